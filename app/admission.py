@@ -0,0 +1,191 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, FrozenSet, Optional, Tuple
+from urllib.parse import parse_qs
+
+from fastapi import status
+from starlette.responses import JSONResponse
+
+import app.config
+from app import metrics
+
+# no database work, or limited on their own (the export builds one copy at a time)
+UNGATED_PATHS = frozenset({'/metrics', '/token', '/docs', '/redoc', '/openapi.json', '/openapi/yaml',
+                           '/download/database', '/profile', '/profile/rules'})
+
+
+class RateLimits:
+    """Token buckets per (route, token): ``burst`` requests at once, refilled at ``rate`` per second.
+
+    Buckets of the least recently seen tokens are dropped beyond ``max_size``; such a token starts over with a full
+    bucket, which only matters for a client cycling through more tokens than that.
+    """
+
+    def __init__(self, limits: Dict[Tuple[str, str], Tuple[float, float]], max_size: int):
+        self.limits = {key: (rate, burst) for key, (rate, burst) in limits.items() if rate > 0}
+        self.max_size = max_size
+        self._buckets: 'OrderedDict[Tuple[str, str, str], Tuple[float, float]]' = OrderedDict()
+
+    def acquire(self, method: str, path: str, token: str) -> float:
+        """Take one request from the bucket and return 0, or the seconds until one is available."""
+        limit = self.limits.get((method, path))
+        if limit is None:
+            return 0.0
+        rate, burst = limit
+        key = (method, path, token)
+        now = time.monotonic()
+        level, updated = self._buckets.get(key, (burst, now))
+        level = min(burst, level + (now - updated) * rate)
+        if level < 1:
+            self._buckets[key] = (level, now)
+            self._buckets.move_to_end(key)
+            return (1 - level) / rate
+        self._buckets[key] = (level - 1, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_size:
+            self._buckets.popitem(last=False)
+        return 0.0
+
+
+class Gate:
+    """Bounds the requests of this worker doing database work at once.
+
+    Up to ``limit`` run and up to ``queue_size`` more wait in arrival order; a request finding the queue full, or
+    waiting longer than ``timeout`` seconds, is turned away instead of adding to the pile-up behind the database. A
+    finishing request hands its slot straight to the first waiter, so a slot is never free while someone waits.
+    """
+
+    def __init__(self, limit: int, queue_size: int, timeout: float):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def enter(self) -> Optional[str]:
+        """Wait for a slot and return None, or the reason the request is shed."""
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return None
+        if len(self._waiters) >= self.queue_size:
+            return 'queue_full'
+        loop = asyncio.get_event_loop()
+        waiter = loop.create_future()
+        self._waiters.append(waiter)
+
+        def expire():
+            if not waiter.done():
+                self._waiters.remove(waiter)
+                waiter.set_result(False)
+
+        timer = loop.call_later(self.timeout, expire)
+        try:
+            admitted = await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled() and waiter.result():
+                self.leave()  # the slot was handed over just before the cancellation
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise
+        finally:
+            timer.cancel()
+        return None if admitted else 'wait_timeout'
+
+    def leave(self):
+        # a cancelled waiter is still queued until its task gets to run
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(True)
+                return
+        self.active -= 1
+
+
+class Admission:
+    """Answers 429 to tokens over their rate and 503 when the database work of this worker backs up.
+
+    Either response carries ``Retry-After`` and is sent before the request touches the database, so a burst costs the
+    clients a retry instead of every request's latency.
+    """
+
+    def __init__(self, rate_limits: RateLimits, gate: Gate, ungated: FrozenSet[str] = UNGATED_PATHS):
+        self.rate_limits = rate_limits
+        self.gate = gate
+        self.ungated = ungated
+        # (reason, route); the route is only told apart for rate limits, a 503 may hit any path
+        self.shed: Dict[Tuple[str, str], int] = {}
+        self.wait = metrics.Histogram(metrics.WAIT_BUCKETS)
+
+    async def _reject(self, scope, receive, send, code: int, reason: str, route: str, retry_after: float):
+        self.shed[reason, route] = self.shed.get((reason, route), 0) + 1
+        detail = 'Too Many Requests' if code == status.HTTP_429_TOO_MANY_REQUESTS else 'Service Unavailable'
+        response = JSONResponse({'detail': detail}, code, headers={'Retry-After': str(max(1, math.ceil(retry_after)))})
+        await response(scope, receive, send)
+
+    async def handle(self, app, scope, receive, send):
+        method, path = scope['method'], scope['path']
+        if (method, path) in self.rate_limits.limits:
+            token = parse_qs(scope.get('query_string', b'').decode('latin-1')).get('token', [''])[0]
+            retry_after = token and self.rate_limits.acquire(method, path, token)
+            if retry_after:
+                return await self._reject(scope, receive, send, status.HTTP_429_TOO_MANY_REQUESTS, 'rate_limited',
+                                          path, retry_after)
+
+        if self.gate.limit <= 0 or path in self.ungated:
+            return await app(scope, receive, send)
+        start = time.perf_counter()
+        reason = await self.gate.enter()
+        self.wait.observe(time.perf_counter() - start)
+        if reason:
+            return await self._reject(scope, receive, send, status.HTTP_503_SERVICE_UNAVAILABLE, reason, '',
+                                      self.gate.timeout)
+        try:
+            await app(scope, receive, send)
+        finally:
+            self.gate.leave()
+
+    def render(self) -> str:
+        lines = [
+            '# HELP dinagon_admission_shed_total Requests turned away before reaching the database.',
+            '# TYPE dinagon_admission_shed_total counter',
+            *(f'dinagon_admission_shed_total{{reason="{reason}",route="{route}"}} {count}'
+              for (reason, route), count in sorted(self.shed.items())),
+            '# HELP dinagon_admission_active Requests of this worker holding a database slot.',
+            '# TYPE dinagon_admission_active gauge',
+            f'dinagon_admission_active {self.gate.active}',
+            '# HELP dinagon_admission_waiting Requests of this worker queued for a database slot.',
+            '# TYPE dinagon_admission_waiting gauge',
+            f'dinagon_admission_waiting {self.gate.waiting}',
+            '# HELP dinagon_admission_wait_seconds Time spent queued for a database slot.',
+            '# TYPE dinagon_admission_wait_seconds histogram',
+            self.wait.render('dinagon_admission_wait_seconds', ''),
+        ]
+        return '\n'.join(lines) + '\n'
+
+
+class AdmissionMiddleware:
+    """ASGI middleware passing HTTP requests through an ``Admission``."""
+
+    def __init__(self, app, admission: Admission):
+        self.app = app
+        self.admission = admission
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        await self.admission.handle(self.app, scope, receive, send)
+
+
+admission = Admission(
+    RateLimits({
+        ('POST', '/answer'): (app.config.ANSWER_RATE, app.config.ANSWER_BURST),
+        ('GET', '/recommendation'): (app.config.RECOMMENDATION_RATE, app.config.RECOMMENDATION_BURST),
+    }, app.config.RATE_LIMIT_TOKENS),
+    Gate(app.config.DB_CONCURRENCY, app.config.DB_QUEUE_SIZE, app.config.DB_QUEUE_TIMEOUT))
+metrics.register(admission.render)
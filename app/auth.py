@@ -0,0 +1,119 @@
+import time
+import uuid
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import jwt
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import app.config
+from app import metrics
+from app.controller import is_legacy_user
+from app.secrets import JWT_SECRET
+from app.shards import shards
+
+ALGORITHM = 'HS256'
+# a signed token is well under 200 characters; anything far longer is rejected before any parsing
+MAX_TOKEN_LENGTH = 512
+
+_MISSING = object()
+
+
+class TokenCache:
+    """Bounded LRU of token -> user id, where None records a rejected token.
+
+    Accepted tokens are kept for ``ttl`` seconds and rejected ones for ``negative_ttl`` seconds, so a client
+    repeating a garbage or unknown token is answered from memory until the entry expires.
+    """
+
+    def __init__(self, max_size: int, ttl: float, negative_ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: 'OrderedDict[str, Tuple[float, Optional[uuid.UUID]]]' = OrderedDict()
+
+    def get(self, token: str):
+        entry = self._entries.get(token)
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            return _MISSING
+        self._entries.move_to_end(token)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, token: str, user_id: Optional[uuid.UUID]):
+        expires = time.monotonic() + (self.ttl if user_id else self.negative_ttl)
+        self._entries[token] = (expires, user_id)
+        self._entries.move_to_end(token)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def render(self) -> str:
+        return '\n'.join([
+            '# HELP dinagon_token_cache_requests_total Token resolutions by cache outcome.',
+            '# TYPE dinagon_token_cache_requests_total counter',
+            f'dinagon_token_cache_requests_total{{outcome="hit"}} {self.hits}',
+            f'dinagon_token_cache_requests_total{{outcome="miss"}} {self.misses}',
+            '# HELP dinagon_token_cache_entries Tokens held in the cache.',
+            '# TYPE dinagon_token_cache_entries gauge',
+            f'dinagon_token_cache_entries {len(self._entries)}',
+        ]) + '\n'
+
+
+token_cache = TokenCache(app.config.TOKEN_CACHE_SIZE, app.config.TOKEN_CACHE_TTL,
+                         app.config.TOKEN_CACHE_NEGATIVE_TTL)
+metrics.register(token_cache.render)
+
+
+def issue_token(user_id: uuid.UUID) -> str:
+    return jwt.encode({'sub': user_id.hex}, JWT_SECRET, algorithm=ALGORITHM)
+
+
+def decode_token(token: str) -> Optional[uuid.UUID]:
+    try:
+        return uuid.UUID(jwt.decode(token, JWT_SECRET, algorithms=[ALGORITHM])['sub'])
+    except (jwt.InvalidTokenError, KeyError, ValueError):
+        return None
+
+
+def _parse_legacy(token: str) -> Optional[uuid.UUID]:
+    if len(token) not in (32, 36):
+        return None
+    try:
+        return uuid.UUID(token)
+    except ValueError:
+        return None
+
+
+async def _resolve(token: str, session: AsyncSession) -> Optional[uuid.UUID]:
+    if '.' in token:
+        return decode_token(token)
+    user_id = _parse_legacy(token)
+    if user_id is None:
+        return None
+    shards.route_user(session, user_id)
+    return user_id if await is_legacy_user(user_id, session) else None
+
+
+async def authenticate(token: str, session: AsyncSession) -> Optional[uuid.UUID]:
+    """Return the user id a token stands for, or None when it is not valid.
+
+    Signed tokens are verified locally. Tokens issued before them are bare user ids, accepted only for the users marked
+    in ``legacy_users``: a user created since has a ``users`` row too, but their id is not a secret (it is the ``sub``
+    of their token), so it must not work as one. ``/question`` hands legacy clients a signed token for the same id.
+    Both outcomes go through ``token_cache``. An accepted token routes ``session`` to the user's shard.
+    """
+    if not token or len(token) > MAX_TOKEN_LENGTH:
+        return None
+    user_id = token_cache.get(token)
+    if user_id is _MISSING:
+        user_id = await _resolve(token, session)
+        token_cache.put(token, user_id)
+    if user_id:
+        shards.route_user(session, user_id)
+    return user_id
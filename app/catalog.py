@@ -0,0 +1,221 @@
+import asyncio
+import time
+import uuid
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from dataclasses import dataclass
+from functools import cached_property
+from typing import Dict, Iterable, List, Tuple, Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import app.config
+from app.models import (Question, Assertion, TestCase, Tag, CatalogVersion, question_tag_relation,
+                        assertion_tag_relation)
+
+
+@dataclass(frozen=True)
+class TagEntry:
+    id: uuid.UUID
+    name: str
+    tutorial_link: str
+
+
+@dataclass(frozen=True)
+class TestCaseEntry:
+    input: str
+    expected: str
+
+
+@dataclass(frozen=True)
+class AssertionEntry:
+    id: uuid.UUID
+    question_id: uuid.UUID
+    assertion: str
+    message: str
+    tags: Tuple[TagEntry, ...]
+
+
+@dataclass(frozen=True)
+class QuestionEntry:
+    id: uuid.UUID
+    title: str
+    description: str
+    default_code: str
+    level: int
+    tags: Tuple[TagEntry, ...]
+    test_cases: Tuple[TestCaseEntry, ...]
+    assertions: Tuple[AssertionEntry, ...]
+
+
+class QuestionIndex:
+    """The questions of a catalog in (level, id) order, with inverted indexes over that order.
+
+    A set of questions is an int used as a bitset of positions, so a filter is a few big-int operations whatever the
+    size of the bank. Levels need no index of their own: a level range is a contiguous run of positions.
+    """
+
+    def __init__(self, questions: Iterable[QuestionEntry]):
+        ordered = sorted(questions, key=lambda q: (q.level, q.id))
+        self.ids = tuple(q.id for q in ordered)
+        self.keys = [(q.level, q.id) for q in ordered]
+        self.levels = [q.level for q in ordered]
+        self.positions = {q.id: i for i, q in enumerate(ordered)}
+        self.every = (1 << len(ordered)) - 1
+        positions = defaultdict(list)
+        for i, q in enumerate(ordered):
+            for tag in q.tags:
+                positions[tag.id].append(i)
+        self.tags = {tag_id: self.members_at(p) for tag_id, p in positions.items()}
+
+    def members_at(self, positions: Iterable[int]) -> int:
+        # set in a byte array and converted once; OR-ing bits into an int one by one copies it every time
+        bits = bytearray((len(self.ids) + 7) // 8)
+        for i in positions:
+            bits[i >> 3] |= 1 << (i & 7)
+        return int.from_bytes(bits, 'little')
+
+    def _from(self, start: int) -> int:
+        return self.every >> start << start
+
+    def level_range(self, low: Optional[int], high: Optional[int]) -> int:
+        start = 0 if low is None else bisect_left(self.levels, low)
+        end = len(self.levels) if high is None else bisect_right(self.levels, high)
+        return self._from(start) & ~self._from(end)
+
+    def tagged(self, tag_ids: Iterable[uuid.UUID], match_all: bool = False) -> int:
+        masks = [self.tags.get(tag_id, 0) for tag_id in tag_ids]
+        if not masks:
+            return self.every
+        mask = masks[0]
+        for m in masks[1:]:
+            mask = mask & m if match_all else mask | m
+        return mask
+
+    def members(self, question_ids: Iterable[uuid.UUID]) -> int:
+        positions = self.positions
+        return self.members_at(filter(None.__ne__, map(positions.get, question_ids)))
+
+    def after(self, key: Tuple[int, uuid.UUID]) -> int:
+        """Questions ordered after ``key``, which need not belong to the catalog any more."""
+        return self._from(bisect_right(self.keys, key))
+
+    @staticmethod
+    def encode_cursor(key: Tuple[int, uuid.UUID]) -> str:
+        return f'{key[0]}.{key[1].hex}'
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> Tuple[int, uuid.UUID]:
+        """Raises ValueError for anything encode_cursor did not make."""
+        level, _, question_id = cursor.partition('.')
+        return int(level), uuid.UUID(hex=question_id)
+
+    def page(self, mask: int, limit: Optional[int] = None) -> Tuple[List[uuid.UUID], bool]:
+        """The first ``limit`` questions of ``mask`` in order, and whether more follow."""
+        bits = format(mask, 'b')[::-1]
+        ids, position = [], bits.find('1')
+        while position >= 0 and (limit is None or len(ids) < limit):
+            ids.append(self.ids[position])
+            position = bits.find('1', position + 1)
+        return ids, position >= 0
+
+
+class Catalog:
+    """Immutable snapshot of the question bank at a given catalog version."""
+
+    def __init__(self, version: int, questions: Dict[uuid.UUID, QuestionEntry], tags: Dict[uuid.UUID, TagEntry]):
+        self.version = version
+        self.questions = questions
+        self.tags = tags
+        self.assertions: Dict[uuid.UUID, AssertionEntry] = {
+            a.id: a for q in questions.values() for a in q.assertions
+        }
+
+    @cached_property
+    def index(self) -> QuestionIndex:
+        return QuestionIndex(self.questions.values())
+
+    def __repr__(self):
+        return f'Catalog(version={self.version!r}, questions={len(self.questions)})'
+
+
+async def get_catalog_version(session: AsyncSession) -> int:
+    version = await session.get(CatalogVersion, 1)
+    return version.version if version else 0
+
+
+async def load_catalog(session: AsyncSession) -> Catalog:
+    # The whole bank is fetched table by table, seven statements whatever its size, instead of walking the
+    # relationships (which are lazy='raise_on_sql') or chunking IN lists with selectinload.
+    version = await get_catalog_version(session)
+    tags = {t.id: TagEntry(id=t.id, name=t.name, tutorial_link=t.tutorial_link)
+            for t in (await session.execute(select(Tag))).scalars()}
+
+    question_tags, assertion_tags = defaultdict(list), defaultdict(list)
+    for question_id, tag_id in await session.execute(select(question_tag_relation.c.question_id,
+                                                            question_tag_relation.c.tag_id)):
+        question_tags[question_id].append(tags[tag_id])
+    for assertion_id, tag_id in await session.execute(select(assertion_tag_relation.c.assertion_id,
+                                                             assertion_tag_relation.c.tag_id)):
+        assertion_tags[assertion_id].append(tags[tag_id])
+
+    test_cases, assertions = defaultdict(list), defaultdict(list)
+    for t in (await session.execute(select(TestCase).order_by(TestCase.question_id))).scalars():
+        test_cases[t.question_id].append(TestCaseEntry(input=t.input, expected=t.expected))
+    for a in (await session.execute(select(Assertion).order_by(Assertion.question_id))).scalars():
+        assertions[a.question_id].append(AssertionEntry(id=a.id, question_id=a.question_id, assertion=a.assertion,
+                                                        message=a.message, tags=tuple(assertion_tags[a.id])))
+
+    return Catalog(version, {
+        q.id: QuestionEntry(id=q.id, title=q.title, description=q.description, default_code=q.default_code,
+                            level=q.level, tags=tuple(question_tags[q.id]), test_cases=tuple(test_cases[q.id]),
+                            assertions=tuple(assertions[q.id]))
+        for q in (await session.execute(select(Question).filter(Question.listed.is_(True)))).scalars()
+    }, tags)
+
+
+class CatalogCache:
+    """Read-through, per-worker cache of the catalog.
+
+    The stored version is compared with ``catalog_version`` at most once every ``check_interval`` seconds, and a
+    changed version is reloaded in full and swapped in as a single reference assignment. With a snapshot file set
+    (see app/snapshot.py), a snapshot of the current version is mapped instead of querying the tables.
+    """
+
+    def __init__(self, check_interval: float):
+        self.check_interval = check_interval
+        self.snapshot = None
+        self._catalog: Optional[Catalog] = None
+        self._checked_at = 0.0
+        self._lock: Optional[asyncio.Lock] = None
+
+    def _is_fresh(self) -> bool:
+        return self._catalog is not None and time.monotonic() - self._checked_at < self.check_interval
+
+    async def get(self, session: AsyncSession) -> Catalog:
+        if self._is_fresh():
+            return self._catalog
+
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._is_fresh():
+                return self._catalog
+            catalog = self._catalog
+            # a cold load without a snapshot reads the version along with the tables
+            version = None if catalog is None and not self.snapshot else await get_catalog_version(session)
+            mapped = self.snapshot and self.snapshot.open(version)
+            if mapped:
+                self._catalog = mapped
+            elif catalog is None or version != catalog.version:
+                self._catalog = await load_catalog(session)
+            self._checked_at = time.monotonic()
+            return self._catalog
+
+    def invalidate(self):
+        self._checked_at = 0.0
+        self._catalog = None
+
+
+catalog_cache = CatalogCache(app.config.CATALOG_CHECK_INTERVAL)
@@ -0,0 +1,214 @@
+import argparse
+import datetime
+import random
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+from sqlalchemy import select, insert, delete
+
+from app.controller import rank_tags
+from app.models import *
+from app.shards import shards
+
+
+def _csr(rows: np.ndarray, cols: np.ndarray, n_rows: int) -> Tuple[np.ndarray, np.ndarray]:
+    order = np.argsort(rows, kind='stable')
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n_rows), out=indptr[1:])
+    return indptr, cols[order]
+
+
+def _tag_counts(rows: np.ndarray, cols: np.ndarray, indptr: np.ndarray, indices: np.ndarray,
+                n_rows: int, n_tags: int) -> np.ndarray:
+    """Dense rows x tags product of the COO matrix (rows, cols) with the CSR cols x tags matrix."""
+    starts = indptr[cols]
+    lengths = indptr[cols + 1] - starts
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    tags = indices[np.repeat(starts, lengths) + offsets]
+    return np.bincount(np.repeat(rows, lengths) * n_tags + tags, minlength=n_rows * n_tags).reshape(n_rows, n_tags)
+
+
+class CatalogMatrices:
+    """Assertion x tag and question x tag incidence matrices in CSR form."""
+
+    def __init__(self, session: Session):
+        self.tag_ids = session.execute(select(Tag.id)).scalars().all()
+        tag_index = {t: i for i, t in enumerate(self.tag_ids)}
+        assertions = session.execute(select(Assertion.id, Assertion.question_id)).all()
+        self.assertion_index = {a: i for i, (a, _) in enumerate(assertions)}
+        self.question_index = {q: i for i, q in enumerate({q for _, q in assertions})}
+        assertion_question = np.array([self.question_index[q] for _, q in assertions], dtype=np.int64)
+
+        pairs = np.array([(self.assertion_index[a], tag_index[t]) for a, t in session.execute(
+            select(assertion_tag_relation.c.assertion_id, assertion_tag_relation.c.tag_id))
+                          if a in self.assertion_index and t in tag_index], dtype=np.int64).reshape(-1, 2)
+        self.assertion_tags = _csr(pairs[:, 0], pairs[:, 1], len(assertions))
+        self.question_tags = _csr(assertion_question[pairs[:, 0]], pairs[:, 1], len(self.question_index))
+
+
+def score_block(matrices: CatalogMatrices, rows: list) -> Dict[uuid.UUID, List[Tuple[uuid.UUID, float]]]:
+    """Score every user of a block of answer rows sorted by (user, question, timestamp, answer).
+
+    Each row is (user, question, answer id, is_correct, failed assertion id or None). The representative answer of a
+    (user, question) pair is the latest one unless the pair was ever answered correctly, as in create_answer.
+    """
+    users, user_index = [], {}
+    a_user, a_question, a_correct = [], [], []
+    f_answer, f_assertion = [], []
+    last_answer = None
+    for user, question, answer_id, is_correct, assertion_id in rows:
+        q = matrices.question_index.get(question)
+        if q is None:
+            continue
+        if answer_id != last_answer:
+            last_answer = answer_id
+            if user not in user_index:
+                user_index[user] = len(users)
+                users.append(user)
+            a_user.append(user_index[user])
+            a_question.append(q)
+            a_correct.append(bool(is_correct))
+        a = matrices.assertion_index.get(assertion_id)
+        if a is not None:
+            f_answer.append(len(a_user) - 1)
+            f_assertion.append(a)
+    if not users:
+        return {}
+
+    a_user = np.array(a_user, dtype=np.int64)
+    a_question = np.array(a_question, dtype=np.int64)
+    a_correct = np.array(a_correct, dtype=np.int8)
+    f_answer = np.array(f_answer, dtype=np.int64)
+    f_assertion = np.array(f_assertion, dtype=np.int64)
+
+    boundary = np.ones(len(a_user), dtype=bool)
+    boundary[1:] = (a_user[1:] != a_user[:-1]) | (a_question[1:] != a_question[:-1])
+    starts = np.flatnonzero(boundary)
+    ends = np.append(starts[1:], len(a_user)) - 1
+    solved = np.maximum.reduceat(a_correct, starts).astype(bool)
+
+    representative = np.zeros(len(a_user), dtype=bool)
+    representative[ends[~solved]] = True
+    failing = representative[f_answer]
+
+    n_users, n_tags = len(users), len(matrices.tag_ids)
+    exposures = _tag_counts(a_user[starts], a_question[starts], *matrices.question_tags, n_users, n_tags)
+    failures = _tag_counts(a_user[f_answer[failing]], f_assertion[failing], *matrices.assertion_tags,
+                           n_users, n_tags)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = (failures / failures.sum(axis=1, keepdims=True)) / (exposures / exposures.sum(axis=1, keepdims=True))
+    user_idx, tag_idx = np.nonzero((failures > 0) & (exposures > 0))
+    values = scores[user_idx, tag_idx]
+    order = np.lexsort((-values, user_idx))
+
+    result = {user: [] for user in users}
+    for u, t, score in zip(user_idx[order].tolist(), tag_idx[order].tolist(), values[order].tolist()):
+        result[users[u]].append((matrices.tag_ids[t], score))
+    return result
+
+
+def _answer_rows():
+    return select(Answer.user, Answer.question, Answer.id, Answer.is_correct,
+                  answer_assertion_relation.c.assertion_id) \
+        .outerjoin(answer_assertion_relation, answer_assertion_relation.c.answer_id == Answer.id) \
+        .order_by(Answer.user, Answer.question, Answer.timestamp, Answer.id)
+
+
+def iter_user_blocks(connection, chunk_size: int):
+    """Stream answer rows in chunks and yield them grouped so that no user is split across two blocks."""
+    result = connection.execution_options(stream_results=True).execute(_answer_rows())
+    pending = []
+    while True:
+        chunk = result.fetchmany(chunk_size)
+        if not chunk:
+            break
+        pending.extend(chunk)
+        tail_user = pending[-1][0]
+        split = len(pending)
+        while split and pending[split - 1][0] == tail_user:
+            split -= 1
+        if split:
+            yield pending[:split]
+            pending = pending[split:]
+    if pending:
+        yield pending
+
+
+def write_results(session: Session, scores: Dict[uuid.UUID, List[Tuple[uuid.UUID, float]]],
+                  computed_at: datetime.datetime, batch_size: int = 10000):
+    session.execute(delete(TagRecommendation))
+    records = [{'user': user, 'tag': tag_id, 'rank': rank, 'score': score, 'computed_at': computed_at}
+               for user, tags in scores.items() for rank, (tag_id, score) in enumerate(tags)]
+    for i in range(0, len(records), batch_size):
+        session.execute(insert(TagRecommendation), records[i:i + batch_size])
+    session.commit()
+
+
+def run(chunk_size: int = 50000) -> Tuple[int, int]:
+    # Only the per-user results are kept in memory, answers are streamed. They are written once the stream is
+    # closed, because an open SQLite read cursor would block the commit, and in a single transaction per shard so
+    # that the API never serves a half-written run of a shard.
+    computed_at = datetime.datetime.now()
+    session = SessionLocal()
+    try:
+        matrices = CatalogMatrices(session)
+    finally:
+        session.close()
+
+    users = rows = 0
+    for shard_engine, shard_session in zip(shards.engines(), shards.sync_sessions()):
+        scores = {}
+        try:
+            with shard_engine.connect() as connection:
+                for block in iter_user_blocks(connection, chunk_size):
+                    scores.update(score_block(matrices, block))
+                    rows += len(block)
+            write_results(shard_session, scores, computed_at)
+        finally:
+            shard_session.close()
+        users += len(scores)
+    return users, rows
+
+
+def check_parity(sample: int, tolerance: float = 1e-9) -> List[uuid.UUID]:
+    """Compare stored batch results with the per-user ranking served by /recommendation."""
+    sessions = {}
+    for session in shards.sync_sessions():
+        for user in session.execute(select(UserTagStat.user).distinct()).scalars():
+            sessions[user] = session
+    try:
+        users = list(sessions)
+        mismatched = []
+        for user in random.sample(users, min(sample, len(users))):
+            session = sessions[user]
+            expected = rank_tags({s.tag: (s.exposures, s.failures)
+                                  for s in session.query(UserTagStat).filter(UserTagStat.user == user)})
+            stored = session.query(TagRecommendation).filter(TagRecommendation.user == user) \
+                .order_by(TagRecommendation.rank).all()
+            expected_scores = dict(expected)
+            if len(stored) != len(expected) or any(
+                    abs(expected_scores.get(r.tag, float('nan')) - r.score) > tolerance for r in stored):
+                mismatched.append(user)
+        return mismatched
+    finally:
+        for session in set(sessions.values()):
+            session.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compute tag recommendations for every user at once')
+    parser.add_argument('--chunk-size', type=int, default=50000, help='answer rows fetched per round trip')
+    parser.add_argument('--check', type=int, default=0, metavar='N',
+                        help='afterwards compare N random users with the per-user /recommendation ranking')
+    args = parser.parse_args()
+
+    create_database()
+    start = time.perf_counter()
+    users, rows = run(args.chunk_size)
+    print(f'{users} users scored from {rows} answer rows in {time.perf_counter() - start:.2f}s')
+    if args.check:
+        mismatched = check_parity(args.check)
+        print(f'{len(mismatched)} of {args.check} sampled users differ from the per-user ranking')
+        raise SystemExit(1 if mismatched else 0)
@@ -3,7 +3,66 @@ import os
 IS_LOCAL = os.path.exists('.LOCAL')
 IS_DEV = True
 HTML_DIR = 'app/templates'
-DATABASE_URI = 'sqlite:///database.db'
+# 'sqlite' (WAL, one writer connection) or 'mysql' (pooled); engine settings for each are in app/profiles.py
+DATABASE_PROFILE = os.environ.get('DATABASE_PROFILE', 'sqlite')
+if DATABASE_PROFILE == 'mysql':
+    MYSQL_URL = os.environ.get('MYSQL_URL', 'dinagon:dinagon@localhost:3306/dinagon')
+    DATABASE_URI = f'mysql+mysqldb://{MYSQL_URL}?charset=utf8mb4'
+    ASYNC_DATABASE_URI = f'mysql+aiomysql://{MYSQL_URL}?charset=utf8mb4'
+else:
+    DATABASE_URI = 'sqlite:///database.db'
+    ASYNC_DATABASE_URI = 'sqlite+aiosqlite:///database.db'
+# users, answers and the per-user tables are split over this many databases by a hash of the user id (app/shards.py);
+# 1 keeps them in the main database. Change it with `python -m app.maintenance reshard`.
+ANSWER_SHARDS = int(os.environ.get('ANSWER_SHARDS', 1))
+DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE', 10))
+DATABASE_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW', 10))
+DATABASE_POOL_TIMEOUT = float(os.environ.get('DATABASE_POOL_TIMEOUT', 30))
+MYSQL_POOL_RECYCLE = int(os.environ.get('MYSQL_POOL_RECYCLE', 3600))
+SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000))  # milliseconds
+UUID_BINARY = os.environ.get('UUID_BINARY', '0') == '1'
+CATALOG_CHECK_INTERVAL = float(os.environ.get('CATALOG_CHECK_INTERVAL', 5))
+# compiled by `python -m app.maintenance build-snapshot`, e.g. catalog.snapshot; empty (the default) to always read the
+# catalog from the tables
+CATALOG_SNAPSHOT = os.environ.get('CATALOG_SNAPSHOT', '')
+QUESTION_PAGE_LIMIT = int(os.environ.get('QUESTION_PAGE_LIMIT', 500))
+SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE', 256))  # result lists kept per worker for paging
+ANSWER_BATCH_LIMIT = int(os.environ.get('ANSWER_BATCH_LIMIT', 1000))
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 10000))
+TOKEN_CACHE_TTL = float(os.environ.get('TOKEN_CACHE_TTL', 300))
+TOKEN_CACHE_NEGATIVE_TTL = float(os.environ.get('TOKEN_CACHE_NEGATIVE_TTL', 30))
+# POST /answer queues answers for group commits instead of committing each one (see app/writebehind.py)
+WRITE_BEHIND = os.environ.get('WRITE_BEHIND', '0') == '1'
+WRITE_BEHIND_DURABILITY = os.environ.get('WRITE_BEHIND_DURABILITY', 'buffered')  # or 'committed'
+WRITE_BEHIND_QUEUE_SIZE = int(os.environ.get('WRITE_BEHIND_QUEUE_SIZE', 10000))
+WRITE_BEHIND_BATCH_SIZE = int(os.environ.get('WRITE_BEHIND_BATCH_SIZE', 500))
+WRITE_BEHIND_INTERVAL = float(os.environ.get('WRITE_BEHIND_INTERVAL', 0.05))
+# POST /answer and GET /recommendation allow bursts of *_BURST requests per token, refilled at *_RATE per second (0, the
+# default: no limit); buckets are kept for the RATE_LIMIT_TOKENS most recently seen tokens
+ANSWER_RATE = float(os.environ.get('ANSWER_RATE', 0))
+ANSWER_BURST = float(os.environ.get('ANSWER_BURST', 10))
+RECOMMENDATION_RATE = float(os.environ.get('RECOMMENDATION_RATE', 0))
+RECOMMENDATION_BURST = float(os.environ.get('RECOMMENDATION_BURST', 5))
+RATE_LIMIT_TOKENS = int(os.environ.get('RATE_LIMIT_TOKENS', 10000))
+# at most DB_CONCURRENCY requests per worker do database work at once (0: no limit); up to DB_QUEUE_SIZE more wait, for
+# at most DB_QUEUE_TIMEOUT seconds, and the rest get 503 (see app/admission.py)
+DB_CONCURRENCY = int(os.environ.get('DB_CONCURRENCY', 20))
+DB_QUEUE_SIZE = int(os.environ.get('DB_QUEUE_SIZE', 100))
+DB_QUEUE_TIMEOUT = float(os.environ.get('DB_QUEUE_TIMEOUT', 2))
+# app/rollups.py leaves answers younger than this many seconds for the next refresh, as they may still be committing
+ROLLUP_LAG = float(os.environ.get('ROLLUP_LAG', 120))
+DASHBOARD_MAX_DAYS = int(os.environ.get('DASHBOARD_MAX_DAYS', 366))
+# /download/database builds at most this many copies at a time and streams each at up to DOWNLOAD_RATE bytes/s (0: no
+# limit)
+DOWNLOAD_CONCURRENCY = int(os.environ.get('DOWNLOAD_CONCURRENCY', 1))
+DOWNLOAD_RATE = int(os.environ.get('DOWNLOAD_RATE', 16 * 1024 * 1024))
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get('DOWNLOAD_CHUNK_SIZE', 256 * 1024))
+# traces of profiled requests are kept in PROFILE_DIR, at most PROFILE_KEEP of them, sampled every PROFILE_INTERVAL
+# seconds; profiling is only available when PROFILE_KEY is set (app/secrets.py)
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', 50))
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.001))
 
 HOST = '0.0.0.0'
 PORT = int(os.environ.get('PORT', 8888))
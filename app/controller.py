@@ -1,75 +1,235 @@
-from typing import Optional, List, Tuple
+import heapq
+from collections import Counter
+from typing import Optional, List, Set, Dict, Tuple
 
 from fastapi import HTTPException, status
-from sqlalchemy import desc
-from sqlalchemy.sql import func
+from sqlalchemy import select, insert, update, func
+from sqlalchemy.orm.attributes import flag_modified
 
+from app.catalog import Catalog, catalog_cache
 from app.models import *
-
-
-def get_user_by_id(id_: str, session: Session) -> Optional[User]:
-    return session.query(User).get(uuid.UUID(id_))
-
-
-def create_user(session: Session) -> User:
-    user = User()
-    session.add(user)
-    session.commit()
-    return user
-
-
-def get_questions(user: User, session: Session) -> List[Tuple[Question, bool]]:
-    answered_correctly = session.query(func.max(Answer.is_correct), Answer.question) \
-        .filter(Answer.user == user.id) \
-        .group_by(Answer.question) \
-        .subquery()
-    questions = session.query(Question, answered_correctly) \
-        .outerjoin(answered_correctly, answered_correctly.c.question == Question.id) \
-        .all()
-
-    return [(q, ans[0] is True) for q, *ans in questions]
-
-
-def get_question(user: User, question_id: uuid.UUID, session: Session) -> Tuple[Question, bool]:
-    answered_correctly = session.query(func.max(Answer.is_correct), Answer.question) \
-        .filter(Answer.user == user.id) \
-        .group_by(Answer.question) \
-        .subquery()
-    q, *ans = session.query(Question, answered_correctly) \
-        .outerjoin(answered_correctly, answered_correctly.c.question == Question.id) \
-        .filter(Question.id == question_id) \
-        .one_or_none()
-
-    return q, ans[0] is True
-
-
-def get_questions_by_id(question_ids: List[uuid.UUID], session: Session) -> List[Question]:
-    return session.query(Question).filter(Question.id.in_(question_ids)).all()
-
-
-def get_answers(user: User, session: Session) -> List[Answer]:
-    answers = session.query(Answer) \
-        .filter(Answer.user == user.id) \
-        .order_by(desc(Answer.is_correct)) \
-        .subquery()
-    q = session.query() \
-        .add_entity(Answer, alias=answers).group_by(answers.c.question) \
-        .all()
-
-    return q
-
-
-def create_answer(user: User, question_id: uuid.UUID, is_correct: bool, failed_assertions: List[uuid.UUID],
-                  is_assertion_used: bool, session: Session):
-    question = session.query(Question).get(question_id)
-    if not question:
-        raise HTTPException(status.HTTP_404_NOT_FOUND)
-    assertions = session.query(Assertion).filter(Assertion.id.in_([a for a in failed_assertions])).all()
-    if len(assertions) != len(failed_assertions):
-        raise HTTPException(status.HTTP_400_BAD_REQUEST)
-
-    answer = Answer(user=user.id, question=question_id, is_correct=is_correct, failed_assertions=assertions,
-                    use_assertions=is_assertion_used)
-
-    session.add(answer)
-    session.commit()
+from app.rollups import key_column, count_columns
+from app.shards import shards
+
+
+async def is_legacy_user(user_id: uuid.UUID, session: AsyncSession) -> bool:
+    return await session.get(LegacyUser, user_id) is not None
+
+
+async def get_progress_version(user_id: uuid.UUID, session: AsyncSession) -> int:
+    version = await session.execute(select(User.progress_version).filter(User.id == user_id))
+    return version.scalar() or 0
+
+
+async def get_solved_questions(user_id: uuid.UUID, session: AsyncSession) -> Set[uuid.UUID]:
+    solved = await session.execute(
+        select(UserQuestionProgress.question)
+        .filter(UserQuestionProgress.user == user_id, UserQuestionProgress.solved.is_(True))
+    )
+    return set(solved.scalars())
+
+
+async def is_solved(user_id: uuid.UUID, question_id: uuid.UUID, session: AsyncSession) -> bool:
+    progress = await session.get(UserQuestionProgress, (user_id, question_id))
+    return progress is not None and progress.solved
+
+
+async def get_tag_stats(user_id: uuid.UUID, session: AsyncSession) -> List[UserTagStat]:
+    stats = await session.execute(select(UserTagStat).filter(UserTagStat.user == user_id))
+    return stats.scalars().all()
+
+
+def rank_tags(stats: Dict[uuid.UUID, Tuple[int, int]]) -> List[Tuple[uuid.UUID, float]]:
+    """Order tags by how over-represented they are among failures, given (exposures, failures) per tag."""
+    exposures = sum(e for e, _ in stats.values())
+    failures = sum(f for _, f in stats.values())
+
+    result = []
+    for tag_id, (tag_exposures, tag_failures) in stats.items():
+        if tag_failures > 0 and tag_exposures > 0:
+            wrong_ratio = tag_failures / failures
+            tag_ratio = tag_exposures / exposures
+            result.append((tag_id, wrong_ratio / tag_ratio))
+
+    result.sort(key=lambda r: -r[1])
+    return result
+
+
+async def _cohort_page(offset: int, limit: int, session: AsyncSession) \
+        -> List[Tuple[uuid.UUID, List[TagRecommendation]]]:
+    users = select(TagRecommendation.user).distinct().order_by(TagRecommendation.user).offset(offset).limit(limit)
+    recommendations = await session.execute(
+        select(TagRecommendation)
+        .filter(TagRecommendation.user.in_(users.scalar_subquery()))
+        .order_by(TagRecommendation.user, TagRecommendation.rank)
+    )
+    result = {}
+    for r in recommendations.scalars():
+        result.setdefault(r.user, []).append(r)
+    return list(result.items())
+
+
+async def get_cohort_recommendations(offset: int, limit: int, session: AsyncSession) \
+        -> List[Tuple[uuid.UUID, List[TagRecommendation]]]:
+    if not shards:
+        return await _cohort_page(offset, limit, session)
+    # every shard orders its users by id, so the page is within the first offset + limit users of each
+    pages = await shards.gather(lambda shard_session: _cohort_page(0, offset + limit, shard_session))
+    return list(heapq.merge(*pages, key=lambda page: page[0]))[offset:offset + limit]
+
+
+async def get_rollups(model, bucket: str, since: datetime.datetime, until: datetime.datetime,
+                      session: AsyncSession) -> Dict[Tuple[datetime.datetime, uuid.UUID], Counter]:
+    """Counts of a rollup table summed per ``bucket`` ('hour' or 'day') and key, between since and until."""
+    key, counts = key_column(model), count_columns(model)
+    rows = await session.execute(select(model).filter(model.bucket >= since, model.bucket < until))
+    result = {}
+    for row in rows.scalars():
+        start = row.bucket if bucket == 'hour' else row.bucket.replace(hour=0)
+        result.setdefault((start, getattr(row, key)), Counter()).update({c: getattr(row, c) for c in counts})
+    return result
+
+
+async def get_rollup_mark(session: AsyncSession) -> Optional[datetime.datetime]:
+    """Time up to which every shard's answers are in the rollups."""
+    return (await session.execute(select(func.min(RollupMark.high_water)))).scalar()
+
+
+async def _record_tag_stats(exposures: Counter, failures: Counter, session: AsyncSession):
+    """Apply counter deltas keyed by (user id, tag id)."""
+    keys = {k for k, n in exposures.items() if n} | {k for k, n in failures.items() if n}
+    if not keys:
+        return
+    # the IN lists select a superset of the keys when several users are involved; the extra rows are left alone
+    stats = {(s.user, s.tag): s for s in (await session.execute(
+        select(UserTagStat)
+        .filter(UserTagStat.user.in_({user_id for user_id, _ in keys}),
+                UserTagStat.tag.in_({tag_id for _, tag_id in keys}))
+        .with_for_update()
+    )).scalars()}
+    for user_id, tag_id in keys:
+        stat = stats.get((user_id, tag_id))
+        if stat is None:
+            stat = UserTagStat(user=user_id, tag=tag_id, exposures=0, failures=0)
+            session.add(stat)
+        stat.exposures += exposures[user_id, tag_id]
+        stat.failures += failures[user_id, tag_id]
+        # same column set on every row, so the flush sends one executemany UPDATE
+        flag_modified(stat, 'exposures')
+        flag_modified(stat, 'failures')
+
+
+async def _record_progress(answers: List[Tuple[Answer, List[uuid.UUID]]], catalog: Catalog,
+                           session: AsyncSession):
+    # Tag counters follow one representative answer per question: the first correct one once the question is
+    # solved, the latest one until then. Exposures count every assertion tag of each attempted question once,
+    # failures count the failed assertion tags of the representative answer while it is incorrect.
+    # Answers of each user are applied in the order given.
+    progress = {(p.user, p.question): p for p in (await session.execute(
+        select(UserQuestionProgress)
+        .filter(UserQuestionProgress.user.in_({answer.user for answer, _ in answers}),
+                UserQuestionProgress.question.in_({answer.question for answer, _ in answers}))
+        .with_for_update()
+    )).scalars()}
+
+    failed_by_answer = {}
+    previous_ids = {p.last_answer for p in progress.values() if not p.solved and p.last_answer}
+    if previous_ids:
+        for answer_id, assertion_id in await session.execute(
+                select(answer_assertion_relation.c.answer_id, answer_assertion_relation.c.assertion_id)
+                .filter(answer_assertion_relation.c.answer_id.in_(previous_ids))):
+            failed_by_answer.setdefault(answer_id, []).append(assertion_id)
+
+    exposures, failures = Counter(), Counter()
+    for answer, failed_assertions in answers:
+        user_id = answer.user
+        p = progress.get((user_id, answer.question))
+        if p is None:
+            p = progress[user_id, answer.question] = UserQuestionProgress(user=user_id, question=answer.question,
+                                                                          solved=False, attempts=0)
+            session.add(p)
+
+        if not p.solved:
+            if not p.attempts:
+                exposures.update((user_id, t.id) for a in catalog.questions[answer.question].assertions
+                                 for t in a.tags)
+            elif p.last_answer:
+                failures.subtract((user_id, t.id) for a in failed_by_answer.get(p.last_answer, ())
+                                  if a in catalog.assertions for t in catalog.assertions[a].tags)
+            if not answer.is_correct:
+                failures.update((user_id, t.id) for a in failed_assertions for t in catalog.assertions[a].tags)
+
+        failed_by_answer[answer.id] = failed_assertions
+        p.solved = p.solved or answer.is_correct
+        p.last_answer = answer.id
+        p.attempts += 1
+        p.last_attempt = answer.timestamp
+        flag_modified(p, 'solved')
+    await _record_tag_stats(exposures, failures, session)
+
+
+def validate_answer(question_id: uuid.UUID, failed_assertions: List[uuid.UUID], catalog: Catalog) -> Optional[int]:
+    if question_id not in catalog.questions:
+        return status.HTTP_404_NOT_FOUND
+    if len(set(failed_assertions)) != len(failed_assertions) or \
+            any(a not in catalog.assertions for a in failed_assertions):
+        return status.HTTP_400_BAD_REQUEST
+    return None
+
+
+def build_answers(user_id: uuid.UUID, items: List[Tuple[uuid.UUID, bool, List[uuid.UUID]]],
+                  is_assertion_used: bool) -> List[Tuple[Answer, List[uuid.UUID]]]:
+    now = datetime.datetime.now()
+    # distinct timestamps keep the submission order of a batch visible to later readers
+    return [(Answer(id=uuid.uuid4(), user=user_id, question=question_id, is_correct=is_correct,
+                    use_assertions=is_assertion_used, timestamp=now + datetime.timedelta(microseconds=i)),
+             failed_assertions)
+            for i, (question_id, is_correct, failed_assertions) in enumerate(items)]
+
+
+async def write_answers(answers: List[Tuple[Answer, List[uuid.UUID]]], catalog: Catalog, session: AsyncSession):
+    """Add answers with their failed assertions and update the per-user tables, without committing.
+
+    Every user must belong to the shard ``session`` is routed to.
+    """
+    # tokens are signed and checked without the database, so a user's row only appears with their first answer
+    user_ids = {answer.user for answer, _ in answers}
+    await session.execute(
+        insert(User).prefix_with('OR IGNORE', dialect='sqlite').prefix_with('IGNORE', dialect='mysql'),
+        [{'id': user_id} for user_id in user_ids]
+    )
+    await session.execute(update(User).filter(User.id.in_(user_ids))
+                          .values(progress_version=User.progress_version + 1)
+                          .execution_options(synchronize_session=False))
+    session.add_all(answer for answer, _ in answers)
+    await session.flush()
+    relations = [{'answer_id': answer.id, 'assertion_id': a} for answer, failed in answers for a in failed]
+    if relations:
+        await session.execute(answer_assertion_relation.insert(), relations)
+    await _record_progress(answers, catalog, session)
+
+
+async def create_answer(user_id: uuid.UUID, question_id: uuid.UUID, is_correct: bool,
+                        failed_assertions: List[uuid.UUID], is_assertion_used: bool, session: AsyncSession):
+    shards.route_user(session, user_id)
+    catalog = await catalog_cache.get(session)
+    error = validate_answer(question_id, failed_assertions, catalog)
+    if error:
+        raise HTTPException(error)
+    await write_answers(build_answers(user_id, [(question_id, is_correct, failed_assertions)], is_assertion_used),
+                        catalog, session)
+    await session.commit()
+
+
+async def create_answers(user_id: uuid.UUID, items: List[Tuple[uuid.UUID, bool, List[uuid.UUID]]],
+                         is_assertion_used: bool, session: AsyncSession) -> List[int]:
+    """Store every valid item in one transaction and return a status code per item."""
+    shards.route_user(session, user_id)
+    catalog = await catalog_cache.get(session)
+    results = [validate_answer(question_id, failed_assertions, catalog) or status.HTTP_201_CREATED
+               for question_id, _, failed_assertions in items]
+    valid = [item for item, code in zip(items, results) if code == status.HTTP_201_CREATED]
+    if valid:
+        await write_answers(build_answers(user_id, valid, is_assertion_used), catalog, session)
+        await session.commit()
+    return results
@@ -0,0 +1,164 @@
+import asyncio
+import datetime
+import os
+import sqlite3
+import tempfile
+import time
+import zlib
+from typing import AsyncIterator, BinaryIO, Optional, Set, Tuple
+
+from sqlalchemy import create_engine
+
+import app.config
+from app.models import Base, engine
+from app.shards import SHARDED_TABLES, shards
+
+# SQLAlchemy's storage format for DateTime on SQLite; text comparison then orders like the timestamps
+_SQLITE_DATETIME = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def _path(bind) -> str:
+    return bind.url.database
+
+
+def _backup(source: str, target: str):
+    # One step copies every page inside a single read transaction, which is consistent under WAL and does not
+    # block writers; a stepped copy would restart each time another connection commits.
+    with sqlite3.connect(f'file:{source}?mode=ro', uri=True) as src, sqlite3.connect(target) as dst:
+        src.backup(dst)
+    src.close()
+    dst.close()
+
+
+def _copy_user_tables(target: sqlite3.Connection, source: str, where: dict, parameters: tuple):
+    target.execute('ATTACH DATABASE ? AS src', (f'file:{source}?mode=ro',))
+    try:
+        # the INSERTs run in one transaction, so they all read the same snapshot of the source
+        with target:
+            for table in SHARDED_TABLES:
+                columns = ', '.join(f'"{c.name}"' for c in table.columns)
+                target.execute(f'INSERT INTO main."{table.name}" ({columns}) SELECT {columns} FROM src."{table.name}" '
+                               f'{where.get(table.name, "")}', parameters if table.name in where else ())
+    finally:
+        target.execute('DETACH DATABASE src')
+
+
+def full_snapshot(directory: str) -> str:
+    """Back up the main database, then fold each shard's user tables into the copy.
+
+    Each database is copied consistently on its own; nothing relates the rows of two shards, so the result is as
+    consistent as a single database would be.
+    """
+    path = os.path.join(directory, 'database.db')
+    _backup(_path(engine), path)
+    if shards:
+        with sqlite3.connect(path) as target:
+            # whatever the main database still holds from before sharding is not served any more
+            for table in SHARDED_TABLES:
+                target.execute(f'DELETE FROM "{table.name}"')
+            for shard_engine in shards.engines():
+                copy = os.path.join(directory, 'shard.db')
+                _backup(_path(shard_engine), copy)
+                _copy_user_tables(target, copy, {}, ())
+                os.remove(copy)
+        target.close()
+    return path
+
+
+def changes_since(directory: str, since: datetime.datetime) -> str:
+    """A database holding only the user rows written after ``since``.
+
+    Answers and their failed assertions are selected by ``Answer.timestamp``, progress rows by their last attempt.
+    Users and tag stats have no timestamp, so those of every user who answered since then are included whole. The
+    catalog is left out.
+    """
+    path = os.path.join(directory, 'changes.db')
+    Base.metadata.create_all(create_engine(f'sqlite:///{path}'), tables=SHARDED_TABLES)
+    answered = 'SELECT DISTINCT "user" FROM src.answers WHERE timestamp > ?'
+    where = {
+        'users': f'WHERE id IN ({answered})',
+        'legacy_users': f'WHERE id IN ({answered})',
+        'answers': 'WHERE timestamp > ?',
+        'answer_assertion_relation': 'WHERE answer_id IN (SELECT id FROM src.answers WHERE timestamp > ?)',
+        'user_question_progress': 'WHERE last_attempt > ?',
+        'user_tag_stats': f'WHERE "user" IN ({answered})',
+        'tag_recommendations': f'WHERE "user" IN ({answered})',
+    }
+    with sqlite3.connect(path) as target:
+        for bind in shards.engines():
+            _copy_user_tables(target, _path(bind), where, (since.strftime(_SQLITE_DATETIME),))
+    target.close()
+    return path
+
+
+class DatabaseExport:
+    """Consistent copies of the database, streamed in chunks at a bounded rate.
+
+    At most ``concurrency`` copies are built or streamed at a time; further requests are turned away. A slot is
+    held until the stream of its copy ends, however it ends. The copy is unlinked as soon as it is opened, so it
+    disappears with the response as well.
+    """
+
+    def __init__(self, concurrency: int, rate: int, chunk_size: int):
+        self.concurrency = concurrency
+        self.rate = rate
+        self.chunk_size = chunk_size
+        self._running = 0
+        self._open: Set[BinaryIO] = set()
+
+    async def open(self, since: Optional[datetime.datetime] = None) -> Optional[BinaryIO]:
+        """Build a copy and return it opened, or None when ``concurrency`` copies are already in use."""
+        if self._running >= self.concurrency:
+            return None
+        self._running += 1
+        try:
+            file = await asyncio.get_event_loop().run_in_executor(None, self._build, since)
+        except BaseException:
+            self._running -= 1
+            raise
+        self._open.add(file)
+        return file
+
+    def close(self, file: BinaryIO):
+        """Close a copy returned by ``open`` and give its slot back; closing it again does nothing."""
+        if file in self._open:
+            self._open.remove(file)
+            self._running -= 1
+        file.close()
+
+    @staticmethod
+    def _build(since: Optional[datetime.datetime]) -> BinaryIO:
+        with tempfile.TemporaryDirectory() as directory:
+            path = full_snapshot(directory) if since is None else changes_since(directory, since)
+            return open(path, 'rb')
+
+    async def stream(self, file: BinaryIO, compress: bool = False) -> AsyncIterator[bytes]:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None  # 31: gzip container
+
+        def next_chunk() -> Tuple[bytes, bool]:
+            data = file.read(self.chunk_size)
+            if compressor is None:
+                return data, not data
+            return (compressor.compress(data), False) if data else (compressor.flush(), True)
+
+        loop = asyncio.get_event_loop()
+        started, sent = time.monotonic(), 0
+        try:
+            while True:
+                # reading and compressing stay off the event loop
+                chunk, last = await loop.run_in_executor(None, next_chunk)
+                if chunk:
+                    yield chunk
+                    sent += len(chunk)
+                if last:
+                    break
+                if self.rate:
+                    delay = sent / self.rate - (time.monotonic() - started)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+        finally:
+            self.close(file)
+
+
+database_export = DatabaseExport(app.config.DOWNLOAD_CONCURRENCY, app.config.DOWNLOAD_RATE,
+                                 app.config.DOWNLOAD_CHUNK_SIZE)
@@ -0,0 +1,285 @@
+import argparse
+import asyncio
+import datetime
+from collections import defaultdict
+from contextlib import ExitStack
+from typing import Dict, Tuple, List
+
+from sqlalchemy import insert, select, delete, desc, inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql import func
+
+import app.config
+from app.catalog import Catalog, load_catalog
+from app.models import *
+from app.shards import SHARDED_TABLES, Shards, create_shard_tables, shard_index, shards
+from app.snapshot import write_snapshot
+
+TagStats = Dict[uuid.UUID, Dict[uuid.UUID, Tuple[int, int]]]
+
+
+def backfill_progress(session: Session) -> int:
+    latest = aliased(Answer)
+    session.query(UserQuestionProgress).delete()
+    session.execute(
+        insert(UserQuestionProgress).from_select(
+            ['user', 'question', 'solved', 'attempts', 'last_attempt', 'last_answer'],
+            select(Answer.user, Answer.question, func.max(Answer.is_correct), func.count(Answer.id),
+                   func.max(Answer.timestamp),
+                   select(latest.id)
+                   .filter(latest.user == Answer.user, latest.question == Answer.question)
+                   .order_by(desc(latest.timestamp))
+                   .limit(1)
+                   .scalar_subquery())
+            .group_by(Answer.user, Answer.question)
+        )
+    )
+    session.commit()
+    return session.query(UserQuestionProgress).count()
+
+
+def mark_legacy_users(session: Session, before: datetime.datetime) -> int:
+    """Record the users that existed before signed tokens were deployed at ``before``, so their bare ids keep working.
+
+    Since then a ``users`` row only appears with the user's first answer, so a user with no answers at all, or with an
+    answer older than ``before``, was created by the old sign-up. Returns the number of users marked.
+    """
+    earlier = select(Answer.id).filter(Answer.user == User.id)
+    marked = select(User.id).filter(~earlier.exists() | earlier.filter(Answer.timestamp < before).exists(),
+                                     ~select(LegacyUser.id).filter(LegacyUser.id == User.id).exists())
+    count = session.execute(insert(LegacyUser).from_select(['id'], marked)).rowcount
+    session.commit()
+    return count
+
+
+def compute_tag_stats(session: Session) -> TagStats:
+    """Recompute every user's (exposures, failures) per tag from the raw answers."""
+    assertion_tags = defaultdict(list)
+    for assertion_id, tag_id in session.execute(select(assertion_tag_relation.c.assertion_id,
+                                                       assertion_tag_relation.c.tag_id)):
+        assertion_tags[assertion_id].append(tag_id)
+    question_tags = defaultdict(list)
+    for assertion_id, question_id in session.execute(select(Assertion.id, Assertion.question_id)):
+        question_tags[question_id].extend(assertion_tags[assertion_id])
+
+    # the representative answer of a question is None once it is solved, the latest answer before that
+    representatives = {}
+    for answer_id, user, question, is_correct in session.execute(
+            select(Answer.id, Answer.user, Answer.question, Answer.is_correct).order_by(Answer.timestamp)):
+        if representatives.get((user, question), False) is not None:
+            representatives[user, question] = None if is_correct else answer_id
+
+    failed_assertions = defaultdict(list)
+    for answer_id, assertion_id in session.execute(select(answer_assertion_relation.c.answer_id,
+                                                          answer_assertion_relation.c.assertion_id)):
+        failed_assertions[answer_id].append(assertion_id)
+
+    counts = defaultdict(lambda: defaultdict(lambda: [0, 0]))
+    for (user, question), answer_id in representatives.items():
+        for tag_id in question_tags[question]:
+            counts[user][tag_id][0] += 1
+        for assertion_id in failed_assertions.get(answer_id, ()):
+            for tag_id in assertion_tags[assertion_id]:
+                counts[user][tag_id][1] += 1
+
+    return {user: {tag_id: (e, f) for tag_id, (e, f) in tags.items() if e or f} for user, tags in counts.items()}
+
+
+def load_tag_stats(session: Session) -> TagStats:
+    stats = defaultdict(dict)
+    for stat in session.query(UserTagStat):
+        if stat.exposures or stat.failures:
+            stats[stat.user][stat.tag] = (stat.exposures, stat.failures)
+    return dict(stats)
+
+
+def check_tag_stats(session: Session, fix: bool = False) -> int:
+    expected = compute_tag_stats(session)
+    stored = load_tag_stats(session)
+    mismatched = [user for user in expected.keys() | stored.keys() if expected.get(user) != stored.get(user)]
+
+    if fix and mismatched:
+        session.query(UserTagStat).delete()
+        session.execute(insert(UserTagStat), [{'user': user, 'tag': tag_id, 'exposures': e, 'failures': f}
+                                              for user, tags in expected.items()
+                                              for tag_id, (e, f) in tags.items()])
+        session.commit()
+    return len(mismatched)
+
+
+def create_indexes(bind: Engine) -> List[str]:
+    inspector = inspect(bind)
+    tables = inspector.get_table_names()
+    existing = {(t, i['name']) for t in tables for i in inspector.get_indexes(t)}
+    created = []
+    # shards only hold the user tables
+    for table in (t for t in Base.metadata.sorted_tables if t.name in tables):
+        for index in table.indexes:
+            if (table.name, index.name) not in existing:
+                index.create(bind)
+                created.append(index.name)
+    return created
+
+
+def migrate_keys(bind: Engine, binary: bool, batch_size: int = 10000) -> int:
+    """Rewrite every UUID key in place between 32-character hex text and 16-byte blobs.
+
+    Only rows still in the old representation are touched, so an interrupted run can simply be repeated. The whole
+    conversion happens in one transaction.
+    """
+    if bind.dialect.name != 'sqlite':
+        raise ValueError(f'in-place key migration is only implemented for SQLite, not {bind.dialect.name}')
+    source, source_type = ('text', str) if binary else ('blob', bytes)
+
+    def convert(value):
+        if not isinstance(value, source_type):
+            return value
+        return bytes.fromhex(value) if binary else value.hex()
+
+    converted = 0
+    with bind.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            columns = [c.name for c in table.columns if isinstance(c.type, UUIDType)]
+            if not columns:
+                continue
+            selected = ', '.join(f'"{c}"' for c in columns)
+            pending = ' OR '.join(f'typeof("{c}") = \'{source}\'' for c in columns)
+            assignments = ', '.join(f'"{c}" = ?' for c in columns)
+            while True:
+                rows = connection.exec_driver_sql(
+                    f'SELECT rowid, {selected} FROM "{table.name}" WHERE {pending} LIMIT {batch_size}'
+                ).fetchall()
+                if not rows:
+                    break
+                connection.exec_driver_sql(f'UPDATE "{table.name}" SET {assignments} WHERE rowid = ?',
+                                           [tuple(convert(v) for v in values) + (rowid,) for rowid, *values in rows])
+                converted += len(rows)
+    return converted
+
+
+def build_snapshot(path: str) -> Tuple[Catalog, int]:
+    async def load():
+        try:
+            async with AsyncSessionLocal() as session:
+                return await load_catalog(session)
+        finally:
+            await async_engine.dispose()
+
+    catalog = asyncio.run(load())
+    return catalog, write_snapshot(catalog, path)
+
+
+def _user_column(table) -> str:
+    return 'id' if table in (User.__table__, LegacyUser.__table__) else 'user'
+
+
+def reshard(sources: List[Engine], targets: List[Engine], batch_size: int = 10000) -> Dict[str, int]:
+    """Copy the user-scoped tables from the ``sources`` databases into ``targets``, placing rows by user.
+
+    The sources are only read. Target tables are emptied first, so an interrupted run can be started again, and each
+    target is written in a single transaction.
+    """
+    if {str(e.url) for e in sources} & {str(e.url) for e in targets}:
+        raise ValueError('source and target databases overlap')
+    for target in targets:
+        create_shard_tables(target)
+
+    copied = {}
+    with ExitStack() as stack:
+        connections = [stack.enter_context(target.begin()) for target in targets]
+        for connection in connections:
+            for table in reversed(SHARDED_TABLES):
+                connection.execute(delete(table))
+        for table in SHARDED_TABLES:
+            if table is answer_assertion_relation:
+                # relation rows belong to the user of their answer
+                query = select(table, Answer.user).join(Answer, Answer.id == table.c.answer_id)
+            else:
+                query = select(table, table.c[_user_column(table)].label('shard_user'))
+            copied[table.name] = 0
+            for source in sources:
+                with source.connect() as connection:
+                    result = connection.execution_options(stream_results=True).execute(query)
+                    while True:
+                        rows = result.fetchmany(batch_size)
+                        if not rows:
+                            break
+                        placed = defaultdict(list)
+                        for row in rows:
+                            placed[shard_index(row[-1], len(targets)) if len(targets) > 1 else 0].append(
+                                {column.name: value for column, value in zip(table.columns, row)})
+                        for index, values in placed.items():
+                            connections[index].execute(insert(table), values)
+                        copied[table.name] += len(rows)
+    return copied
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Dinagon maintenance commands')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('backfill-progress', help='rebuild user_question_progress from answers')
+    check = commands.add_parser('check-tag-stats', help='recompute user_tag_stats from answers and compare')
+    check.add_argument('--fix', action='store_true', help='rewrite user_tag_stats when they disagree')
+    migrate = commands.add_parser('migrate-keys', help='convert stored UUID keys between text and binary')
+    migrate.add_argument('--to', choices=['binary', 'text'], required=True)
+    migrate.add_argument('--vacuum', action='store_true', help='reclaim the space freed by shorter keys')
+    commands.add_parser('create-indexes', help='create indexes missing from an existing database')
+    legacy = commands.add_parser('mark-legacy-users', help='keep accepting the bare user ids that served as tokens '
+                                                           'before signed tokens')
+    legacy.add_argument('--before', type=datetime.datetime.fromisoformat, required=True,
+                        help='local time the signed tokens were deployed, e.g. "2021-08-01 09:00"')
+    move = commands.add_parser('reshard', help='copy users and answers into a new number of shards; stop the server '
+                                              'first, as answers written meanwhile are not copied')
+    move.add_argument('--to', type=int, required=True, help='number of shards, 1 for the main database')
+    move.add_argument('--batch-size', type=int, default=10000)
+    snapshot = commands.add_parser('build-snapshot', help='compile the catalog into a file workers memory-map')
+    snapshot.add_argument('--output', default=app.config.CATALOG_SNAPSHOT or 'catalog.snapshot')
+    args = parser.parse_args()
+
+    create_database()
+    # user rows may be spread over shards; every command below runs once per shard (or once without shards)
+    sessions = shards.sync_sessions()
+    engines = [engine, *(e for e in shards.engines() if e is not engine)]
+    try:
+        if args.command == 'backfill-progress':
+            print(f'{sum(backfill_progress(session) for session in sessions)} progress rows written')
+        elif args.command == 'check-tag-stats':
+            mismatched = sum(check_tag_stats(session, args.fix) for session in sessions)
+            print(f'{mismatched} users with inconsistent tag stats{" (rewritten)" if args.fix and mismatched else ""}')
+            raise SystemExit(1 if mismatched and not args.fix else 0)
+        elif args.command == 'migrate-keys':
+            for session in sessions:
+                session.close()
+            for bind in engines:
+                print(f'{bind.url}: {migrate_keys(bind, args.to == "binary")} rows converted')
+                print(f'created indexes: {", ".join(create_indexes(bind)) or "none"}')
+                if args.vacuum:
+                    with bind.connect() as connection:
+                        connection.exec_driver_sql('VACUUM')
+            print(f'start the server with UUID_BINARY={int(args.to == "binary")}')
+        elif args.command == 'mark-legacy-users':
+            print(f'{sum(mark_legacy_users(session, args.before) for session in sessions)} legacy users marked')
+        elif args.command == 'create-indexes':
+            for bind in engines:
+                print(f'{bind.url}: created indexes: {", ".join(create_indexes(bind)) or "none"}')
+        elif args.command == 'reshard':
+            if args.to == max(len(shards), 1):
+                raise SystemExit(f'already using {args.to} shard(s)')
+            target = Shards(args.to)
+            copied = reshard(shards.engines(), target.engines(), args.batch_size)
+            print(', '.join(f'{table} {rows}' for table, rows in copied.items()) + ' rows copied')
+            print(f'start the server with ANSWER_SHARDS={args.to}; the previous databases were left as they were')
+            print(f'the dashboard rollups track each shard separately: run '
+                  f'`ANSWER_SHARDS={args.to} python -m app.rollups --rebuild` as well')
+        elif args.command == 'build-snapshot':
+            catalog, size = build_snapshot(args.output)
+            print(f'{args.output}: catalog version {catalog.version}, {len(catalog.questions)} questions, '
+                  f'{size} bytes')
+    finally:
+        for session in sessions:
+            session.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+# Everything here is updated from the event loop thread only: SQLAlchemy runs the asyncio drivers' cursor calls in
+# greenlets on that thread, and the middleware records a finished request between two awaits. Plain dicts are
+# therefore enough and no lock is taken on the request path.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34)
+WAIT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str) -> str:
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels.rstrip(",")}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels.rstrip(",")}}} {self.count}')
+        return '\n'.join(lines)
+
+
+class RequestStats:
+    __slots__ = ('statements', 'sql_seconds', 'rows', 'pool_wait')
+
+    def __init__(self):
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.rows = 0
+        self.pool_wait = 0.0
+
+
+class RouteMetrics:
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.statements = Histogram(STATEMENT_BUCKETS)
+        self.pool_wait = Histogram(WAIT_BUCKETS)
+        self.sql_seconds = 0.0
+        self.rows = 0
+        self.responses: Dict[int, int] = {}
+
+
+_current: ContextVar[Optional[RequestStats]] = ContextVar('request_stats', default=None)
+_routes: Dict[Tuple[str, str], RouteMetrics] = {}
+_collectors: List[Callable[[], str]] = []
+
+
+def register(collector: Callable[[], str]):
+    """Add a callable returning extra exposition text to every /metrics response."""
+    if collector not in _collectors:
+        _collectors.append(collector)
+
+
+class TimedAsyncQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool that charges the time spent waiting for a connection to the current request."""
+
+    def _do_get(self):
+        stats = _current.get()
+        if stats is None:
+            return super()._do_get()
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            stats.pool_wait += time.perf_counter() - start
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        context._metrics_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.sql_seconds += time.perf_counter() - getattr(context, '_metrics_start', time.perf_counter())
+
+
+def _do_orm_execute(orm_execute_state):
+    # rows are counted on the buffered result the AsyncSession would build anyway
+    if _current.get() is None or not orm_execute_state.is_select:
+        return None
+    frozen = orm_execute_state.invoke_statement().freeze()
+    _current.get().rows += len(frozen.data)
+    return frozen()
+
+
+def instrument(*engines: Engine):
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    if not event.contains(Session, 'do_orm_execute', _do_orm_execute):
+        event.listen(Session, 'do_orm_execute', _do_orm_execute)
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency and database usage per route template."""
+
+    def __init__(self, app):
+        self.app = app
+        self._templates = None
+
+    def _template(self, scope) -> str:
+        if self._templates is None:
+            self._templates = {getattr(route, 'endpoint', None): route.path for route in scope['app'].routes}
+        return self._templates.get(scope.get('endpoint'), 'unmatched')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats()
+        token = _current.set(stats)
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            _current.reset(token)
+            key = (scope['method'], self._template(scope))
+            metrics = _routes.get(key)
+            if metrics is None:
+                metrics = _routes[key] = RouteMetrics()
+            metrics.latency.observe(elapsed)
+            metrics.statements.observe(stats.statements)
+            metrics.pool_wait.observe(stats.pool_wait)
+            metrics.sql_seconds += stats.sql_seconds
+            metrics.rows += stats.rows
+            metrics.responses[status_code] = metrics.responses.get(status_code, 0) + 1
+
+
+def render() -> str:
+    sections = {
+        'dinagon_request_duration_seconds': ('histogram', 'Request latency.', lambda m: m.latency),
+        'dinagon_request_sql_statements': ('histogram', 'SQL statements per request.', lambda m: m.statements),
+        'dinagon_request_pool_wait_seconds': ('histogram', 'Time spent waiting for a pooled connection.',
+                                              lambda m: m.pool_wait),
+    }
+    routes = sorted(_routes.items())
+    lines = []
+    for name, (kind, help_, metric) in sections.items():
+        lines.append(f'# HELP {name} {help_}')
+        lines.append(f'# TYPE {name} {kind}')
+        for (method, route), metrics in routes:
+            lines.append(metric(metrics).render(name, f'method="{method}",route="{route}",'))
+
+    lines.append('# HELP dinagon_request_sql_seconds_total Time spent executing SQL.')
+    lines.append('# TYPE dinagon_request_sql_seconds_total counter')
+    lines.extend(f'dinagon_request_sql_seconds_total{{method="{method}",route="{route}"}} {m.sql_seconds}'
+                 for (method, route), m in routes)
+    lines.append('# HELP dinagon_request_sql_rows_total Rows returned by SELECT statements.')
+    lines.append('# TYPE dinagon_request_sql_rows_total counter')
+    lines.extend(f'dinagon_request_sql_rows_total{{method="{method}",route="{route}"}} {m.rows}'
+                 for (method, route), m in routes)
+    lines.append('# HELP dinagon_responses_total Responses by status code.')
+    lines.append('# TYPE dinagon_responses_total counter')
+    lines.extend(f'dinagon_responses_total{{method="{method}",route="{route}",status="{code}"}} {count}'
+                 for (method, route), m in routes for code, count in sorted(m.responses.items()))
+    return '\n'.join(lines) + '\n' + ''.join(collector() for collector in _collectors)
@@ -1,26 +1,47 @@
 import datetime
 import uuid
-from typing import Generator
+from typing import AsyncGenerator
 
-from sqlalchemy import Column, Boolean, ForeignKey, DateTime, Table, Text, Integer
+from sqlalchemy import Column, Boolean, ForeignKey, DateTime, Table, Text, String, Integer, Float, Index
 from sqlalchemy import MetaData
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from sqlalchemy.orm.session import Session
 from sqlalchemy_utils import UUIDType
 import app.config
+from app.profiles import (SQLITE, sync_engine_options, async_engine_options, apply_sqlite_pragmas,
+                          sqlite_pragmas)
 
 meta = MetaData()
 
+UUIDKey = UUIDType(binary=app.config.UUID_BINARY)
+
 engine = create_engine(
     app.config.DATABASE_URI,
     encoding='utf-8',
-    pool_recycle=60,
-    connect_args={"check_same_thread": False}
+    **sync_engine_options(app.config.DATABASE_PROFILE)
 )
 
+async_engine = create_async_engine(
+    app.config.ASYNC_DATABASE_URI,
+    **async_engine_options(app.config.DATABASE_PROFILE)
+)
+# sessions that write; the same engine as async_engine except on SQLite, where writes share one connection
+async_write_engine = async_engine if app.config.DATABASE_PROFILE != SQLITE else create_async_engine(
+    app.config.ASYNC_DATABASE_URI,
+    **async_engine_options(app.config.DATABASE_PROFILE, writer=True)
+)
+if app.config.DATABASE_PROFILE == SQLITE:
+    for e in {engine, async_engine.sync_engine, async_write_engine.sync_engine}:
+        apply_sqlite_pragmas(e, sqlite_pragmas())
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+AsyncSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=async_engine, class_=AsyncSession,
+                                 expire_on_commit=False)
+AsyncWriteSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=async_write_engine, class_=AsyncSession,
+                                      expire_on_commit=False, info={'writer': True})
 
 Base = declarative_base()
 
@@ -29,81 +50,172 @@ def clear_database():
     Base.metadata.drop_all(engine)
 
 
+# columns added to tables that databases written by earlier versions already have; create_all skips those tables
+ADDED_COLUMNS = (
+    ('users', 'progress_version', 'INTEGER NOT NULL DEFAULT 0'),
+    ('questions', 'listed', 'BOOLEAN NOT NULL DEFAULT 1'),
+)
+
+
+def upgrade_schema(bind) -> None:
+    inspector = inspect(bind)
+    with bind.begin() as connection:
+        for table, column, definition in ADDED_COLUMNS:
+            if inspector.has_table(table) and column not in {c['name'] for c in inspector.get_columns(table)}:
+                connection.exec_driver_sql(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
 def create_database():
     Base.metadata.create_all(bind=engine)
+    from app.shards import shards  # app.shards is built on the tables below
+    shards.create_all()
+    for bind in {engine, *shards.engines()}:
+        upgrade_schema(bind)
 
 
-def get_db() -> Generator[Session, None, None]:
-    db = SessionLocal()
-    try:
+async def get_db() -> AsyncGenerator[AsyncSession, None]:
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
+
+
+async def get_write_db() -> AsyncGenerator[AsyncSession, None]:
+    async with AsyncWriteSessionLocal() as db:
+        yield db
+
+
+async def dispose_engines():
+    await async_engine.dispose()
+    if async_write_engine is not async_engine:
+        await async_write_engine.dispose()
 
 
 assertion_tag_relation = Table('assertion_tag_relation', Base.metadata,
-                               Column('assertion_id', UUIDType(binary=False), ForeignKey('assertions.id'),
-                                      primary_key=True),
-                               Column('tag_id', UUIDType(binary=False), ForeignKey('tags.id'), primary_key=True)
+                               Column('assertion_id', UUIDKey, ForeignKey('assertions.id'), primary_key=True),
+                               Column('tag_id', UUIDKey, ForeignKey('tags.id'), primary_key=True),
+                               Index('ix_assertion_tag_relation_tag_id', 'tag_id')
                                )
 question_tag_relation = Table('question_tag_relation', Base.metadata,
-                              Column('question_id', UUIDType(binary=False), ForeignKey('questions.id'),
-                                     primary_key=True),
-                              Column('tag_id', UUIDType(binary=False), ForeignKey('tags.id'), primary_key=True)
+                              Column('question_id', UUIDKey, ForeignKey('questions.id'), primary_key=True),
+                              Column('tag_id', UUIDKey, ForeignKey('tags.id'), primary_key=True),
+                              Index('ix_question_tag_relation_tag_id', 'tag_id')
                               )
 answer_assertion_relation = Table('answer_assertion_relation', Base.metadata,
-                                  Column('answer_id', UUIDType(binary=False), ForeignKey('answers.id'),
-                                         primary_key=True),
-                                  Column('assertion_id', UUIDType(binary=False), ForeignKey('assertions.id'),
-                                         primary_key=True)
+                                  Column('answer_id', UUIDKey, ForeignKey('answers.id'), primary_key=True),
+                                  Column('assertion_id', UUIDKey, ForeignKey('assertions.id'), primary_key=True),
+                                  Index('ix_answer_assertion_relation_assertion_id', 'assertion_id')
                                   )
 
 
 class User(Base):
     __tablename__ = 'users'
 
-    id = Column(UUIDType(binary=False), primary_key=True, default=uuid.uuid4)
+    id = Column(UUIDKey, primary_key=True, default=uuid.uuid4)
+    # bumped whenever the user's answers change what the question endpoints return; part of their ETags
+    progress_version = Column(Integer, nullable=False, default=0, server_default='0')
 
     def __repr__(self):
         return f'Users(id={self.id!r})'
 
 
+class LegacyUser(Base):
+    """Users from before signed tokens, whose bare id is still accepted as a token (app/auth.py).
+
+    Filled once by ``python -m app.maintenance mark-legacy-users``; rows created since then never appear here.
+    """
+    __tablename__ = 'legacy_users'
+
+    id = Column(UUIDKey, ForeignKey('users.id'), primary_key=True)
+
+
 class Answer(Base):
     __tablename__ = 'answers'
 
-    id = Column(UUIDType(binary=False), primary_key=True, default=uuid.uuid4)
+    id = Column(UUIDKey, primary_key=True, default=uuid.uuid4)
 
-    user = Column(UUIDType(binary=False), ForeignKey('users.id'))
-    question = Column(UUIDType(binary=False), ForeignKey('questions.id'))
+    user = Column(UUIDKey, ForeignKey('users.id'))
+    question = Column(UUIDKey, ForeignKey('questions.id'))
 
     is_correct = Column(Boolean, nullable=False)
 
-    failed_assertions = relationship("Assertion", secondary=answer_assertion_relation)
+    failed_assertions = relationship("Assertion", secondary=answer_assertion_relation, lazy='raise_on_sql')
 
     use_assertions = Column(Boolean, nullable=False)
 
     timestamp = Column(DateTime, default=datetime.datetime.now)
 
+    __table_args__ = (
+        Index('ix_answers_user_question_correct', 'user', 'question', 'is_correct'),
+        Index('ix_answers_question', 'question'),
+        Index('ix_answers_timestamp', 'timestamp'),
+    )
+
     def __repr__(self):
         return (f'Answers(id={self.id!r}, user={self.user!r}, question={self.question!r}, '
                 f'is_correct={self.is_correct}, timestamp={self.timestamp!r})')
 
 
+class UserQuestionProgress(Base):
+    __tablename__ = 'user_question_progress'
+
+    user = Column(UUIDKey, ForeignKey('users.id'), primary_key=True)
+    question = Column(UUIDKey, ForeignKey('questions.id'), primary_key=True)
+
+    solved = Column(Boolean, nullable=False, default=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    last_attempt = Column(DateTime)
+    last_answer = Column(UUIDKey, ForeignKey('answers.id'))
+
+    def __repr__(self):
+        return (f'UserQuestionProgress(user={self.user!r}, question={self.question!r}, solved={self.solved}, '
+                f'attempts={self.attempts}, last_attempt={self.last_attempt!r})')
+
+
+class UserTagStat(Base):
+    __tablename__ = 'user_tag_stats'
+
+    user = Column(UUIDKey, ForeignKey('users.id'), primary_key=True)
+    tag = Column(UUIDKey, ForeignKey('tags.id'), primary_key=True)
+
+    exposures = Column(Integer, nullable=False, default=0)
+    failures = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return (f'UserTagStat(user={self.user!r}, tag={self.tag!r}, exposures={self.exposures}, '
+                f'failures={self.failures})')
+
+
+class TagRecommendation(Base):
+    __tablename__ = 'tag_recommendations'
+
+    user = Column(UUIDKey, ForeignKey('users.id'), primary_key=True)
+    tag = Column(UUIDKey, ForeignKey('tags.id'), primary_key=True)
+
+    rank = Column(Integer, nullable=False)
+    score = Column(Float, nullable=False)
+    computed_at = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return (f'TagRecommendation(user={self.user!r}, tag={self.tag!r}, rank={self.rank}, score={self.score}, '
+                f'computed_at={self.computed_at!r})')
+
+
 class Question(Base):
     __tablename__ = 'questions'
 
-    id = Column(UUIDType(binary=False), primary_key=True, default=uuid.uuid4)
+    id = Column(UUIDKey, primary_key=True, default=uuid.uuid4)
 
     title = Column(Text, nullable=False)
     description = Column(Text, nullable=False)
     default_code = Column(Text, nullable=False)
 
-    test_cases = relationship('TestCase', uselist=True, lazy='dynamic')
-    assertions = relationship('Assertion', uselist=True, lazy='dynamic')
+    test_cases = relationship('TestCase', uselist=True, lazy='raise_on_sql')
+    assertions = relationship('Assertion', uselist=True, lazy='raise_on_sql')
 
     level = Column(Integer, nullable=False)
+    # cleared when the question's fixture file is deleted; unlisted questions stay only for the answers to them
+    listed = Column(Boolean, nullable=False, default=True, server_default='1')
 
-    tags = relationship('Tag', secondary=question_tag_relation)
+    tags = relationship('Tag', secondary=question_tag_relation, lazy='raise_on_sql')
 
     def __repr__(self):
         return (f'Question(id={self.id!r}, title={self.title!r}, description={self.description!r}, '
@@ -113,12 +225,12 @@ class Question(Base):
 class TestCase(Base):
     __tablename__ = 'test_cases'
 
-    id = Column(UUIDType(binary=False), primary_key=True, default=uuid.uuid4)
+    id = Column(UUIDKey, primary_key=True, default=uuid.uuid4)
 
     input = Column(Text, nullable=False)
     expected = Column(Text, nullable=False)
 
-    question_id = Column(UUIDType(binary=False), ForeignKey('questions.id'))
+    question_id = Column(UUIDKey, ForeignKey('questions.id'), index=True)
 
     def __repr__(self):
         return f'TestCase(id={self.id!r}, input={self.input!r}, expected={self.expected!r})'
@@ -127,15 +239,15 @@ class TestCase(Base):
 class Assertion(Base):
     __tablename__ = 'assertions'
 
-    id = Column(UUIDType(binary=False), primary_key=True, default=uuid.uuid4)
+    id = Column(UUIDKey, primary_key=True, default=uuid.uuid4)
 
     assertion = Column(Text, nullable=False)
     message = Column(Text, nullable=False)
 
-    tags = relationship("Tag", secondary=assertion_tag_relation)
+    tags = relationship("Tag", secondary=assertion_tag_relation, lazy='raise_on_sql')
 
-    answer_id = Column(UUIDType(binary=False), ForeignKey('answers.id'))
-    question_id = Column(UUIDType(binary=False), ForeignKey('questions.id'))
+    answer_id = Column(UUIDKey, ForeignKey('answers.id'))
+    question_id = Column(UUIDKey, ForeignKey('questions.id'), index=True)
 
     def __repr__(self):
         return f'Assertion(id={self.id!r}, assertion={self.assertion!r}, message={self.message!r})'
@@ -144,7 +256,7 @@ class Assertion(Base):
 class Tag(Base):
     __tablename__ = 'tags'
 
-    id = Column(UUIDType(binary=False), primary_key=True, default=uuid.uuid4)
+    id = Column(UUIDKey, primary_key=True, default=uuid.uuid4)
 
     name = Column(Text, nullable=False)
     tutorial_link = Column(Text, nullable=False)
@@ -153,5 +265,80 @@ class Tag(Base):
         return f'Tag(id={self.id!r}, name={self.name!r}, tutorial_link={self.tutorial_link!r})'
 
 
+class CatalogVersion(Base):
+    __tablename__ = 'catalog_version'
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'CatalogVersion(version={self.version!r})'
+
+
+class FixtureFile(Base):
+    __tablename__ = 'fixture_files'
+
+    path = Column(String(255), primary_key=True)
+    digest = Column(Text, nullable=False)
+    question_id = Column(UUIDKey, nullable=False)
+
+    def __repr__(self):
+        return f'FixtureFile(path={self.path!r}, digest={self.digest!r})'
+
+
+# Dashboard aggregates per hour, refreshed from the answers by app/rollups.py. They live in the main database next to
+# the catalog, whatever the number of shards.
+
+class QuestionRollup(Base):
+    __tablename__ = 'question_rollups'
+
+    bucket = Column(DateTime, primary_key=True)
+    question = Column(UUIDKey, ForeignKey('questions.id'), primary_key=True)
+
+    attempts = Column(Integer, nullable=False, default=0)
+    correct = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return (f'QuestionRollup(bucket={self.bucket!r}, question={self.question!r}, attempts={self.attempts}, '
+                f'correct={self.correct})')
+
+
+class AssertionRollup(Base):
+    __tablename__ = 'assertion_rollups'
+
+    bucket = Column(DateTime, primary_key=True)
+    assertion = Column(UUIDKey, ForeignKey('assertions.id'), primary_key=True)
+
+    failures = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'AssertionRollup(bucket={self.bucket!r}, assertion={self.assertion!r}, failures={self.failures})'
+
+
+class TagRollup(Base):
+    __tablename__ = 'tag_rollups'
+
+    bucket = Column(DateTime, primary_key=True)
+    tag = Column(UUIDKey, ForeignKey('tags.id'), primary_key=True)
+
+    exposures = Column(Integer, nullable=False, default=0)
+    failures = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return (f'TagRollup(bucket={self.bucket!r}, tag={self.tag!r}, exposures={self.exposures}, '
+                f'failures={self.failures})')
+
+
+class RollupMark(Base):
+    __tablename__ = 'rollup_marks'
+
+    # answers of a shard up to and including high_water are in the rollups
+    shard = Column(Integer, primary_key=True)
+    high_water = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'RollupMark(shard={self.shard}, high_water={self.high_water!r})'
+
+
 if __name__ == '__main__':
     create_database()
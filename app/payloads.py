@@ -0,0 +1,103 @@
+import json
+import uuid
+from typing import Dict, Iterable, Optional, Sequence, Set, Tuple
+
+from fastapi.encoders import jsonable_encoder
+
+from app.catalog import Catalog, QuestionEntry
+from app.scheme import Question, QuestionListItem, Tag, TestCase, Assertion
+
+
+def question_model(q: QuestionEntry, answered_correctly: bool) -> Question:
+    return Question(questionID=q.id, title=q.title,
+                    description=q.description,
+                    testCases=[
+                        TestCase(input=t.input, expected=t.expected)
+                        for t in q.test_cases
+                    ],
+                    assertions=[
+                        Assertion(id=a.id,
+                                  assertion=a.assertion,
+                                  message=a.message,
+                                  tags=[Tag(id=tag.id, name=tag.name, tutorial_link=tag.tutorial_link) for tag in
+                                        a.tags])
+                        for a in q.assertions
+                    ],
+                    answeredCorrectly=answered_correctly,
+                    tags=[Tag(id=tag.id, name=tag.name, tutorial_link=tag.tutorial_link) for tag in q.tags],
+                    level=q.level,
+                    defaultCode=q.default_code)
+
+
+def list_item_model(q: QuestionEntry, answered_correctly: bool) -> QuestionListItem:
+    return QuestionListItem(questionID=q.id, title=q.title,
+                            answeredCorrectly=answered_correctly, level=q.level,
+                            tags=[Tag(id=tag.id, name=tag.name, tutorial_link=tag.tutorial_link) for tag in q.tags])
+
+
+def _dumps(model) -> bytes:
+    # the same encoding JSONResponse applies to a response_model, so cached bytes equal what FastAPI would send
+    return json.dumps(jsonable_encoder(model), ensure_ascii=False, allow_nan=False, indent=None,
+                      separators=(',', ':')).encode('utf-8')
+
+
+class QuestionPayloads:
+    """Encoded responses for one catalog snapshot.
+
+    Every question is encoded once per value of ``answeredCorrectly``, on first use, so a request only picks the
+    variants matching the user's progress and joins them.
+    """
+
+    def __init__(self, catalog: Catalog):
+        self.catalog = catalog
+        self._details: Dict[uuid.UUID, Tuple[bytes, bytes]] = {}
+        self._items: Dict[uuid.UUID, Tuple[bytes, bytes]] = {}
+
+    def question(self, question_id: uuid.UUID, answered_correctly: bool) -> bytes:
+        variants = self._details.get(question_id)
+        if variants is None:
+            q = self.catalog.questions[question_id]
+            variants = self._details[question_id] = (_dumps(question_model(q, False)),
+                                                      _dumps(question_model(q, True)))
+        return variants[answered_correctly]
+
+    def _list_items(self, solved: Set[uuid.UUID], question_ids: Optional[Sequence[uuid.UUID]]) -> Iterable[bytes]:
+        """List items of ``question_ids``, every question in the order of the catalog index by default.
+
+        Items are encoded on first use like the details, so a filtered page of a mapped catalog (app/snapshot.py)
+        decodes only the questions on it.
+        """
+        items = self._items
+        ids = self.catalog.index.ids if question_ids is None else question_ids
+        if len(items) < len(self.catalog.questions):
+            for question_id in ids:
+                if question_id not in items:
+                    q = self.catalog.questions[question_id]
+                    items[question_id] = (_dumps(list_item_model(q, False)), _dumps(list_item_model(q, True)))
+        return (items[question_id][question_id in solved] for question_id in ids)
+
+    def question_list(self, token: str, solved: Set[uuid.UUID], question_ids: Optional[Sequence[uuid.UUID]] = None,
+                      next_cursor: Optional[str] = None) -> bytes:
+        items = self._list_items(solved, question_ids)
+        # tokens are JWTs or UUIDs and cursors are made by QuestionIndex.encode_cursor, none of which needs escaping
+        cursor = b'null' if next_cursor is None else b'"' + next_cursor.encode('ascii') + b'"'
+        return b''.join((b'{"token":"', token.encode('ascii'), b'","questions":[', b','.join(items),
+                         b'],"nextCursor":', cursor, b'}'))
+
+    def search_results(self, total: int, solved: Set[uuid.UUID], question_ids: Sequence[uuid.UUID]) -> bytes:
+        return b''.join((b'{"total":', str(total).encode('ascii'), b',"questions":[',
+                         b','.join(self._list_items(solved, question_ids)), b']}'))
+
+
+class PayloadCache:
+    def __init__(self):
+        self._payloads: Optional[QuestionPayloads] = None
+
+    def get(self, catalog: Catalog) -> QuestionPayloads:
+        payloads = self._payloads
+        if payloads is None or payloads.catalog is not catalog:
+            payloads = self._payloads = QuestionPayloads(catalog)
+        return payloads
+
+
+payload_cache = PayloadCache()
@@ -0,0 +1,58 @@
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import app.config
+from app.metrics import TimedAsyncQueuePool
+
+SQLITE = 'sqlite'
+MYSQL = 'mysql'
+PROFILES = (SQLITE, MYSQL)
+
+
+def sqlite_pragmas() -> dict:
+    # WAL lets readers run alongside the writer, and NORMAL only syncs at checkpoints, which WAL keeps safe
+    # against corruption; a power loss can at most drop the last commits.
+    return {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': app.config.SQLITE_MMAP_SIZE,
+        'busy_timeout': app.config.SQLITE_BUSY_TIMEOUT,
+        'temp_store': 'MEMORY',
+    }
+
+
+def apply_sqlite_pragmas(engine: Engine, pragmas: dict):
+    """Run ``PRAGMA`` statements on every new connection of ``engine`` (the sync engine of an async one)."""
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+        cursor.close()
+
+
+def sync_engine_options(profile: str) -> dict:
+    if profile == SQLITE:
+        return {'connect_args': {'check_same_thread': False}}
+    # sized like the request pools: the export, the rollup and cohort jobs and the maintenance commands all run on this
+    # engine; a pool opens its connections on demand, so a worker that never uses it holds none
+    return {'pool_size': app.config.DATABASE_POOL_SIZE, 'max_overflow': app.config.DATABASE_MAX_OVERFLOW,
+            'pool_pre_ping': True, 'pool_recycle': app.config.MYSQL_POOL_RECYCLE}
+
+
+def async_engine_options(profile: str, writer: bool = False) -> dict:
+    """Engine arguments for the request engines.
+
+    SQLite takes one writer at a time whatever the pool holds, so writes get their own engine with a single
+    connection: concurrent writers queue for it in the pool instead of spinning in ``busy_timeout`` or failing with
+    "database is locked", while readers keep a full pool next to it.
+    """
+    options = {'poolclass': TimedAsyncQueuePool, 'pool_timeout': app.config.DATABASE_POOL_TIMEOUT}
+    if profile == SQLITE:
+        if writer:
+            return {**options, 'pool_size': 1, 'max_overflow': 0}
+        return {**options, 'pool_size': app.config.DATABASE_POOL_SIZE, 'max_overflow': 0}
+    # MySQL closes idle connections after wait_timeout; pre-ping replaces dead ones before a request sees them
+    return {**options, 'pool_size': app.config.DATABASE_POOL_SIZE, 'max_overflow': app.config.DATABASE_MAX_OVERFLOW,
+            'pool_pre_ping': True, 'pool_recycle': app.config.MYSQL_POOL_RECYCLE}
@@ -0,0 +1,295 @@
+import asyncio
+import datetime
+import hmac
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextvars import ContextVar
+from typing import List, Optional
+
+from sqlalchemy import event
+from starlette.routing import Match
+
+import app.config
+
+# trace names become file names, so only names of this form are ever read back
+TRACE_NAME = re.compile(r'^[0-9T]+-[A-Z]+-[\w-]*-[0-9a-f]{8}$')
+MAX_STATEMENTS = 1000
+
+_trace: ContextVar[Optional['Trace']] = ContextVar('profile_trace', default=None)
+
+
+def _label(code) -> str:
+    path = code.co_filename.replace('\\', '/').split('/')
+    return f'{code.co_name} ({"/".join(path[-2:])}:{code.co_firstlineno})'
+
+
+def _sql_label(statement: str) -> str:
+    # ';' separates the frames of a collapsed stack
+    return 'SQL ' + ' '.join(statement.split())[:200].replace(';', ',')
+
+
+class Trace:
+    """Wall-clock stack samples and SQL statements of one request.
+
+    A sample is the stack of the request's task at that moment, whether it runs or awaits: the frames on the event
+    loop thread while it runs, else the chain of coroutines it is suspended in. Time spent waiting for the database
+    thus shows up under the await that issued the query, with the statement as the leaf.
+    """
+
+    def __init__(self, method: str, route: str, root):
+        self.method = method
+        self.route = route
+        self.root = root
+        self.task = asyncio.current_task()
+        self.thread = threading.get_ident()
+        self.start = time.perf_counter()
+        self.created = datetime.datetime.now()
+        self.seconds = 0.0
+        self.status = 0
+        self.samples = Counter()
+        self.statements: List[dict] = []
+        self.statement: Optional[str] = None  # being executed, read by the sampler thread
+        self.name = f'{self.created:%Y%m%dT%H%M%S}-{method}-{re.sub(r"[^a-zA-Z0-9]+", "-", route).strip("-")}-' \
+                    f'{uuid.uuid4().hex[:8]}'
+
+    def _frames(self, top) -> list:
+        frames, frame = [], top
+        while frame is not None:
+            frames.append(frame)
+            if frame is self.root:
+                return frames[::-1]
+            frame = frame.f_back
+        # not running: follow the coroutines the task awaits, from the middleware down
+        frames, awaiting = [], self.task.get_coro()
+        while awaiting is not None:
+            frame = getattr(awaiting, 'cr_frame', None) or getattr(awaiting, 'gi_frame', None)
+            if frame is None:
+                break
+            if frames or frame is self.root:
+                frames.append(frame)
+            awaiting = getattr(awaiting, 'cr_await', None) or getattr(awaiting, 'gi_yieldfrom', None)
+        return frames
+
+    def sample(self, top):
+        stack = [_label(f.f_code) for f in self._frames(top)]
+        statement = self.statement
+        if statement is not None:
+            stack.append(_sql_label(statement))
+        if stack:
+            self.samples[';'.join(stack)] += 1
+
+    def folded(self) -> str:
+        """The samples in the collapsed-stack format read by flamegraph.pl, speedscope and similar tools."""
+        return ''.join(f'{stack} {count}\n' for stack, count in self.samples.most_common())
+
+    def to_json(self) -> dict:
+        return {'method': self.method, 'route': self.route, 'created': self.created.isoformat(timespec='seconds'),
+                'status': self.status, 'seconds': round(self.seconds, 6), 'samples': sum(self.samples.values()),
+                'statements': self.statements, 'folded': self.folded()}
+
+
+class Sampler(threading.Thread):
+    """Samples the traces in progress every ``interval`` seconds and sleeps on a condition while there are none."""
+
+    def __init__(self, interval: float):
+        super().__init__(name='profile-sampler', daemon=True)
+        self.interval = interval
+        self.traces: List[Trace] = []
+        self._condition = threading.Condition()
+
+    def add(self, trace: Trace):
+        with self._condition:
+            self.traces.append(trace)
+            self._condition.notify()
+
+    def remove(self, trace: Trace):
+        # under the lock, so a trace is not sampled any more once this returns
+        with self._condition:
+            self.traces.remove(trace)
+
+    def run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self.traces)
+            time.sleep(self.interval)
+            with self._condition:
+                frames = sys._current_frames()
+                for trace in self.traces:
+                    trace.sample(frames.get(trace.thread))
+                del frames
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    trace = _trace.get()
+    if trace is not None:
+        trace.statement = statement
+        context._profile_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    trace = _trace.get()
+    if trace is not None:
+        trace.statement = None
+        if len(trace.statements) < MAX_STATEMENTS:
+            start = getattr(context, '_profile_start', time.perf_counter())
+            trace.statements.append({'statement': statement, 'at': round(start - trace.start, 6),
+                                     'seconds': round(time.perf_counter() - start, 6)})
+
+
+class Rule:
+    """Trace one in ``every`` requests to ``route``, ``count`` times."""
+
+    def __init__(self, method: str, route, every: int, count: int):
+        self.method = method
+        self.route = route
+        self.every = every
+        self.count = count
+        self.seen = 0
+
+    def to_json(self) -> dict:
+        return {'method': self.method, 'route': self.route.path, 'every': self.every, 'remaining': self.count}
+
+
+class Profiler:
+    """Opt-in request profiling, armed per route or asked for per request, with traces written to ``directory``.
+
+    Nothing is hooked in before the first trace: the SQL listeners are attached then, and the sampler thread is
+    started then and only wakes while a trace is in progress. Rules live in the worker process that received them.
+    """
+
+    def __init__(self, directory: str, keep: int, interval: float):
+        self.directory = directory
+        self.keep = keep
+        self.interval = interval
+        self.rules: List[Rule] = []
+        self._engines = []
+        self._sampler: Optional[Sampler] = None
+
+    def instrument(self, *engines):
+        self._engines.extend(engines)
+
+    def arm(self, routes, method: str, path: str, every: int, count: int) -> Rule:
+        for route in routes:
+            if getattr(route, 'path', None) == path and method in (getattr(route, 'methods', None) or ()):
+                rule = Rule(method, route, every, count)
+                self.rules = [r for r in self.rules if r.route is not route or r.method != method] + [rule]
+                return rule
+        raise ValueError(f'no route {method} {path}')
+
+    def disarm(self):
+        self.rules = []
+
+    def match(self, scope) -> Optional[str]:
+        """The route template of a request that an armed rule picks for tracing."""
+        for rule in self.rules:
+            if rule.method != scope['method'] or rule.route.matches(scope)[0] != Match.FULL:
+                continue
+            rule.seen += 1
+            if (rule.seen - 1) % rule.every:
+                return None
+            rule.count -= 1
+            if rule.count <= 0:
+                self.rules = [r for r in self.rules if r is not rule]
+            return rule.route.path
+        return None
+
+    def start(self, method: str, route: str, root) -> Trace:
+        """Trace the rest of the current task; ``root`` is the frame samples start from."""
+        if self._sampler is None:
+            for engine in self._engines:
+                event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+                event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+            self._sampler = Sampler(self.interval)
+            self._sampler.start()
+        trace = Trace(method, route, root)
+        _trace.set(trace)
+        self._sampler.add(trace)
+        return trace
+
+    def stop(self, trace: Trace):
+        trace.seconds = time.perf_counter() - trace.start
+        self._sampler.remove(trace)
+        _trace.set(None)
+
+    def save(self, trace: Trace):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, f'{trace.name}.json'), 'w', encoding='utf-8') as f:
+            json.dump(trace.to_json(), f, ensure_ascii=False)
+        # names start with the time, so the oldest traces sort first
+        names = sorted(n for n in os.listdir(self.directory) if n.endswith('.json'))
+        for old in names[:max(0, len(names) - self.keep)]:
+            os.remove(os.path.join(self.directory, old))
+
+    def traces(self) -> List[dict]:
+        """Summaries of the stored traces, newest first."""
+        if not os.path.isdir(self.directory):
+            return []
+        summaries = []
+        for file in sorted(os.listdir(self.directory), reverse=True):
+            name = file[:-len('.json')]
+            trace = file.endswith('.json') and self.load(name)
+            if trace:
+                summaries.append({'name': name, **{k: v for k, v in trace.items() if k not in ('statements', 'folded')},
+                                  'statements': len(trace['statements'])})
+        return summaries
+
+    def load(self, name: str) -> Optional[dict]:
+        if not TRACE_NAME.match(name):
+            return None
+        try:
+            with open(os.path.join(self.directory, f'{name}.json'), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+
+class ProfilingMiddleware:
+    """ASGI middleware tracing the requests a ``Profiler`` rule picks, or that carry ``X-Profile: <key>``.
+
+    The response of a traced request names its trace in ``X-Profile-Trace``; the trace is written once the response
+    has been sent.
+    """
+
+    def __init__(self, app, profiler: Profiler, key: str):
+        self.app = app
+        self.profiler = profiler
+        self.key = key.encode('latin-1')
+
+    def _requested(self, scope) -> bool:
+        for name, value in scope['headers']:
+            if name == b'x-profile':
+                return hmac.compare_digest(value, self.key)
+        return False
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'].startswith('/profile'):
+            return await self.app(scope, receive, send)
+        route = self.profiler.rules and self.profiler.match(scope)
+        if not route and self._requested(scope):
+            route = next((r.path for r in scope['app'].routes if r.matches(scope)[0] == Match.FULL), scope['path'])
+        if not route:
+            return await self.app(scope, receive, send)
+
+        trace = self.profiler.start(scope['method'], route, sys._getframe())
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                trace.status = message['status']
+                message = {**message, 'headers': [*message.get('headers', []),
+                                                  (b'x-profile-trace', trace.name.encode('ascii'))]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self.profiler.stop(trace)
+            await asyncio.get_event_loop().run_in_executor(None, self.profiler.save, trace)
+
+
+profiler = Profiler(app.config.PROFILE_DIR, app.config.PROFILE_KEEP, app.config.PROFILE_INTERVAL)
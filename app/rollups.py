@@ -0,0 +1,188 @@
+import argparse
+import datetime
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import select, and_, delete, insert, update
+from sqlalchemy.exc import IntegrityError
+
+import app.config
+from app.models import *
+from app.shards import shards
+
+ROLLUPS = (QuestionRollup, AssertionRollup, TagRollup)
+
+
+class RefreshConflict(Exception):
+    """Another refresh moved a high-water mark first; nothing of this one was written."""
+
+
+def hour(timestamp: datetime.datetime) -> datetime.datetime:
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def key_column(model) -> str:
+    """The column after ``bucket`` in the primary key of a rollup table."""
+    return model.__table__.primary_key.columns.values()[1].name
+
+
+def count_columns(model) -> List[str]:
+    return [c.name for c in model.__table__.columns if not c.primary_key]
+
+
+class Totals:
+    """Counter deltas per rollup table, keyed by (bucket, question / assertion / tag)."""
+
+    def __init__(self, session: Session):
+        self.question_tags, self.assertion_tags = defaultdict(list), defaultdict(list)
+        for assertion_id, question_id, tag_id in session.execute(
+                select(Assertion.id, Assertion.question_id, assertion_tag_relation.c.tag_id)
+                .join(assertion_tag_relation, assertion_tag_relation.c.assertion_id == Assertion.id)):
+            self.question_tags[question_id].append(tag_id)
+            self.assertion_tags[assertion_id].append(tag_id)
+        self.counts: Dict[type, Dict[Tuple[datetime.datetime, uuid.UUID], Counter]] = {
+            model: defaultdict(Counter) for model in ROLLUPS}
+
+    def add(self, bind, lower: Optional[datetime.datetime], upper: datetime.datetime):
+        """Count the answers of one shard with lower < timestamp <= upper.
+
+        Every answer counts, unlike the per-user tag stats that follow one representative answer per question; tags are
+        those of the assertions at the time of the count.
+        """
+        window = and_(Answer.timestamp > lower, Answer.timestamp <= upper) if lower else Answer.timestamp <= upper
+        questions, assertions, tags = (self.counts[model] for model in ROLLUPS)
+        with bind.connect() as connection:
+            connection = connection.execution_options(stream_results=True)
+            for timestamp, question_id, is_correct in connection.execute(
+                    select(Answer.timestamp, Answer.question, Answer.is_correct).filter(window)):
+                bucket = hour(timestamp)
+                questions[bucket, question_id].update(attempts=1, correct=int(bool(is_correct)))
+                for tag_id in self.question_tags.get(question_id, ()):
+                    tags[bucket, tag_id]['exposures'] += 1
+            for timestamp, assertion_id in connection.execute(
+                    select(Answer.timestamp, answer_assertion_relation.c.assertion_id)
+                    .join(answer_assertion_relation, answer_assertion_relation.c.answer_id == Answer.id)
+                    .filter(window)):
+                bucket = hour(timestamp)
+                assertions[bucket, assertion_id]['failures'] += 1
+                for tag_id in self.assertion_tags.get(assertion_id, ()):
+                    tags[bucket, tag_id]['failures'] += 1
+
+    def __len__(self) -> int:
+        return sum(len(counts) for counts in self.counts.values())
+
+    def apply(self, session: Session):
+        """Add the deltas to the stored rows, without committing."""
+        for model in ROLLUPS:
+            key, counts = key_column(model), count_columns(model)
+            buckets = {bucket for bucket, _ in self.counts[model]}
+            if not buckets:
+                continue
+            rows = {(row.bucket, getattr(row, key)): row for row in session.execute(
+                select(model).filter(model.bucket.in_(buckets)).with_for_update()).scalars()}
+            for (bucket, key_id), deltas in self.counts[model].items():
+                row = rows.get((bucket, key_id))
+                if row is None:
+                    row = model(bucket=bucket, **{key: key_id}, **{c: 0 for c in counts})
+                    session.add(row)
+                for column, delta in deltas.items():
+                    setattr(row, column, getattr(row, column) + delta)
+
+
+def refresh(lag: float = app.config.ROLLUP_LAG, now: Optional[datetime.datetime] = None) \
+        -> Tuple[int, datetime.datetime]:
+    """Fold the answers written since the last refresh into the rollups and return (buckets touched, high-water mark).
+
+    Answers are timestamped before they commit, so the newest ``lag`` seconds are left for the next run; an answer
+    that takes longer than that to commit is missed. The deltas and the marks of every shard are written in one
+    transaction of the main database, so an interrupted refresh leaves nothing behind. Each mark only moves from the
+    value it was read with, and the first write takes the database's write lock; of two concurrent refreshes over the
+    same answers, the one that loses raises RefreshConflict and writes nothing.
+    """
+    upper = (now or datetime.datetime.now()) - datetime.timedelta(seconds=lag)
+    session = SessionLocal()
+    try:
+        marks = {m.shard: m for m in session.execute(select(RollupMark).with_for_update()).scalars()}
+        totals = Totals(session)
+        for index, bind in enumerate(shards.engines()):
+            mark = marks.get(index)
+            if mark is not None and mark.high_water >= upper:
+                continue
+            totals.add(bind, mark and mark.high_water, upper)
+            # SELECT ... FOR UPDATE does not lock on SQLite, so the marks are moved by compare-and-set
+            try:
+                if mark is None:
+                    session.execute(insert(RollupMark).values(shard=index, high_water=upper))
+                elif not session.execute(update(RollupMark).where(RollupMark.shard == index,
+                                                                  RollupMark.high_water == mark.high_water)
+                                         .values(high_water=upper)).rowcount:
+                    raise RefreshConflict(f'the mark of shard {index} moved during the refresh')
+            except IntegrityError as e:
+                raise RefreshConflict(f'the mark of shard {index} was created during the refresh') from e
+        totals.apply(session)
+        session.commit()
+        return len(totals), upper
+    finally:
+        session.close()
+
+
+def rebuild(lag: float = app.config.ROLLUP_LAG) -> Tuple[int, datetime.datetime]:
+    """Empty the rollups and refresh them from every answer, e.g. after resharding or when the tags change."""
+    session = SessionLocal()
+    try:
+        for model in (*ROLLUPS, RollupMark):
+            session.execute(delete(model))
+        session.commit()
+    finally:
+        session.close()
+    return refresh(lag)
+
+
+def check() -> List[str]:
+    """Recount the answers up to each shard's mark and return the rollup tables that differ from the stored rows."""
+    session = SessionLocal()
+    try:
+        totals = Totals(session)
+        for mark in session.execute(select(RollupMark)).scalars():
+            totals.add(shards.engines()[mark.shard], None, mark.high_water)
+        differing = []
+        for model in ROLLUPS:
+            key, counts = key_column(model), count_columns(model)
+            stored = {(row.bucket, getattr(row, key)): +Counter({c: getattr(row, c) for c in counts})
+                      for row in session.execute(select(model)).scalars()}
+            expected = {k: +v for k, v in totals.counts[model].items()}
+            if {k: v for k, v in stored.items() if v} != {k: v for k, v in expected.items() if v}:
+                differing.append(model.__tablename__)
+        return differing
+    finally:
+        session.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='refresh the dashboard rollups from the answers written since the '
+                                                 'last run')
+    parser.add_argument('--lag', type=float, default=app.config.ROLLUP_LAG,
+                        help='seconds of recent answers left for the next run, as they may still be committing')
+    parser.add_argument('--every', type=float, default=0, metavar='SECONDS', help='keep refreshing at this interval')
+    parser.add_argument('--rebuild', action='store_true', help='recompute every rollup from scratch first')
+    parser.add_argument('--check', action='store_true', help='afterwards recount the answers and compare')
+    args = parser.parse_args()
+
+    create_database()
+    if args.rebuild:
+        print(f'rebuilt {rebuild(args.lag)[0]} buckets')
+    while True:
+        start = time.perf_counter()
+        try:
+            buckets, upper = refresh(args.lag)
+            print(f'{buckets} buckets updated up to {upper:%Y-%m-%d %H:%M:%S} in {time.perf_counter() - start:.2f}s')
+        except RefreshConflict as e:
+            print(f'another refresh ran at the same time, nothing written: {e}')
+        if not args.every:
+            break
+        time.sleep(args.every)
+    if args.check:
+        differing = check()
+        print(f'rollups differing from the answers: {", ".join(differing) or "none"}')
+        raise SystemExit(1 if differing else 0)
@@ -1,15 +1,33 @@
-from itertools import chain
-from typing import Optional
+import asyncio
+import datetime
+import hmac
+import os
+from typing import List, Optional
 
-from fastapi import FastAPI, status, HTTPException, Depends
+from fastapi import FastAPI, status, HTTPException, Depends, Query, Header, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, FileResponse
-from sqlalchemy.orm import Session
+from fastapi.responses import HTMLResponse, PlainTextResponse, StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.config import PORT, DATABASE_URI
-from app.controller import (get_user_by_id, create_user,
-                            get_questions, create_answer, get_question, get_answers, get_questions_by_id)
-from app.models import get_db
+from app.config import (PORT, DATABASE_PROFILE, DASHBOARD_MAX_DAYS, ANSWER_BATCH_LIMIT, WRITE_BEHIND, CATALOG_SNAPSHOT,
+                        QUESTION_PAGE_LIMIT)
+from app.admission import AdmissionMiddleware, admission
+from app.catalog import QuestionIndex, catalog_cache
+from app.auth import authenticate, issue_token
+from app.controller import (get_solved_questions, create_answer, create_answers, is_solved, get_tag_stats,
+                            get_rollups, get_rollup_mark,
+                            rank_tags, get_cohort_recommendations, get_progress_version)
+from app.export import database_export
+from app.metrics import MetricsMiddleware, instrument, render as render_metrics
+from app.models import (get_db, get_write_db, dispose_engines, engine, async_engine, async_write_engine,
+                        QuestionRollup, AssertionRollup, TagRollup)
+from app.payloads import payload_cache
+from app.profiling import ProfilingMiddleware, profiler
+from app.search import search_cache
+from app.secrets import ADMIN_KEY, PROFILE_KEY
+from app.shards import shards
+from app.snapshot import SnapshotFile
+from app.writebehind import answer_buffer
 from app.scheme import *
 
 app = FastAPI(
@@ -21,6 +39,10 @@ app = FastAPI(
     debug=True
 )
 
+if PROFILE_KEY:
+    app.add_middleware(ProfilingMiddleware, profiler=profiler, key=PROFILE_KEY)
+# inside CORS and metrics, so shed requests still get CORS headers and show up in the metrics
+app.add_middleware(AdmissionMiddleware, admission=admission)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=['https://chunagon.herokuapp.com', 'https://chunagon-dash.herokuapp.com',
@@ -28,83 +50,311 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=['*'],
     allow_headers=['*'],
+    expose_headers=['ETag', 'Retry-After'],
 )
+app.add_middleware(MetricsMiddleware)
+request_engines = [*{async_engine.sync_engine, async_write_engine.sync_engine, engine}, *shards.all_engines()]
+instrument(*request_engines)
+profiler.instrument(*request_engines)
 
 
-@app.get('/question', response_model=QuestionList)
-async def questions(token: Optional[str] = '', session: Session = Depends(get_db)):
-    user = token and get_user_by_id(token, session)
-    if not user:
-        user = create_user(session)
+@app.on_event('startup')
+async def map_catalog_snapshot():
+    if CATALOG_SNAPSHOT:
+        catalog_cache.snapshot = SnapshotFile(CATALOG_SNAPSHOT)
 
-    return QuestionList(token=user.id,
-                        questions=[QuestionListItem(questionID=q.id, title=q.title,
-                                                    answeredCorrectly=answered_correctly, level=q.level,
-                                                    tags=[Tag(id=tag.id, name=tag.name, tutorial_link=tag.tutorial_link)
-                                                          for tag in q.tags])
-                                   for q, answered_correctly in get_questions(user, session)])
 
+@app.on_event('startup')
+async def start_answer_buffer():
+    if WRITE_BEHIND:
+        answer_buffer.start()
 
-@app.get('/question/{questionID}', response_model=Question)
-async def certain_question(questionID: uuid.UUID, token: str, session: Session = Depends(get_db)):
-    user = get_user_by_id(token, session)
-    if not user:
+
+@app.on_event('shutdown')
+async def flush_answer_buffer():
+    await answer_buffer.close()
+
+
+@app.on_event('shutdown')
+async def dispose_engine():
+    await dispose_engines()
+    await shards.dispose()
+
+
+def _etag(catalog_version: int, progress_version: int) -> str:
+    return f'"{catalog_version}-{progress_version}"'
+
+
+def _validators(etag: str) -> dict:
+    return {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+
+
+def _matches(if_none_match: Optional[str], etag: str) -> bool:
+    return bool(if_none_match) and any(tag.strip() in (etag, f'W/{etag}', '*') for tag in if_none_match.split(','))
+
+
+@app.post('/token', response_model=SignupResponse)
+async def new_token():
+    return SignupResponse(token=issue_token(uuid.uuid4()))
+
+
+# The two question routes answer with bytes from payload_cache; response_model only documents the schema.
+
+@app.get('/question', response_model=QuestionList, responses={304: {'description': 'Not Modified'}})
+async def questions(token: Optional[str] = '', if_none_match: Optional[str] = Header(None),
+                    min_level: Optional[int] = None, max_level: Optional[int] = None,
+                    tag: Optional[List[uuid.UUID]] = Query(None), match: str = Query('any', regex='^(any|all)$'),
+                    solved: Optional[bool] = None, cursor: Optional[str] = None,
+                    limit: Optional[int] = Query(None, ge=1, le=QUESTION_PAGE_LIMIT),
+                    session: AsyncSession = Depends(get_db)):
+    """Questions in (level, id) order, all of them unless filtered or paged.
+
+    Filters combine: a level range, questions with any (or all) of the ``tag`` ids, solved or unsolved ones. With
+    ``limit`` the response holds one page, and ``nextCursor`` is passed as ``cursor`` for the next one.
+    """
+    try:
+        after = cursor and QuestionIndex.decode_cursor(cursor)
+    except ValueError:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, 'invalid cursor')
+    user_id = token and await authenticate(token, session)
+    catalog = await catalog_cache.get(session)
+    headers = {}
+    if user_id:
+        etag = _etag(catalog.version, await get_progress_version(user_id, session))
+        headers = _validators(etag)
+        if _matches(if_none_match, etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        solved_ids = await get_solved_questions(user_id, session)
+    else:
+        user_id, solved_ids = uuid.uuid4(), set()
+
+    question_ids = next_cursor = None
+    if any(v is not None for v in (min_level, max_level, tag, solved, cursor, limit)):
+        index = catalog.index
+        mask = index.level_range(min_level, max_level) & index.tagged(tag or (), match == 'all')
+        if solved is not None:
+            mask &= index.members(solved_ids) if solved else ~index.members(solved_ids)
+        if after:
+            mask &= index.after(after)
+        question_ids, more = index.page(mask, limit)
+        if more:
+            next_cursor = index.encode_cursor(index.keys[index.positions[question_ids[-1]]])
+    return Response(payload_cache.get(catalog).question_list(issue_token(user_id), solved_ids, question_ids,
+                                                             next_cursor),
+                    media_type='application/json', headers=headers)
+
+
+# declared before /question/{questionID}, which would otherwise take "search" for an id
+
+@app.get('/question/search', response_model=QuestionSearchResult)
+async def search_questions(q: str = Query(..., min_length=1, max_length=200), token: Optional[str] = '',
+                           offset: int = Query(0, ge=0), limit: int = Query(20, ge=1, le=QUESTION_PAGE_LIMIT),
+                           session: AsyncSession = Depends(get_db)):
+    """Questions whose title, description or assertion messages contain every word of ``q``, best match first."""
+    user_id = token and await authenticate(token, session)
+    catalog = await catalog_cache.get(session)
+    solved = await get_solved_questions(user_id, session) if user_id else set()
+    results = (await search_cache.get(catalog)).search(q)
+    return Response(payload_cache.get(catalog).search_results(
+        len(results), solved, [question_id for question_id, _ in results[offset:offset + limit]]),
+        media_type='application/json')
+
+
+@app.get('/question/{questionID}', response_model=Question, responses={304: {'description': 'Not Modified'}})
+async def certain_question(questionID: uuid.UUID, token: str, if_none_match: Optional[str] = Header(None),
+                           session: AsyncSession = Depends(get_db)):
+    user_id = await authenticate(token, session)
+    if not user_id:
         raise HTTPException(status.HTTP_401_UNAUTHORIZED)
-    q, answered_correctly = get_question(user, questionID, session)
-
-    return Question(questionID=q.id, title=q.title,
-                    description=q.description,
-                    testCases=[
-                        TestCase(input=t.input, expected=t.expected)
-                        for t in q.test_cases
-                    ],
-                    assertions=[
-                        Assertion(id=a.id,
-                                  assertion=a.assertion,
-                                  message=a.message,
-                                  tags=[Tag(id=tag.id, name=tag.name, tutorial_link=tag.tutorial_link) for tag in
-                                        a.tags])
-                        for a in q.assertions
-                    ],
-                    answeredCorrectly=answered_correctly,
-                    tags=[Tag(id=tag.id, name=tag.name, tutorial_link=tag.tutorial_link) for tag in q.tags],
-                    level=q.level,
-                    defaultCode=q.default_code)
+    catalog = await catalog_cache.get(session)
+    if questionID not in catalog.questions:
+        raise HTTPException(status.HTTP_404_NOT_FOUND)
+    etag = _etag(catalog.version, await get_progress_version(user_id, session))
+    if _matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=_validators(etag))
+    answered_correctly = await is_solved(user_id, questionID, session)
+
+    return Response(payload_cache.get(catalog).question(questionID, answered_correctly),
+                    media_type='application/json', headers=_validators(etag))
+
+
+# with write-behind the request only reads; holding a writer connection would block the flush it waits for
+answer_db = get_db if WRITE_BEHIND else get_write_db
 
 
 @app.post('/answer', response_model=UserAnswerRequest, status_code=status.HTTP_201_CREATED)
-async def answer(req: UserAnswerRequest, token: str, session: Session = Depends(get_db),
+async def answer(req: UserAnswerRequest, token: str, session: AsyncSession = Depends(answer_db),
                  is_assertion_used: bool = True):
-    user = get_user_by_id(token, session)
-    if not user:
+    user_id = await authenticate(token, session)
+    if not user_id:
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED)
+
+    if WRITE_BEHIND:
+        await answer_buffer.submit(user_id, req.questionID, req.isCorrect, req.failedAssertions, is_assertion_used,
+                                   session)
+    else:
+        await create_answer(user_id, req.questionID, req.isCorrect, req.failedAssertions, is_assertion_used, session)
+
+
+@app.post('/answers/batch', response_model=BatchAnswerResponse)
+async def answers_batch(req: List[UserAnswerRequest], token: str, session: AsyncSession = Depends(get_write_db),
+                        is_assertion_used: bool = True):
+    user_id = await authenticate(token, session)
+    if not user_id:
         raise HTTPException(status.HTTP_401_UNAUTHORIZED)
+    if len(req) > ANSWER_BATCH_LIMIT:
+        raise HTTPException(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
 
-    create_answer(user, req.questionID, req.isCorrect, req.failedAssertions, is_assertion_used, session)
+    codes = await create_answers(user_id, [(r.questionID, r.isCorrect, r.failedAssertions) for r in req],
+                                 is_assertion_used, session)
+    return BatchAnswerResponse(results=[BatchAnswerResult(questionID=r.questionID, status=code)
+                                        for r, code in zip(req, codes)])
 
 
 @app.get('/recommendation', response_model=RecommendationResponse)
-async def recommendation(token: str, session: Session = Depends(get_db)):
-    user = get_user_by_id(token, session)
-    if not user:
+async def recommendation(token: str, session: AsyncSession = Depends(get_db)):
+    user_id = await authenticate(token, session)
+    if not user_id:
         raise HTTPException(status.HTTP_401_UNAUTHORIZED)
 
-    answers = get_answers(user, session)
-    all_tags = list(chain.from_iterable([list(chain.from_iterable(a.tags for a in question.assertions)) for question in
-                                         get_questions_by_id([ans.question for ans in answers], session)]))
-    wrong_tags = list(chain.from_iterable(
-        [list(chain.from_iterable(a.tags for a in ans.failed_assertions)) for ans in answers if
-         ans.is_correct is False]))
+    catalog = await catalog_cache.get(session)
+    stats = {s.tag: (s.exposures, s.failures) for s in await get_tag_stats(user_id, session) if s.tag in catalog.tags}
+
+    return RecommendationResponse(tags=[Tag(id=t.id, name=t.name, tutorial_link=t.tutorial_link)
+                                        for t in (catalog.tags[tag_id] for tag_id, _ in rank_tags(stats))])
+
+
+def _check_key(key: str, given: str):
+    # a deployment without the key does not offer the endpoint at all
+    if not key:
+        raise HTTPException(status.HTTP_404_NOT_FOUND)
+    if not hmac.compare_digest(given.encode('latin-1'), key.encode('latin-1')):
+        raise HTTPException(status.HTTP_403_FORBIDDEN)
+
+
+def admin(x_admin_key: str = Header('')):
+    _check_key(ADMIN_KEY, x_admin_key)
+
+
+@app.get('/dashboard/recommendation', response_model=CohortRecommendationResponse, dependencies=[Depends(admin)])
+async def cohort_recommendation(offset: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=1000),
+                                session: AsyncSession = Depends(get_db)):
+    catalog = await catalog_cache.get(session)
+    recommendations = await get_cohort_recommendations(offset, limit, session)
+
+    return CohortRecommendationResponse(
+        computedAt=recommendations[0][1][0].computed_at if recommendations else None,
+        users=[UserRecommendation(user=user,
+                                  tags=[Tag(id=t.id, name=t.name, tutorial_link=t.tutorial_link)
+                                        for t in (catalog.tags[r.tag] for r in tags if r.tag in catalog.tags)])
+               for user, tags in recommendations])
+
+
+# The dashboard statistics are read from the rollups of app/rollups.py, never from the answers. A window defaults to
+# the last week and may not exceed DASHBOARD_MAX_DAYS.
+
+def _window(bucket: str, since: Optional[datetime.datetime], until: Optional[datetime.datetime]):
+    # buckets start in local time, like the answers they count
+    since, until = (v.astimezone().replace(tzinfo=None) if v is not None and v.tzinfo is not None else v
+                    for v in (since, until))
+    until = until or datetime.datetime.now()
+    since = since or until - datetime.timedelta(days=7)
+    if until - since > datetime.timedelta(days=DASHBOARD_MAX_DAYS):
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, f'at most {DASHBOARD_MAX_DAYS} days at a time')
+    # whole buckets, so that the first one is not partly counted
+    since = since.replace(minute=0, second=0, microsecond=0)
+    return since if bucket == 'hour' else since.replace(hour=0), until
+
+
+@app.get('/dashboard/questions', response_model=QuestionStatsResponse)
+async def dashboard_questions(bucket: str = Query('hour', regex='^(hour|day)$'),
+                              since: Optional[datetime.datetime] = None, until: Optional[datetime.datetime] = None,
+                              session: AsyncSession = Depends(get_db)):
+    catalog = await catalog_cache.get(session)
+    rollups = await get_rollups(QuestionRollup, bucket, *_window(bucket, since, until), session)
+    return QuestionStatsResponse(
+        bucket=bucket, refreshedTo=await get_rollup_mark(session),
+        questions=[QuestionStats(start=start, questionID=question_id, attempts=c['attempts'], correct=c['correct'],
+                                 solveRate=c['correct'] / c['attempts'] if c['attempts'] else 0)
+                   for (start, question_id), c in sorted(rollups.items()) if question_id in catalog.questions])
+
+
+@app.get('/dashboard/assertions', response_model=AssertionStatsResponse)
+async def dashboard_assertions(bucket: str = Query('hour', regex='^(hour|day)$'),
+                               since: Optional[datetime.datetime] = None, until: Optional[datetime.datetime] = None,
+                               session: AsyncSession = Depends(get_db)):
+    catalog = await catalog_cache.get(session)
+    window = _window(bucket, since, until)
+    attempts = await get_rollups(QuestionRollup, bucket, *window, session)
+    rollups = await get_rollups(AssertionRollup, bucket, *window, session)
+    assertions = []
+    for (start, assertion_id), c in sorted(rollups.items()):
+        if assertion_id not in catalog.assertions:
+            continue
+        question_id = catalog.assertions[assertion_id].question_id
+        question_attempts = attempts.get((start, question_id), {}).get('attempts', 0)
+        assertions.append(AssertionStats(start=start, assertionID=assertion_id, questionID=question_id,
+                                         failures=c['failures'], attempts=question_attempts,
+                                         failureRate=c['failures'] / question_attempts if question_attempts else 0))
+    return AssertionStatsResponse(bucket=bucket, refreshedTo=await get_rollup_mark(session), assertions=assertions)
+
+
+@app.get('/dashboard/tags', response_model=TagStatsResponse)
+async def dashboard_tags(bucket: str = Query('hour', regex='^(hour|day)$'),
+                         since: Optional[datetime.datetime] = None, until: Optional[datetime.datetime] = None,
+                         session: AsyncSession = Depends(get_db)):
+    catalog = await catalog_cache.get(session)
+    rollups = await get_rollups(TagRollup, bucket, *_window(bucket, since, until), session)
+    return TagStatsResponse(
+        bucket=bucket, refreshedTo=await get_rollup_mark(session),
+        tags=[TagStats(start=start, tag=Tag(id=tag_id, name=catalog.tags[tag_id].name,
+                                            tutorial_link=catalog.tags[tag_id].tutorial_link),
+                       exposures=c['exposures'], failures=c['failures'],
+                       struggleRate=c['failures'] / c['exposures'] if c['exposures'] else 0)
+              for (start, tag_id), c in sorted(rollups.items()) if tag_id in catalog.tags])
+
+
+@app.get('/metrics', response_class=PlainTextResponse, include_in_schema=False)
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type='text/plain; version=0.0.4')
+
+
+def profile_admin(x_profile: str = Header('')):
+    _check_key(PROFILE_KEY, x_profile)
+
+
+@app.get('/profile/rules', include_in_schema=False, dependencies=[Depends(profile_admin)])
+async def profile_rules():
+    return [rule.to_json() for rule in profiler.rules]
+
+
+@app.post('/profile/rules', include_in_schema=False, dependencies=[Depends(profile_admin)])
+async def arm_profiler(route: str, method: str = 'GET', every: int = Query(1, ge=1), count: int = Query(10, ge=1)):
+    try:
+        return profiler.arm(app.routes, method.upper(), route, every, count).to_json()
+    except ValueError as e:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, str(e))
+
+
+@app.delete('/profile/rules', include_in_schema=False, dependencies=[Depends(profile_admin)])
+async def disarm_profiler():
+    profiler.disarm()
+    return []
+
 
-    result = []
+@app.get('/profile', include_in_schema=False, dependencies=[Depends(profile_admin)])
+async def profile_traces():
+    return await asyncio.get_event_loop().run_in_executor(None, profiler.traces)
 
-    for tag in set(all_tags):
-        wrong_ratio = wrong_tags.count(tag) / len(wrong_tags)
-        if wrong_ratio > 0:
-            tag_ratio = all_tags.count(tag) / len(all_tags)
-            result.append((-wrong_ratio / tag_ratio, tag))
 
-    result.sort()
-    return RecommendationResponse(tags=[Tag(id=t.id, name=t.name, tutorial_link=t.tutorial_link) for _, t in result])
+@app.get('/profile/{name}', include_in_schema=False, dependencies=[Depends(profile_admin)])
+async def profile_trace(name: str, format: str = Query('folded', regex='^(folded|json)$')):
+    trace = await asyncio.get_event_loop().run_in_executor(None, profiler.load, name)
+    if trace is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND)
+    if format == 'json':
+        return trace
+    return PlainTextResponse(trace['folded'], headers={'Content-Disposition': f'attachment; filename="{name}.folded"'})
 
 
 @app.get('/openapi/yaml', response_class=HTMLResponse, include_in_schema=False)
@@ -118,6 +368,19 @@ async def openapi_yaml():
                         '<textarea rows="100" cols="200">{}</textarea></body></html>'.format(yaml_data))
 
 
-@app.get('/download/database')
-async def download_database():
-    return FileResponse(DATABASE_URI.split('/')[-1])
+@app.get('/download/database', dependencies=[Depends(admin)])
+async def download_database(since: Optional[datetime.datetime] = None, compress: bool = False):
+    if DATABASE_PROFILE != 'sqlite':
+        raise HTTPException(status.HTTP_404_NOT_FOUND)
+    if since is not None and since.tzinfo is not None:
+        since = since.astimezone().replace(tzinfo=None)  # answers are stamped in local time
+    file = await database_export.open(since)
+    if file is None:
+        raise HTTPException(status.HTTP_429_TOO_MANY_REQUESTS, headers={'Retry-After': '10'})
+    filename = 'database.db' if since is None else f'database-since-{since:%Y%m%dT%H%M%S}.db'
+    headers = {'Content-Disposition': f'attachment; filename="{filename}.gz"' if compress
+               else f'attachment; filename="{filename}"'}
+    if not compress:
+        headers['Content-Length'] = str(os.fstat(file.fileno()).st_size)
+    return StreamingResponse(database_export.stream(file, compress), headers=headers,
+                             media_type='application/gzip' if compress else 'application/vnd.sqlite3')
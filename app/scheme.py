@@ -1,7 +1,8 @@
 from __future__ import annotations
 
+import datetime
 import uuid
-from typing import List
+from typing import List, Optional
 
 from fastapi.param_functions import Form
 from pydantic import BaseModel
@@ -116,13 +117,14 @@ class QuestionListItem(BaseModel):
 
 
 class QuestionList(BaseModel):
-    token: uuid.UUID
+    token: str
     questions: List[QuestionListItem]
+    nextCursor: Optional[str]
 
     class Config:
         schema_extra = {
             "example": {
-                'token': '2f644942-e039-4a1c-aab2-bfb8d67d5ff9',
+                'token': '(JWT)',
                 'questions': [
                     {"questionID": '2f644942-e039-4a1c-aab2-bfb8d67d5ff9',
                      "title": "add 2 value",
@@ -148,6 +150,30 @@ class QuestionList(BaseModel):
                              tutorial_link='https://developer.mozilla.org/ja/docs/Web/JavaScript/Guide/Functions')
                      ],
                      'level': 2}
+                ],
+                'nextCursor': '2.2f644942e0394a1caab2bfb8d67d5ff9'
+            }
+        }
+
+
+class QuestionSearchResult(BaseModel):
+    total: int
+    questions: List[QuestionListItem]
+
+    class Config:
+        schema_extra = {
+            "example": {
+                'total': 1,
+                'questions': [
+                    {"questionID": '2f644942-e039-4a1c-aab2-bfb8d67d5ff9',
+                     "title": "for文で合計を求める",
+                     "answeredCorrectly": False,
+                     "tags": [
+                         Tag(id='2f644942-e039-4a1c-aab2-bfb8d67d5ff9',
+                             name="for文",
+                             tutorial_link='https://developer.mozilla.org/ja/docs/Web/JavaScript/Reference/Statements/for')
+                     ],
+                     'level': 1}
                 ]
             }
         }
@@ -252,6 +278,33 @@ class UserAnswerRequest(BaseModel):
         }
 
 
+class BatchAnswerResult(BaseModel):
+    questionID: uuid.UUID
+    status: int
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "questionID": '2f644942-e039-4a1c-aab2-bfb8d67d5ff9',
+                "status": 201
+            }
+        }
+
+
+class BatchAnswerResponse(BaseModel):
+    results: List[BatchAnswerResult]
+
+    class Config:
+        schema_extra = {
+            "example": {
+                'results': [
+                    {"questionID": '2f644942-e039-4a1c-aab2-bfb8d67d5ff9', "status": 201},
+                    {"questionID": '2f644942-e039-4a1c-aab2-bfb8d67d5ff9', "status": 404}
+                ]
+            }
+        }
+
+
 class RecommendationResponse(BaseModel):
     tags: List[Tag]
 
@@ -265,3 +318,119 @@ class RecommendationResponse(BaseModel):
                 ]
             }
         }
+
+
+class UserRecommendation(BaseModel):
+    user: uuid.UUID
+    tags: List[Tag]
+
+    class Config:
+        schema_extra = {
+            "example": {
+                'user': '2f644942-e039-4a1c-aab2-bfb8d67d5ff9',
+                'tags': [
+                    Tag(id='2f644942-e039-4a1c-aab2-bfb8d67d5ff9',
+                        name="算術理解",
+                        tutorial_link='https://developer.mozilla.org/ja/docs/Web/JavaScript/Guide/Expressions_and_Operators')
+                ]
+            }
+        }
+
+
+class CohortRecommendationResponse(BaseModel):
+    computedAt: Optional[datetime.datetime]
+    users: List[UserRecommendation]
+
+    class Config:
+        schema_extra = {
+            "example": {
+                'computedAt': '2021-07-20T12:00:00',
+                'users': [
+                    {'user': '2f644942-e039-4a1c-aab2-bfb8d67d5ff9',
+                     'tags': [
+                         Tag(id='2f644942-e039-4a1c-aab2-bfb8d67d5ff9',
+                             name="算術理解",
+                             tutorial_link='https://developer.mozilla.org/ja/docs/Web/JavaScript/Guide/Expressions_and_Operators')
+                     ]}
+                ]
+            }
+        }
+
+
+class QuestionStats(BaseModel):
+    start: datetime.datetime
+    questionID: uuid.UUID
+    attempts: int
+    correct: int
+    solveRate: float
+
+    class Config:
+        schema_extra = {
+            "example": {
+                'start': '2021-07-20T12:00:00',
+                'questionID': '2f644942-e039-4a1c-aab2-bfb8d67d5ff9',
+                'attempts': 40,
+                'correct': 30,
+                'solveRate': 0.75
+            }
+        }
+
+
+class QuestionStatsResponse(BaseModel):
+    bucket: str
+    refreshedTo: Optional[datetime.datetime]
+    questions: List[QuestionStats]
+
+
+class AssertionStats(BaseModel):
+    start: datetime.datetime
+    assertionID: uuid.UUID
+    questionID: uuid.UUID
+    failures: int
+    attempts: int
+    failureRate: float
+
+    class Config:
+        schema_extra = {
+            "example": {
+                'start': '2021-07-20T12:00:00',
+                'assertionID': '2f644942-e039-4a1c-aab2-bfb8d67d5ff9',
+                'questionID': '2f644942-e039-4a1c-aab2-bfb8d67d5ff9',
+                'failures': 8,
+                'attempts': 40,
+                'failureRate': 0.2
+            }
+        }
+
+
+class AssertionStatsResponse(BaseModel):
+    bucket: str
+    refreshedTo: Optional[datetime.datetime]
+    assertions: List[AssertionStats]
+
+
+class TagStats(BaseModel):
+    start: datetime.datetime
+    tag: Tag
+    exposures: int
+    failures: int
+    struggleRate: float
+
+    class Config:
+        schema_extra = {
+            "example": {
+                'start': '2021-07-20T12:00:00',
+                'tag': Tag(id='2f644942-e039-4a1c-aab2-bfb8d67d5ff9',
+                           name="算術理解",
+                           tutorial_link='https://developer.mozilla.org/ja/docs/Web/JavaScript/Guide/Expressions_and_Operators'),
+                'exposures': 120,
+                'failures': 18,
+                'struggleRate': 0.15
+            }
+        }
+
+
+class TagStatsResponse(BaseModel):
+    bucket: str
+    refreshedTo: Optional[datetime.datetime]
+    tags: List[TagStats]
@@ -0,0 +1,156 @@
+import asyncio
+import math
+import re
+import unicodedata
+import uuid
+from collections import Counter, OrderedDict, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from app.catalog import Catalog, QuestionEntry
+from app.config import SEARCH_CACHE_SIZE
+
+# matches in a title count for more than matches in the body
+FIELD_WEIGHTS = (('title', 3.0), ('description', 1.0), ('messages', 1.0))
+K1, B = 1.2, 0.75
+
+_WORD = re.compile(r'\w+')
+
+
+def normalize(text: str) -> str:
+    # NFKC folds full-width latin and digits and half-width kana, so 'ｆｏｒ文' finds 'for文'
+    return unicodedata.normalize('NFKC', text).lower()
+
+
+def terms(text: str, indexing: bool = False) -> List[str]:
+    """Character bigrams of every run of word characters, or the character itself for a run of one.
+
+    Japanese has no spaces to split words on, so n-grams stand in for them; latin words get the same treatment, which
+    also makes prefixes match. Indexed text also gets every single character, for one-character queries.
+    """
+    result = []
+    for run in _WORD.findall(normalize(text)):
+        if indexing and len(run) > 1:
+            result.extend(run)
+        result.extend([run] if len(run) == 1 else [run[i:i + 2] for i in range(len(run) - 1)])
+    return result
+
+
+class Document:
+    """The indexed form of one question: weighted term frequencies and the text to confirm phrase matches."""
+
+    __slots__ = ('key', 'frequencies', 'length', 'text')
+
+    def __init__(self, q: QuestionEntry):
+        self.key = _document_key(q)
+        fields = {'title': q.title, 'description': q.description,
+                  'messages': '\n'.join(a.message for a in q.assertions)}
+        self.frequencies = Counter()
+        for field, weight in FIELD_WEIGHTS:
+            for term in terms(fields[field], indexing=True):
+                self.frequencies[term] += weight
+        self.length = sum(self.frequencies.values())
+        self.text = '\n'.join(normalize(fields[field]) for field, _ in FIELD_WEIGHTS)
+
+
+def _document_key(q: QuestionEntry) -> tuple:
+    return q.title, q.description, tuple(a.message for a in q.assertions)
+
+
+class SearchIndex:
+    """Inverted index from bigrams to questions, ranked with BM25.
+
+    Documents of questions whose text did not change are taken over from the index of the previous catalog version,
+    so a reload only tokenizes what the fixture load touched.
+    """
+
+    def __init__(self, catalog: Catalog, previous: Optional['SearchIndex'] = None):
+        self.catalog = catalog
+        reused = previous.documents if previous is not None else {}
+        self.documents: Dict[uuid.UUID, Document] = {}
+        for question_id in catalog.index.ids:
+            q = catalog.questions[question_id]
+            document = reused.get(question_id)
+            if document is None or document.key != _document_key(q):
+                document = Document(q)
+            self.documents[question_id] = document
+        # postings hold the saturated term frequency of BM25, so a query only multiplies in the idf of its terms
+        average_length = sum(d.length for d in self.documents.values()) / max(len(self.documents), 1)
+        self.postings: Dict[str, Dict[uuid.UUID, float]] = defaultdict(dict)
+        for question_id, document in self.documents.items():
+            norm = K1 * (1 - B + B * document.length / average_length)
+            for term, frequency in document.frequencies.items():
+                self.postings[term][question_id] = frequency * (K1 + 1) / (frequency + norm)
+        self._results: Dict[str, List[Tuple[uuid.UUID, float]]] = OrderedDict()
+
+    def search(self, query: str) -> List[Tuple[uuid.UUID, float]]:
+        """Questions containing every word of ``query``, best first; ties keep the order of the catalog index.
+
+        Recent queries are remembered, so paging through the results does not search again.
+        """
+        key = normalize(query)
+        results = self._results.get(key)
+        if results is None:
+            results = self._results[key] = self._search(key)
+            if len(self._results) > SEARCH_CACHE_SIZE:
+                self._results.popitem(last=False)
+        else:
+            self._results.move_to_end(key)
+        return results
+
+    def _search(self, query: str) -> List[Tuple[uuid.UUID, float]]:
+        query_terms = set(terms(query))
+        if not query_terms:
+            return []
+        postings = sorted((self.postings.get(term, {}) for term in query_terms), key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            candidates.intersection_update(posting)
+            if not candidates:
+                return []
+
+        # The bigrams of a longer word may all occur without the word, e.g. 'for' and 'or文' for 'for文'; words of one
+        # or two characters are a single term and match exactly.
+        words = [word for word in _WORD.findall(query) if len(word) > 2]
+        if words:
+            candidates = [q for q in candidates if all(word in self.documents[q].text for word in words)]
+        count = len(self.documents)
+        weighted = [(math.log(1 + (count - len(self.postings[term]) + 0.5) / (len(self.postings[term]) + 0.5)),
+                     self.postings[term]) for term in query_terms]
+        results = [(question_id, sum(weight * posting[question_id] for weight, posting in weighted))
+                   for question_id in candidates]
+        positions = self.catalog.index.positions
+        results.sort(key=lambda r: (-r[1], positions[r[0]]))
+        return results
+
+
+class SearchCache:
+    """The search index of the current catalog, built on a worker thread once per catalog version.
+
+    Tokenizing a large bank takes long enough to stall every request of the worker, so the index is built in the
+    default executor while the event loop goes on; searches arriving meanwhile wait for that same build.
+    """
+
+    def __init__(self):
+        self._index: Optional[SearchIndex] = None
+        self._building: Optional[Tuple[Catalog, asyncio.Future]] = None
+
+    async def get(self, catalog: Catalog) -> SearchIndex:
+        index = self._index
+        if index is not None and index.catalog is catalog:
+            return index
+        if self._building is None or self._building[0] is not catalog:
+            future = asyncio.get_event_loop().run_in_executor(None, SearchIndex, catalog, index)
+            future.add_done_callback(self._built)
+            self._building = (catalog, future)
+        # shielded: a client going away must not cancel the build the other searches wait for
+        return await asyncio.shield(self._building[1])
+
+    def _built(self, future: asyncio.Future):
+        if self._building is None or self._building[1] is not future:
+            return  # superseded by the build for a newer catalog
+        self._building = None
+        if not future.cancelled() and future.exception() is None:
+            self._index = future.result()
+
+
+search_cache = SearchCache()
@@ -1,3 +1,8 @@
 import os
 
 JWT_SECRET = os.environ['JWT_SECRET']
+# required in the X-Admin-Key header by the endpoints exposing user ids (the cohort recommendations and the database
+# download); empty turns them off
+ADMIN_KEY = os.environ.get('ADMIN_KEY', '')
+# enables request profiling (app/profiling.py) for whoever sends it in the X-Profile header; empty turns it off
+PROFILE_KEY = os.environ.get('PROFILE_KEY', '')
@@ -0,0 +1,160 @@
+import asyncio
+import hashlib
+import os
+import uuid
+from typing import Awaitable, Callable, List, TypeVar, Union
+
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateIndex, CreateTable
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import Session
+
+import app.config
+from app.models import (Base, User, LegacyUser, Answer, UserQuestionProgress, UserTagStat, TagRecommendation,
+                        answer_assertion_relation, engine, SessionLocal, AsyncSessionLocal, AsyncWriteSessionLocal)
+from app.profiles import (SQLITE, sync_engine_options, async_engine_options, apply_sqlite_pragmas,
+                          sqlite_pragmas)
+
+T = TypeVar('T')
+
+# Everything written on behalf of a single user. These tables live in the user's shard; the catalog stays in the
+# main database, and a routed session reads it from there.
+SHARDED_TABLES = (User.__table__, LegacyUser.__table__, Answer.__table__, answer_assertion_relation,
+                  UserQuestionProgress.__table__, UserTagStat.__table__, TagRecommendation.__table__)
+
+
+def create_shard_tables(bind: Engine):
+    """Create the sharded tables missing from ``bind``, like ``create_all`` does.
+
+    Foreign keys to the catalog are left out: the catalog lives in another database, and MySQL refuses a key to a
+    table it cannot see.
+    """
+    existing = set(inspect(bind).get_table_names())
+    with bind.begin() as connection:
+        for table in (t for t in Base.metadata.sorted_tables if t in SHARDED_TABLES and t.name not in existing):
+            connection.execute(CreateTable(table, include_foreign_key_constraints=[
+                fk for fk in table.foreign_key_constraints if fk.referred_table in SHARDED_TABLES]))
+            for index in table.indexes:
+                connection.execute(CreateIndex(index))
+
+
+def shard_index(user_id: uuid.UUID, count: int) -> int:
+    # hashed rather than taken from the id's bits, so ids that are not random (uuid5, sequential) spread as well
+    return int.from_bytes(hashlib.blake2b(user_id.bytes, digest_size=8).digest(), 'little') % count
+
+
+def shard_uri(uri: str, index: int, count: int) -> str:
+    """The database of shard ``index`` out of ``count``, next to the main database ``uri``.
+
+    The count is part of the name, so the databases of two layouts never overlap while resharding.
+    """
+    base, _, query = uri.partition('?')
+    suffix = f'shard{index}of{count}'
+    if base.startswith('sqlite'):
+        root, extension = os.path.splitext(base)
+        base = f'{root}.{suffix}{extension}'
+    else:
+        base = f'{base}_{suffix}'
+    return f'{base}?{query}' if query else base
+
+
+class Shard:
+    def __init__(self, uri: str, async_uri: str, profile: str):
+        self.engine = create_engine(uri, **sync_engine_options(profile))
+        self.reader = create_async_engine(async_uri, **async_engine_options(profile))
+        self.writer = self.reader if profile != SQLITE else create_async_engine(
+            async_uri, **async_engine_options(profile, writer=True))
+        if profile == SQLITE:
+            for e in {self.engine, self.reader.sync_engine, self.writer.sync_engine}:
+                apply_sqlite_pragmas(e, sqlite_pragmas())
+
+    async def dispose(self):
+        self.engine.dispose()
+        for e in {self.reader, self.writer}:
+            await e.dispose()
+
+
+class Shards:
+    """User-scoped tables partitioned by a hash of the user id over several databases.
+
+    With no shards configured every method leaves sessions alone and fans out over the main database only, so callers
+    use the same code either way. A session is routed by binding the sharded tables to one shard's engine; it then
+    reads the catalog from the main database and the user's rows from the shard, and each commit only takes the
+    shard's write lock.
+    """
+
+    def __init__(self, count: int = 1, uri: str = app.config.DATABASE_URI,
+                 async_uri: str = app.config.ASYNC_DATABASE_URI, profile: str = app.config.DATABASE_PROFILE):
+        self._shards: List[Shard] = []
+        self.configure(count, uri, async_uri, profile)
+
+    def configure(self, count: int, uri: str, async_uri: str, profile: str):
+        """Use ``count`` shards next to the given main database; 1 keeps every table in the main database."""
+        self._shards = [Shard(shard_uri(uri, i, count), shard_uri(async_uri, i, count), profile)
+                        for i in range(count)] if count > 1 else []
+
+    def __len__(self) -> int:
+        return len(self._shards)
+
+    def index(self, user_id: uuid.UUID) -> int:
+        return shard_index(user_id, len(self._shards)) if self._shards else 0
+
+    def route(self, session: Union[Session, AsyncSession], index: int):
+        if not self._shards:
+            return
+        sync_session = session.sync_session if isinstance(session, AsyncSession) else session
+        routed = sync_session.info.get('shard')
+        if routed is not None:
+            if routed != index:
+                raise ValueError(f'session already routed to shard {routed}, not {index}')
+            return
+        shard = self._shards[index]
+        if sync_session is session:
+            bind = shard.engine
+        else:
+            bind = (shard.writer if sync_session.info.get('writer') else shard.reader).sync_engine
+        for table in SHARDED_TABLES:
+            sync_session.bind_table(table, bind)
+        sync_session.info['shard'] = index
+
+    def route_user(self, session: Union[Session, AsyncSession], user_id: uuid.UUID):
+        self.route(session, self.index(user_id))
+
+    async def gather(self, call: Callable[[AsyncSession], Awaitable[T]], writer: bool = False) -> List[T]:
+        """Run ``call`` once per shard, concurrently, each with its own routed session."""
+
+        async def run(index: int) -> T:
+            async with (AsyncWriteSessionLocal if writer else AsyncSessionLocal)() as session:
+                self.route(session, index)
+                return await call(session)
+
+        return list(await asyncio.gather(*[run(index) for index in range(len(self._shards) or 1)]))
+
+    def sync_sessions(self) -> List[Session]:
+        """One routed session per shard, for maintenance scripts; the caller closes them."""
+        sessions = []
+        for index in range(len(self._shards) or 1):
+            session = SessionLocal()
+            self.route(session, index)
+            sessions.append(session)
+        return sessions
+
+    def engines(self) -> list:
+        """Every sync engine holding user rows."""
+        return [shard.engine for shard in self._shards] or [engine]
+
+    def create_all(self):
+        for shard in self._shards:
+            create_shard_tables(shard.engine)
+
+    def all_engines(self) -> list:
+        """Every engine of every shard, sync engines of the async ones included."""
+        return [e for shard in self._shards for e in {shard.engine, shard.reader.sync_engine, shard.writer.sync_engine}]
+
+    async def dispose(self):
+        for shard in self._shards:
+            await shard.dispose()
+
+
+shards = Shards(app.config.ANSWER_SHARDS)
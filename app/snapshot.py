@@ -0,0 +1,193 @@
+import json
+import mmap
+import os
+import struct
+import uuid
+from collections.abc import Mapping
+from functools import cached_property
+from typing import Dict, Iterator, NamedTuple, Optional, Tuple
+
+from app.catalog import Catalog, QuestionEntry, AssertionEntry, QuestionIndex, TestCaseEntry, TagEntry
+
+# File layout, all integers little-endian:
+#   header            magic, catalog version, question count, assertion count, tags and facets blob lengths
+#   tags blob         JSON [[id hex, name, tutorial_link], ...]
+#   facets blob       JSON [[level, [tag ordinal, ...]], ...] per question, in catalog order
+#   question index    (id bytes, entry offset, entry length) per question, in catalog order
+#   assertion index   (id bytes, question ordinal) per assertion
+#   entries           one JSON array per question, decoded on first access
+MAGIC = b'DNGCAT02'
+HEADER = struct.Struct('<8sqIIQQ')
+QUESTION_INDEX = struct.Struct('<16sQI')
+ASSERTION_INDEX = struct.Struct('<16sI')
+
+
+def _encode_entry(q: QuestionEntry) -> bytes:
+    return json.dumps([q.title, q.description, q.default_code, q.level, [t.id.hex for t in q.tags],
+                       [[t.input, t.expected] for t in q.test_cases],
+                       [[a.id.hex, a.assertion, a.message, [t.id.hex for t in a.tags]] for a in q.assertions]],
+                      ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def write_snapshot(catalog: Catalog, path: str) -> int:
+    """Compile ``catalog`` into a snapshot file and move it over ``path`` in one rename; returns its size.
+
+    Workers that already mapped the previous file keep reading it until they swap, so the rename is the only
+    publication step.
+    """
+    questions = list(catalog.questions.values())
+    tags = json.dumps([[t.id.hex, t.name, t.tutorial_link] for t in catalog.tags.values()],
+                      ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    ordinals = {tag_id: ordinal for ordinal, tag_id in enumerate(catalog.tags)}
+    facets = json.dumps([[q.level, [ordinals[t.id] for t in q.tags]] for q in questions],
+                        separators=(',', ':')).encode('ascii')
+    entries = [_encode_entry(q) for q in questions]
+    assertions = [(a.id, ordinal) for ordinal, q in enumerate(questions) for a in q.assertions]
+
+    offset = (HEADER.size + len(tags) + len(facets) + QUESTION_INDEX.size * len(questions)
+              + ASSERTION_INDEX.size * len(assertions))
+    index = []
+    for q, entry in zip(questions, entries):
+        index.append(QUESTION_INDEX.pack(q.id.bytes, offset, len(entry)))
+        offset += len(entry)
+
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, catalog.version, len(questions), len(assertions), len(tags), len(facets)))
+        f.write(tags)
+        f.write(facets)
+        f.write(b''.join(index))
+        f.write(b''.join(ASSERTION_INDEX.pack(assertion_id.bytes, ordinal) for assertion_id, ordinal in assertions))
+        f.write(b''.join(entries))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+    return offset
+
+
+class _Facets(NamedTuple):
+    """What QuestionIndex reads of a question, kept apart from the entries so building it decodes none of them."""
+    id: uuid.UUID
+    level: int
+    tags: Tuple[TagEntry, ...]
+
+
+class _Questions(Mapping):
+    def __init__(self, buffer: mmap.mmap, index: Dict[uuid.UUID, Tuple[int, int]], tags: Dict[uuid.UUID, TagEntry]):
+        self._buffer = buffer
+        self._index = index
+        self._tags = tags
+        self._entries: Dict[uuid.UUID, QuestionEntry] = {}
+
+    def __getitem__(self, question_id: uuid.UUID) -> QuestionEntry:
+        entry = self._entries.get(question_id)
+        if entry is None:
+            offset, length = self._index[question_id]
+            entry = self._entries[question_id] = self._decode(question_id, self._buffer[offset:offset + length])
+        return entry
+
+    def _decode(self, question_id: uuid.UUID, data: bytes) -> QuestionEntry:
+        title, description, default_code, level, tags, test_cases, assertions = json.loads(data)
+        return QuestionEntry(
+            id=question_id, title=title, description=description, default_code=default_code, level=level,
+            tags=tuple(self._tags[uuid.UUID(t)] for t in tags),
+            test_cases=tuple(TestCaseEntry(input=i, expected=e) for i, e in test_cases),
+            assertions=tuple(AssertionEntry(id=uuid.UUID(a), question_id=question_id, assertion=assertion,
+                                            message=message, tags=tuple(self._tags[uuid.UUID(t)] for t in a_tags))
+                             for a, assertion, message, a_tags in assertions))
+
+    def __contains__(self, question_id) -> bool:
+        return question_id in self._index
+
+    def __iter__(self) -> Iterator[uuid.UUID]:
+        return iter(self._index)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+
+class _Assertions(Mapping):
+    def __init__(self, questions: _Questions, index: Dict[uuid.UUID, uuid.UUID]):
+        self._questions = questions
+        self._index = index
+
+    def __getitem__(self, assertion_id: uuid.UUID) -> AssertionEntry:
+        return next(a for a in self._questions[self._index[assertion_id]].assertions if a.id == assertion_id)
+
+    def __contains__(self, assertion_id) -> bool:
+        return assertion_id in self._index
+
+    def __iter__(self) -> Iterator[uuid.UUID]:
+        return iter(self._index)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+
+class MappedCatalog(Catalog):
+    """A catalog read from a memory-mapped snapshot.
+
+    Only the header, tags, facets and indexes are decoded when the file is opened; a question is decoded the first
+    time it is looked up. The pages themselves come from the page cache, so every worker mapping the same file shares
+    them. ``index`` is built from the facets, so filtering and paging decode only the questions on the page, but the
+    full question list renders, and so decodes and keeps, every question in each worker that serves it.
+    """
+
+    def __init__(self, buffer: mmap.mmap):
+        magic, version, question_count, assertion_count, tags_length, facets_length = HEADER.unpack_from(buffer)
+        if magic != MAGIC:
+            raise ValueError('not a catalog snapshot')
+        position = HEADER.size
+        self.tags = {uuid.UUID(id_): TagEntry(id=uuid.UUID(id_), name=name, tutorial_link=link)
+                     for id_, name, link in json.loads(buffer[position:position + tags_length])}
+        position += tags_length
+        facets = json.loads(buffer[position:position + facets_length])
+        position += facets_length
+
+        question_ids, index = [], {}
+        for id_bytes, offset, length in QUESTION_INDEX.iter_unpack(
+                buffer[position:position + QUESTION_INDEX.size * question_count]):
+            question_id = uuid.UUID(bytes=id_bytes)
+            question_ids.append(question_id)
+            index[question_id] = (offset, length)
+        position += QUESTION_INDEX.size * question_count
+
+        tags = list(self.tags.values())
+        self._facets = [_Facets(question_id, level, tuple(tags[t] for t in ordinals))
+                        for question_id, (level, ordinals) in zip(question_ids, facets)]
+        self.version = version
+        self.questions = _Questions(buffer, index, self.tags)
+        self.assertions = _Assertions(self.questions, {
+            uuid.UUID(bytes=id_bytes): question_ids[ordinal] for id_bytes, ordinal in
+            ASSERTION_INDEX.iter_unpack(buffer[position:position + ASSERTION_INDEX.size * assertion_count])
+        })
+
+    @cached_property
+    def index(self) -> QuestionIndex:
+        return QuestionIndex(self._facets)
+
+
+class SnapshotFile:
+    """Maps the snapshot at ``path`` and maps it again whenever the file is replaced."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._identity = None
+        self._catalog: Optional[MappedCatalog] = None
+
+    def open(self, version: int) -> Optional[MappedCatalog]:
+        """Return the mapped catalog if the file holds catalog ``version``, None when it is missing or stale."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        identity = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        if identity != self._identity:
+            try:
+                with open(self.path, 'rb') as f:
+                    # the mapping stays valid after the descriptor is closed, and after the path is replaced
+                    self._catalog = MappedCatalog(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            except ValueError:
+                self._catalog = None  # empty, or written in an earlier format; stale until build-snapshot runs
+            self._identity = identity
+        return self._catalog if self._catalog is not None and self._catalog.version == version else None
@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import time
+import uuid
+from typing import List, Optional, Tuple
+
+from fastapi import HTTPException, status
+
+import app.config
+from app import metrics
+from app.catalog import catalog_cache
+from app.controller import build_answers, validate_answer, write_answers
+from app.models import Answer, AsyncWriteSessionLocal
+from app.shards import shards
+
+logger = logging.getLogger(__name__)
+
+BUFFERED = 'buffered'
+COMMITTED = 'committed'
+
+
+class _Pending:
+    __slots__ = ('answer', 'failed_assertions', 'done')
+
+    def __init__(self, answer: Answer, failed_assertions: List[uuid.UUID], done: Optional[asyncio.Future]):
+        self.answer = answer
+        self.failed_assertions = failed_assertions
+        self.done = done
+
+
+class AnswerBuffer:
+    """Queue of validated answers written by a background task in group commits.
+
+    With ``buffered`` durability a request is acknowledged once its answer is queued, so a crash loses what has not
+    been flushed yet and a read right after the acknowledgement may not see it. With ``committed`` durability the
+    request waits until the group commit holding its answer is done; it still shares that commit with every other
+    answer queued in the meantime.
+
+    Answers are validated against the catalog when they are submitted and written against the catalog current at the
+    flush, which a fixture load may have changed in between: failed assertions that are gone are left out, and an
+    answer to a question that is gone is counted as stale and not written.
+    """
+
+    def __init__(self, session_factory=AsyncWriteSessionLocal, max_size: int = 10000, batch_size: int = 500,
+                 interval: float = 0.05, durability: str = BUFFERED):
+        if durability not in (BUFFERED, COMMITTED):
+            raise ValueError(f'unknown durability level {durability!r}')
+        self.session_factory = session_factory
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.interval = interval
+        self.durability = durability
+        self.flushed = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.stale = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._accepting = False
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def render(self) -> str:
+        return '\n'.join([
+            '# HELP dinagon_answer_buffer_depth Answers queued for the next group commit.',
+            '# TYPE dinagon_answer_buffer_depth gauge',
+            f'dinagon_answer_buffer_depth {self.depth}',
+            '# HELP dinagon_answer_buffer_answers_total Answers leaving the write-behind buffer by outcome.',
+            '# TYPE dinagon_answer_buffer_answers_total counter',
+            f'dinagon_answer_buffer_answers_total{{outcome="flushed"}} {self.flushed}',
+            f'dinagon_answer_buffer_answers_total{{outcome="dropped"}} {self.dropped}',
+            f'dinagon_answer_buffer_answers_total{{outcome="rejected"}} {self.rejected}',
+            f'dinagon_answer_buffer_answers_total{{outcome="stale"}} {self.stale}',
+        ]) + '\n'
+
+    def start(self):
+        self._queue = asyncio.Queue(self.max_size)
+        self._task = asyncio.ensure_future(self._run())
+        self._accepting = True
+        metrics.register(self.render)
+
+    async def close(self):
+        """Stop accepting answers and wait until everything queued is written."""
+        if self._task is None:
+            return
+        self._accepting = False
+        await self._queue.join()
+        self._task.cancel()
+        self._task = None
+
+    async def submit(self, user_id: uuid.UUID, question_id: uuid.UUID, is_correct: bool,
+                     failed_assertions: List[uuid.UUID], is_assertion_used: bool, session):
+        catalog = await catalog_cache.get(session)
+        error = validate_answer(question_id, failed_assertions, catalog)
+        if error:
+            raise HTTPException(error)
+        if not self._accepting:
+            raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, headers={'Retry-After': '1'})
+
+        [(answer, failed)] = build_answers(user_id, [(question_id, is_correct, failed_assertions)], is_assertion_used)
+        done = asyncio.get_event_loop().create_future() if self.durability == COMMITTED else None
+        try:
+            self._queue.put_nowait(_Pending(answer, failed, done))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, headers={'Retry-After': '1'})
+        if done is not None:
+            await done
+
+    async def _collect(self) -> List[_Pending]:
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _write(self, batch: List[_Pending]) -> List[_Pending]:
+        """Write ``batch`` in one commit; returns the answers left out because their question left the catalog."""
+        async with self.session_factory() as session:
+            shards.route_user(session, batch[0].answer.user)
+            catalog = await catalog_cache.get(session)
+            # queued answers are templates; fresh instances keep a failed attempt from leaving state behind
+            answers = [(Answer(id=p.answer.id, user=p.answer.user, question=p.answer.question,
+                               is_correct=p.answer.is_correct, use_assertions=p.answer.use_assertions,
+                               timestamp=p.answer.timestamp),
+                        [a for a in p.failed_assertions if a in catalog.assertions])
+                       for p in batch if p.answer.question in catalog.questions]
+            if answers:
+                await write_answers(answers, catalog, session)
+                await session.commit()
+            return [p for p in batch if p.answer.question not in catalog.questions]
+
+    async def _flush(self, batch: List[_Pending]):
+        # a commit covers one shard, so each shard's answers succeed or fail on their own, side by side
+        by_shard = {}
+        for p in batch:
+            by_shard.setdefault(shards.index(p.answer.user), []).append(p)
+        await asyncio.gather(*[self._flush_shard(pending) for pending in by_shard.values()])
+
+    async def _flush_shard(self, batch: List[_Pending]):
+        try:
+            stale = await self._write(batch)
+            groups: List[Tuple[List[_Pending], Optional[BaseException]]] = [(batch, None)]
+        except Exception:
+            # one bad answer must not cost the whole group: retry user by user and drop what still fails
+            logger.exception('group commit of %d answers failed, retrying per user', len(batch))
+            by_user = {}
+            for p in batch:
+                by_user.setdefault(p.answer.user, []).append(p)
+            groups, stale = [], []
+            for pending in by_user.values():
+                try:
+                    stale.extend(await self._write(pending))
+                    groups.append((pending, None))
+                except Exception as e:
+                    logger.exception('dropped %d answers of user %s', len(pending), pending[0].answer.user)
+                    self.dropped += len(pending)
+                    groups.append((pending, e))
+
+        if stale:
+            logger.warning('dropped %d answers to questions no longer in the catalog', len(stale))
+            self.stale += len(stale)
+        stale = set(stale)
+        for pending, error in groups:
+            if error is None:
+                self.flushed += sum(p not in stale for p in pending)
+            for p in pending:
+                if p.done is None or p.done.done():
+                    continue
+                if error is not None:
+                    p.done.set_exception(HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE))
+                elif p in stale:
+                    p.done.set_exception(HTTPException(status.HTTP_404_NOT_FOUND))
+                else:
+                    p.done.set_result(None)
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            try:
+                await self._flush(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+
+answer_buffer = AnswerBuffer(max_size=app.config.WRITE_BEHIND_QUEUE_SIZE,
+                             batch_size=app.config.WRITE_BEHIND_BATCH_SIZE,
+                             interval=app.config.WRITE_BEHIND_INTERVAL,
+                             durability=app.config.WRITE_BEHIND_DURABILITY)
@@ -1,17 +1,18 @@
 import uvicorn
 
-from app.config import HOST, PORT, IS_DEV
-from app.models import create_database, clear_database
-from testing.load_fixture import load
-
-from sqlalchemy.exc import IntegrityError
+from app.config import HOST, PORT, IS_DEV, CATALOG_SNAPSHOT
+from app.maintenance import build_snapshot
+from app.models import create_database
+from testing.load_fixture import LegacyCatalogError, load, report
 
 if __name__ == '__main__':
-    clear_database()
     create_database()
     if IS_DEV:
         try:
-            load()
-        except IntegrityError:
-            pass
+            report(load(), dry_run=False)
+        except LegacyCatalogError as e:
+            raise SystemExit(f'{e}; run `python -m testing.load_fixture --prune` first')
+    if CATALOG_SNAPSHOT:
+        # compiled once here, then memory-mapped by every worker instead of each loading the tables
+        build_snapshot(CATALOG_SNAPSHOT)
     uvicorn.run(app='app.routes:app', reload=True, host=HOST, port=PORT, workers=2)
@@ -0,0 +1,149 @@
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+import uuid
+
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker, lazyload
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.sql import func
+
+from app import controller
+from app.catalog import catalog_cache
+from app.models import Base, User, Question, Assertion, TestCase, Tag, Answer
+
+
+def populate(session, questions: int, assertions: int):
+    tags = [Tag(name=f'tag{i}', tutorial_link='') for i in range(8)]
+    session.add_all(tags)
+    question_ids = []
+    for i in range(questions):
+        q = Question(id=uuid.uuid4(), title=f'question {i}', description='', default_code='', level=i % 5,
+                     test_cases=[TestCase(input='()', expected='0') for _ in range(3)],
+                     assertions=[Assertion(assertion='true', message='', tags=[tags[(i + j) % len(tags)]])
+                                 for j in range(assertions)],
+                     tags=[tags[i % len(tags)]])
+        session.add(q)
+        question_ids.append(q.id)
+    session.commit()
+    return question_ids
+
+
+def blocking_get_question(user, question_id, session):
+    answered_correctly = session.query(func.max(Answer.is_correct), Answer.question) \
+        .filter(Answer.user == user.id) \
+        .group_by(Answer.question) \
+        .subquery()
+    q, *ans = session.query(Question, answered_correctly) \
+        .outerjoin(answered_correctly, answered_correctly.c.question == Question.id) \
+        .filter(Question.id == question_id) \
+        .options(lazyload(Question.assertions).lazyload(Assertion.tags)) \
+        .one_or_none()
+    [(a.id, [t.id for t in a.tags]) for a in q.assertions]
+    return q, ans[0] is True
+
+
+def blocking_create_answer(user, question_id, is_correct, session):
+    question = session.query(Question).get(question_id)
+    session.add(Answer(user=user.id, question=question.id, is_correct=is_correct, use_assertions=True))
+    session.commit()
+
+
+async def blocking_request(sync_session, user, question_id, write):
+    session = sync_session()
+    try:
+        blocking_get_question(user, question_id, session)
+        if write:
+            blocking_create_answer(user, question_id, False, session)
+    finally:
+        session.close()
+
+
+async def async_request(async_session, user, question_id, write):
+    async with async_session() as session:
+        catalog = await catalog_cache.get(session)
+        catalog.questions[question_id], await controller.is_solved(user.id, question_id, session)
+        if write:
+            await controller.create_answer(user.id, question_id, False, [], True, session)
+
+
+async def drive(handler, factory, users, question_ids, requests: int, concurrency: int, write_every: int):
+    latencies = []
+    queue = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(i)
+
+    async def worker():
+        while not queue.empty():
+            i = queue.get_nowait()
+            start = time.perf_counter()
+            await handler(factory, users[i % len(users)], question_ids[i % len(question_ids)],
+                          write_every and i % write_every == 0)
+            latencies.append(time.perf_counter() - start)
+
+    lags = []
+    done = asyncio.Event()
+
+    async def probe():
+        # how late a 1ms timer fires is what every other in-flight request on the worker waits
+        while not done.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags.append(time.perf_counter() - start - 0.001)
+
+    probing = asyncio.ensure_future(probe())
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    done.set()
+    await probing
+    latencies.sort()
+    lags.sort()
+    return {'throughput': requests / elapsed,
+            'p50': statistics.median(latencies) * 1000,
+            'p99': latencies[int(len(latencies) * 0.99) - 1] * 1000,
+            'lag': lags[int(len(lags) * 0.99) - 1] * 1000}
+
+
+async def bench(args):
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'bench.db')
+    engine = create_engine(f'sqlite:///{path}', connect_args={'check_same_thread': False})
+    Base.metadata.create_all(engine)
+    sync_session = sessionmaker(bind=engine)
+
+    session = sync_session(expire_on_commit=False)
+    question_ids = populate(session, args.questions, args.assertions)
+    users = [User(id=uuid.uuid4()) for _ in range(args.users)]
+    session.add_all(users)
+    session.commit()
+    session.close()
+
+    async_engine = create_async_engine(f'sqlite+aiosqlite:///{path}', poolclass=AsyncAdaptedQueuePool)
+    async_session = sessionmaker(bind=async_engine, class_=AsyncSession, expire_on_commit=False)
+
+    for name, handler, factory in (('blocking', blocking_request, sync_session),
+                                   ('async', async_request, async_session)):
+        result = await drive(handler, factory, users, question_ids, args.requests, args.concurrency,
+                             args.write_every)
+        print(f'{name:>8}: {result["throughput"]:8.1f} req/s  '
+              f'p50 {result["p50"]:7.2f} ms  p99 {result["p99"]:7.2f} ms  '
+              f'loop lag p99 {result["lag"]:7.2f} ms')
+
+    await async_engine.dispose()
+    engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compare the blocking and the async database path')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--questions', type=int, default=50)
+    parser.add_argument('--assertions', type=int, default=5)
+    parser.add_argument('--write-every', type=int, default=5, help='every n-th request also posts an answer')
+    asyncio.run(bench(parser.parse_args()))
@@ -0,0 +1,83 @@
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+import uuid
+
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from app import controller
+from app.catalog import catalog_cache
+from app.models import Base, User
+from testing.bench_async import populate
+
+
+def replay(catalog, users, answers: int):
+    """Answers grouped per user, in submission order, as an offline client would upload them."""
+    questions = list(catalog.questions.values())
+    result = {user.id: [] for user in users}
+    for _ in range(answers):
+        q, is_correct = random.choice(questions), random.random() < 0.3
+        failed = [] if is_correct else [a.id for a in random.sample(q.assertions, random.randint(0, 2))]
+        result[random.choice(users).id].append((q.id, is_correct, failed))
+    return result
+
+
+async def single(async_session, items):
+    for user_id, answers in items.items():
+        for question_id, is_correct, failed in answers:
+            async with async_session() as session:
+                await controller.create_answer(user_id, question_id, is_correct, failed, True, session)
+
+
+async def batched(async_session, items, batch_size: int):
+    for user_id, answers in items.items():
+        for offset in range(0, len(answers), batch_size):
+            async with async_session() as session:
+                await controller.create_answers(user_id, answers[offset:offset + batch_size], True, session)
+
+
+async def bench(args):
+    random.seed(args.seed)
+    runs = [('single', lambda factory, items: single(factory, items))] + \
+           [(f'batch {size}', lambda factory, items, size=size: batched(factory, items, size))
+            for size in args.batch_sizes]
+
+    for name, run in runs:
+        path = os.path.join(tempfile.mkdtemp(), 'batch.db')
+        engine = create_engine(f'sqlite:///{path}')
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine, expire_on_commit=False)()
+        populate(session, args.questions, args.assertions)
+        users = [User(id=uuid.uuid4()) for _ in range(args.users)]
+        session.add_all(users)
+        session.commit()
+        session.close()
+        engine.dispose()
+
+        async_engine = create_async_engine(f'sqlite+aiosqlite:///{path}')
+        async_session = sessionmaker(bind=async_engine, class_=AsyncSession, expire_on_commit=False)
+        catalog_cache.invalidate()
+        async with async_session() as session:
+            items = replay(await catalog_cache.get(session), users, args.answers)
+
+        start = time.perf_counter()
+        await run(async_session, items)
+        elapsed = time.perf_counter() - start
+        print(f'{name:>12}: {args.answers / elapsed:9.1f} answers/s  ({elapsed:.2f}s)')
+        await async_engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compare posting answers one by one with the batch endpoint')
+    parser.add_argument('--answers', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--questions', type=int, default=50)
+    parser.add_argument('--assertions', type=int, default=5)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--seed', type=int, default=0)
+    asyncio.run(bench(parser.parse_args()))
@@ -0,0 +1,122 @@
+import argparse
+import datetime
+import os
+import random
+import tempfile
+import time
+import uuid
+
+from sqlalchemy import create_engine
+
+from app.maintenance import create_indexes, migrate_keys
+from app.models import Base
+
+QUERIES = {
+    'solved questions of a user': ('SELECT question, max(is_correct) FROM answers WHERE user = ? GROUP BY question',
+                                   lambda d: (d.key(random.choice(d.users)),)),
+    'correct answer exists': ('SELECT 1 FROM answers WHERE user = ? AND question = ? AND is_correct = 1 LIMIT 1',
+                              lambda d: (d.key(random.choice(d.users)), d.key(random.choice(d.questions)))),
+    'answers failing an assertion': ('SELECT count(*) FROM answer_assertion_relation WHERE assertion_id = ?',
+                                     lambda d: (d.key(random.choice(d.assertions)),)),
+    'assertions of a question': ('SELECT id FROM assertions WHERE question_id = ?',
+                                 lambda d: (d.key(random.choice(d.questions)),)),
+}
+
+
+class Dataset:
+    def __init__(self, users: int, questions: int, assertions: int):
+        self.users = [uuid.uuid4() for _ in range(users)]
+        self.questions = [uuid.uuid4() for _ in range(questions)]
+        self.question_assertions = {q: [uuid.uuid4() for _ in range(assertions)] for q in self.questions}
+        self.assertions = [a for q in self.questions for a in self.question_assertions[q]]
+        self.binary = False
+
+    def key(self, value: uuid.UUID):
+        return value.bytes if self.binary else value.hex
+
+
+def populate(connection, data: Dataset, answers: int, batch_size: int = 50000):
+    key = data.key
+    connection.exec_driver_sql('INSERT INTO users (id) VALUES (?)', [(key(u),) for u in data.users])
+    connection.exec_driver_sql(
+        'INSERT INTO questions (id, title, description, default_code, level) VALUES (?, ?, ?, ?, ?)',
+        [(key(q), 'title', 'description', '', 1) for q in data.questions])
+    connection.exec_driver_sql('INSERT INTO assertions (id, assertion, message, question_id) VALUES (?, ?, ?, ?)',
+                               [(key(a), 'true', 'message', key(q))
+                                for q, assertions in data.question_assertions.items() for a in assertions])
+    start = datetime.datetime(2021, 4, 1)
+    for offset in range(0, answers, batch_size):
+        rows, failures = [], []
+        for i in range(offset, min(offset + batch_size, answers)):
+            answer_id, question = uuid.uuid4(), random.choice(data.questions)
+            is_correct = random.random() < 0.3
+            rows.append((key(answer_id), key(random.choice(data.users)), key(question), is_correct, True,
+                         start + datetime.timedelta(seconds=i)))
+            if not is_correct:
+                failures.append((key(answer_id), key(random.choice(data.question_assertions[question]))))
+        connection.exec_driver_sql('INSERT INTO answers (id, user, question, is_correct, use_assertions, timestamp) '
+                                   'VALUES (?, ?, ?, ?, ?, ?)', rows)
+        connection.exec_driver_sql('INSERT INTO answer_assertion_relation (answer_id, assertion_id) VALUES (?, ?)',
+                                   failures)
+
+
+def measure(engine, data: Dataset, queries: int) -> dict:
+    with engine.connect() as connection:
+        connection.exec_driver_sql('ANALYZE')
+        results = {}
+        for name, (statement, parameters) in QUERIES.items():
+            start = time.perf_counter()
+            for _ in range(queries):
+                connection.exec_driver_sql(statement, parameters(data)).fetchall()
+            results[name] = (time.perf_counter() - start) / queries * 1000
+    return results
+
+
+def size_of(engine, path: str) -> float:
+    with engine.connect() as connection:
+        connection.exec_driver_sql('VACUUM')
+    return os.path.getsize(path) / 1024 / 1024
+
+
+def bench(args):
+    random.seed(args.seed)
+    path = os.path.join(tempfile.mkdtemp(), 'keys.db')
+    engine = create_engine(f'sqlite:///{path}')
+    Base.metadata.create_all(engine)
+    data = Dataset(args.users, args.questions, args.assertions)
+
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                connection.exec_driver_sql(f'DROP INDEX "{index.name}"')
+        start = time.perf_counter()
+        populate(connection, data, args.answers)
+        print(f'inserted {args.answers} answers in {time.perf_counter() - start:.1f}s')
+
+    phases = [('text keys, no indexes', measure(engine, data, args.queries), size_of(engine, path))]
+
+    create_indexes(engine)
+    phases.append(('text keys, indexed', measure(engine, data, args.queries), size_of(engine, path)))
+
+    start = time.perf_counter()
+    migrate_keys(engine, binary=True)
+    print(f'migrated keys to binary in {time.perf_counter() - start:.1f}s')
+    data.binary = True
+    phases.append(('binary keys, indexed', measure(engine, data, args.queries), size_of(engine, path)))
+
+    print(f'{"ms per query":<30}' + ''.join(f'{phase:>24}' for phase, _, _ in phases))
+    for name in QUERIES:
+        print(f'{name:<30}' + ''.join(f'{result[name]:>24.3f}' for _, result, _ in phases))
+    print(f'{"database size (MiB)":<30}' + ''.join(f'{size:>24.1f}' for _, _, size in phases))
+    engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compare text and binary UUID keys with and without indexes')
+    parser.add_argument('--answers', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--questions', type=int, default=200)
+    parser.add_argument('--assertions', type=int, default=5)
+    parser.add_argument('--queries', type=int, default=100, help='timed executions of each query per phase')
+    parser.add_argument('--seed', type=int, default=0)
+    bench(parser.parse_args())
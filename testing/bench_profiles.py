@@ -0,0 +1,121 @@
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+import uuid
+
+from fastapi import HTTPException
+from sqlalchemy import create_engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from app import controller
+from app.catalog import catalog_cache
+from app.models import Base, User
+from app.profiles import (SQLITE, MYSQL, sync_engine_options, async_engine_options, apply_sqlite_pragmas,
+                          sqlite_pragmas)
+from testing.bench_async import populate
+
+
+def setup(sync_url: str, profile: str, questions: int, users: int):
+    engine = create_engine(sync_url, **sync_engine_options(profile))
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine, expire_on_commit=False)()
+    question_ids = populate(session, questions, 5)
+    user_ids = [uuid.uuid4() for _ in range(users)]
+    session.add_all([User(id=user_id) for user_id in user_ids])
+    session.commit()
+    session.close()
+    engine.dispose()
+    return question_ids, user_ids
+
+
+def sessions(async_url: str, profile: str, tuned: bool):
+    """(read session factory, write session factory, engines) as app/models.py builds them, or the old setup."""
+    if not tuned:
+        engine = create_async_engine(async_url, pool_recycle=60, poolclass=AsyncAdaptedQueuePool)
+        factory = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+        return factory, factory, [engine]
+    reader = create_async_engine(async_url, **async_engine_options(profile))
+    writer = reader if profile != SQLITE else create_async_engine(async_url, **async_engine_options(profile, True))
+    if profile == SQLITE:
+        for e in {reader, writer}:
+            apply_sqlite_pragmas(e.sync_engine, sqlite_pragmas())
+    return (sessionmaker(bind=reader, class_=AsyncSession, expire_on_commit=False),
+            sessionmaker(bind=writer, class_=AsyncSession, expire_on_commit=False), list({reader, writer}))
+
+
+async def drive(read_session, write_session, user_ids, question_ids, args):
+    """The question detail reads and answer writes of a client, in a fixed proportion."""
+    latencies, failed = [], 0
+    queue = asyncio.Queue()
+    for i in range(args.requests):
+        queue.put_nowait(i)
+
+    async def worker():
+        nonlocal failed
+        while not queue.empty():
+            i = queue.get_nowait()
+            user_id, question_id = user_ids[i % len(user_ids)], random.choice(question_ids)
+            write = random.random() < args.writes
+            start = time.perf_counter()
+            try:
+                async with (write_session if write else read_session)() as session:
+                    if write:
+                        await controller.create_answer(user_id, question_id, random.random() < 0.3, [], True,
+                                                       session)
+                    else:
+                        await catalog_cache.get(session)
+                        await controller.get_progress_version(user_id, session)
+                        await controller.is_solved(user_id, question_id, session)
+            except (DBAPIError, HTTPException):
+                failed += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {'throughput': args.requests / elapsed, 'p50': statistics.median(latencies) * 1000,
+            'p99': latencies[int(len(latencies) * 0.99) - 1] * 1000, 'failed': failed}
+
+
+async def bench(args):
+    random.seed(args.seed)
+    path = os.path.join(tempfile.mkdtemp(), 'profiles.db')
+    runs = [('sqlite (old)', SQLITE, f'sqlite:///{path}', f'sqlite+aiosqlite:///{path}', False),
+            ('sqlite profile', SQLITE, f'sqlite:///{path}', f'sqlite+aiosqlite:///{path}', True)]
+    if args.mysql:
+        runs.append(('mysql profile', MYSQL, f'mysql+mysqldb://{args.mysql}?charset=utf8mb4',
+                     f'mysql+aiomysql://{args.mysql}?charset=utf8mb4', True))
+
+    print(f'{args.requests} requests, {args.concurrency} concurrent, {args.writes:.0%} answer writes')
+    for name, profile, sync_url, async_url, tuned in runs:
+        if profile == SQLITE and os.path.exists(path):
+            os.remove(path)
+        question_ids, user_ids = setup(sync_url, profile, args.questions, args.users)
+        read_session, write_session, engines = sessions(async_url, profile, tuned)
+        catalog_cache.invalidate()
+        result = await drive(read_session, write_session, user_ids, question_ids, args)
+        print(f'{name:>15}: {result["throughput"]:8.1f} req/s  p50 {result["p50"]:7.2f} ms  '
+              f'p99 {result["p99"]:7.2f} ms  failed {result["failed"]:5}')
+        for engine in engines:
+            await engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='run one read/write workload against each database profile')
+    parser.add_argument('--mysql', help='user:password@host:port/database of a scratch MySQL database to include')
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--writes', type=float, default=0.2, help='fraction of requests that post an answer')
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--questions', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    asyncio.run(bench(parser.parse_args()))
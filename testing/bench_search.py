@@ -0,0 +1,56 @@
+import argparse
+import dataclasses
+import random
+import statistics
+import time
+
+from app.catalog import Catalog
+from app.search import SearchIndex
+from testing.bench_payloads import synthetic_catalog
+
+QUERIES = ('question 12', '加算', '足し合わせ', '関数を定義')
+
+
+def timed(call, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1000
+
+
+def bench(args):
+    print(f'build, incremental rebuild after changing {args.changed:.0%} of the questions, and median query times')
+    for size in args.questions:
+        random.seed(args.seed)
+        catalog = synthetic_catalog(size, args.assertions)
+        catalog.index
+        start = time.perf_counter()
+        index = SearchIndex(catalog)
+        built = (time.perf_counter() - start) * 1000
+
+        questions = dict(catalog.questions)
+        for question_id in random.sample(list(questions), max(1, int(size * args.changed))):
+            questions[question_id] = dataclasses.replace(questions[question_id],
+                                                         description=questions[question_id].description + ' for文')
+        changed = Catalog(2, questions, catalog.tags)
+        changed.index
+        start = time.perf_counter()
+        SearchIndex(changed, index)
+        rebuilt = (time.perf_counter() - start) * 1000
+
+        # _search skips the cache of recent queries that serves the following pages
+        queries = '   '.join(f'{query!r} {timed(lambda: index._search(query), args.repeat):6.2f} ms '
+                               f'({len(index.search(query))})' for query in QUERIES)
+        print(f'{size:>6} questions: build {built:7.1f} ms   rebuild {rebuilt:7.1f} ms   {queries}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='GET /question/search: index build and query times')
+    parser.add_argument('--questions', type=int, nargs='+', default=[100, 1000, 5000])
+    parser.add_argument('--assertions', type=int, default=5)
+    parser.add_argument('--changed', type=float, default=0.01)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    bench(parser.parse_args())
@@ -0,0 +1,112 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import statistics
+import tempfile
+import time
+import uuid
+
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from app import controller
+from app.models import Base, Answer
+from app.profiles import SQLITE, async_engine_options, apply_sqlite_pragmas, sqlite_pragmas
+from app.shards import shards, shard_uri
+from testing.bench_async import populate
+
+
+async def drive(session_factory, user_ids, question_ids, requests: int, concurrency: int):
+    latencies, failed = [], 0
+    queue = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(i)
+
+    async def worker():
+        nonlocal failed
+        while not queue.empty():
+            i = queue.get_nowait()
+            start = time.perf_counter()
+            try:
+                async with session_factory() as session:
+                    await controller.create_answer(user_ids[i % len(user_ids)], random.choice(question_ids),
+                                                   random.random() < 0.3, [], True, session)
+            except DBAPIError:
+                failed += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {'throughput': requests / elapsed, 'p50': statistics.median(latencies) * 1000,
+            'p99': latencies[int(len(latencies) * 0.99) - 1] * 1000, 'failed': failed}
+
+
+async def run_worker(path: str, count: int, question_ids, requests: int, concurrency: int, users: int, seed: int):
+    random.seed(seed)
+    shards.configure(count, f'sqlite:///{path}', f'sqlite+aiosqlite:///{path}', SQLITE)
+    # without shards the main database takes the writes, through the single writer connection of the profile
+    main = create_async_engine(f'sqlite+aiosqlite:///{path}', **async_engine_options(SQLITE, writer=count == 1))
+    apply_sqlite_pragmas(main.sync_engine, sqlite_pragmas())
+    session_factory = sessionmaker(bind=main, class_=AsyncSession, expire_on_commit=False, info={'writer': True})
+    try:
+        return await drive(session_factory, [uuid.uuid4() for _ in range(users)], question_ids, requests,
+                           concurrency)
+    finally:
+        await shards.dispose()
+        await main.dispose()
+
+
+def worker_process(arguments):
+    return asyncio.run(run_worker(*arguments))
+
+
+def bench(args):
+    print(f'{args.requests} answers from {args.processes} processes, {args.concurrency} concurrent requests and '
+          f'{args.users} users each')
+    for count in args.shards:
+        path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+        engine = create_engine(f'sqlite:///{path}')
+        Base.metadata.create_all(engine)
+        question_ids = populate(sessionmaker(bind=engine)(), args.questions, 5)
+        engine.dispose()
+        shards.configure(count, f'sqlite:///{path}', f'sqlite+aiosqlite:///{path}', SQLITE)
+        shards.create_all()
+        asyncio.run(shards.dispose())
+
+        # separate processes, like uvicorn workers: each has its own connections and contends for the same files
+        start = time.perf_counter()
+        with multiprocessing.get_context('spawn').Pool(args.processes) as pool:
+            results = pool.map(worker_process, [(path, count, question_ids, args.requests // args.processes,
+                                                 args.concurrency, args.users, args.seed + i)
+                                                for i in range(args.processes)])
+        elapsed = time.perf_counter() - start
+
+        stored = 0
+        for uri in [shard_uri(f'sqlite:///{path}', i, count) for i in range(count)] if count > 1 \
+                else [f'sqlite:///{path}']:
+            engine = create_engine(uri)
+            with engine.connect() as connection:
+                stored += connection.execute(select(func.count()).select_from(Answer)).scalar()
+            engine.dispose()
+        print(f'{count:>2} shard(s): {stored / elapsed:8.1f} answers/s  '
+              f'p50 {statistics.median(r["p50"] for r in results):7.2f} ms  '
+              f'p99 {max(r["p99"] for r in results):7.2f} ms  failed {sum(r["failed"] for r in results):4}  '
+              f'stored {stored}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='answer write throughput over a growing number of shards')
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--users', type=int, default=250)
+    parser.add_argument('--questions', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    bench(parser.parse_args())
@@ -0,0 +1,94 @@
+import argparse
+import asyncio
+import mmap
+import os
+import tempfile
+import time
+import tracemalloc
+
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from app.catalog import load_catalog
+from app.models import Base
+from app.payloads import QuestionPayloads
+from app.snapshot import MappedCatalog, write_snapshot
+from testing.bench_async import populate
+
+
+def heap(build):
+    """What ``build`` returns and the Python heap bytes it still holds."""
+    tracemalloc.start()
+    result = build()
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, held
+
+
+def timed(build) -> float:
+    start = time.perf_counter()
+    build()
+    return time.perf_counter() - start
+
+
+async def bench(args):
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'bench.db')
+    sync_engine = create_engine(f'sqlite:///{path}')
+    Base.metadata.create_all(sync_engine)
+    populate(sessionmaker(bind=sync_engine)(), args.questions, args.assertions)
+
+    async_engine = create_async_engine(f'sqlite+aiosqlite:///{path}')
+    async_session = sessionmaker(bind=async_engine, class_=AsyncSession)
+    async with async_session() as session:
+        await load_catalog(session)  # warm the page cache so both sides read from memory
+        start = time.perf_counter()
+        await load_catalog(session)
+        db_seconds = time.perf_counter() - start
+        tracemalloc.start()
+        catalog = await load_catalog(session)
+        db_held = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    await async_engine.dispose()
+
+    snapshot = os.path.join(directory, 'catalog.snapshot')
+    start = time.perf_counter()
+    size = write_snapshot(catalog, snapshot)
+    build_seconds = time.perf_counter() - start
+
+    def open_snapshot():
+        with open(snapshot, 'rb') as f:
+            return MappedCatalog(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    # timed untraced first, since tracemalloc slows allocation-heavy code several times over
+    ids = list(catalog.questions)
+    open_seconds = timed(open_snapshot)
+    fresh = open_snapshot()
+    first_seconds = timed(lambda: fresh.questions[ids[0]])
+    all_seconds = timed(lambda: [fresh.questions[i] for i in ids])
+    mapped, open_held = heap(open_snapshot)
+    indexed = open_snapshot()
+    index_seconds = timed(lambda: indexed.index)
+    assert indexed.index.keys == catalog.index.keys and indexed.index.tags == catalog.index.tags, 'indexes differ'
+    assert not indexed.questions._entries, 'building the index decoded questions'
+    _, all_held = heap(lambda: [mapped.questions[i] for i in ids])
+
+    payloads = QuestionPayloads(catalog), QuestionPayloads(mapped)
+    assert payloads[0].question_list('t', set()) == payloads[1].question_list('t', set()), 'list payloads differ'
+    assert all(payloads[0].question(i, False) == payloads[1].question(i, False) for i in ids), 'payloads differ'
+
+    print(f'{args.questions} questions, {args.assertions} assertions each; snapshot {size / 1024:.0f} KiB, '
+          f'compiled in {build_seconds * 1000:.1f} ms')
+    print(f'{"load_catalog from the tables":<34} {db_seconds * 1000:8.1f} ms  {db_held / 1024:8.0f} KiB heap')
+    print(f'{"map the snapshot":<34} {open_seconds * 1000:8.1f} ms  {open_held / 1024:8.0f} KiB heap')
+    print(f'{"  index built from the facets":<34} {index_seconds * 1000:8.1f} ms')
+    print(f'{"  first question decoded":<34} {first_seconds * 1000:8.3f} ms')
+    print(f'{"  every question decoded":<34} {all_seconds * 1000:8.1f} ms  {all_held / 1024:8.0f} KiB heap')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compare loading the catalog per worker with mapping a snapshot')
+    parser.add_argument('--questions', type=int, default=1000)
+    parser.add_argument('--assertions', type=int, default=5)
+    asyncio.run(bench(parser.parse_args()))
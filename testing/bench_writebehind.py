@@ -0,0 +1,108 @@
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+import uuid
+
+from fastapi import HTTPException
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from app import controller
+from app.catalog import catalog_cache
+from app.models import Base, User, Answer
+from app.writebehind import AnswerBuffer, BUFFERED, COMMITTED
+from testing.bench_async import populate
+
+
+async def drive(post, async_session, users, question_ids, requests: int, concurrency: int):
+    latencies, rejected, failed = [], 0, 0
+    queue = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(i)
+
+    async def worker():
+        nonlocal rejected, failed
+        while not queue.empty():
+            i = queue.get_nowait()
+            start = time.perf_counter()
+            async with async_session() as session:
+                try:
+                    await post(users[i % len(users)], random.choice(question_ids), session)
+                except HTTPException:
+                    rejected += 1
+                except OperationalError:
+                    failed += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {'throughput': requests / elapsed, 'p50': statistics.median(latencies) * 1000,
+            'p99': latencies[int(len(latencies) * 0.99) - 1] * 1000, 'rejected': rejected,
+            'failed': failed}
+
+
+async def bench(args):
+    random.seed(args.seed)
+    modes = [('direct', None)] + [(durability, durability) for durability in (BUFFERED, COMMITTED)]
+    for name, durability in modes:
+        path = os.path.join(tempfile.mkdtemp(), 'writebehind.db')
+        engine = create_engine(f'sqlite:///{path}')
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine, expire_on_commit=False)()
+        question_ids = populate(session, args.questions, 5)
+        users = [User(id=uuid.uuid4()) for _ in range(args.users)]
+        session.add_all(users)
+        session.commit()
+        session.close()
+        engine.dispose()
+
+        async_engine = create_async_engine(f'sqlite+aiosqlite:///{path}', poolclass=AsyncAdaptedQueuePool)
+        async_session = sessionmaker(bind=async_engine, class_=AsyncSession, expire_on_commit=False)
+        catalog_cache.invalidate()
+
+        if durability is None:
+            buffer = None
+
+            async def post(user, question_id, session):
+                await controller.create_answer(user.id, question_id, False, [], True, session)
+        else:
+            buffer = AnswerBuffer(async_session, max_size=args.queue_size, batch_size=args.batch_size,
+                                  interval=args.interval, durability=durability)
+            buffer.start()
+
+            async def post(user, question_id, session):
+                await buffer.submit(user.id, question_id, False, [], True, session)
+
+        result = await drive(post, async_session, users, question_ids, args.requests, args.concurrency)
+        start = time.perf_counter()
+        if buffer is not None:
+            await buffer.close()
+        drained = time.perf_counter() - start
+        async with async_session() as session:
+            stored = (await session.execute(select(func.count()).select_from(Answer))).scalar()
+        print(f'{name:>10}: {result["throughput"]:8.1f} req/s  p50 {result["p50"]:7.2f} ms  '
+              f'p99 {result["p99"]:7.2f} ms  rejected {result["rejected"]:5}  failed {result["failed"]:5}  '
+              f'stored {stored:6}  shutdown flush {drained * 1000:6.1f} ms')
+        await async_engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compare committing every answer with the write-behind buffer')
+    parser.add_argument('--requests', type=int, default=3000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--questions', type=int, default=50)
+    parser.add_argument('--queue-size', type=int, default=10000)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--interval', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=0)
+    asyncio.run(bench(parser.parse_args()))
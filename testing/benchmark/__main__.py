@@ -0,0 +1,129 @@
+"""Reproducible load benchmark of the API.
+
+    python -m testing.benchmark run --users 2000 --requests 5000 --output before.json
+    python -m testing.benchmark run --users 2000 --requests 5000 --output after.json
+    python -m testing.benchmark compare before.json after.json
+
+The synthetic data and the sequence of requests only depend on the seeds, so two runs with the same arguments differ
+in the code and the machine, not in what they measure. The database of the configured profile is replaced: with the
+sqlite profile the run happens in a fresh directory, with mysql it needs --reset-database.
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+
+
+def _mix(text: str) -> dict:
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+async def run(args):
+    # imported here: the sqlite paths are relative to the working directory and JWT_SECRET is read on import
+    os.environ.setdefault('JWT_SECRET', 'benchmark')
+    import app.config
+    from app.auth import issue_token
+    from app.models import engine, async_engine, async_write_engine
+    from app.routes import app as api
+    from app.shards import shards
+    from testing.benchmark import report
+    from testing.benchmark.data import DataSpec, generate
+    from testing.benchmark.driver import LoadSpec, drive, OPERATIONS
+
+    if app.config.DATABASE_PROFILE != 'sqlite' and not args.reset_database:
+        raise SystemExit('this replaces every table of the configured database; pass --reset-database to proceed')
+    data_spec = DataSpec(users=args.users, questions=args.questions, assertions=args.assertions, answers=args.answers,
+                         skew=args.skew, retry=args.retry, seed=args.seed)
+    load_spec = LoadSpec(requests=args.requests, warmup=args.warmup, concurrency=args.concurrency, mix=args.mix,
+                         seed=args.seed)
+    unknown = set(load_spec.mix) - set(OPERATIONS)
+    if unknown:
+        raise SystemExit(f'unknown operations in --mix: {", ".join(sorted(unknown))}')
+
+    print(f'generating {args.users} users and {args.questions} questions in {os.getcwd()}', file=sys.stderr)
+    data = generate(data_spec)
+    print(f'{data.answers} answers in {data.seconds:.1f}s, running {args.warmup} + {args.requests} requests',
+          file=sys.stderr)
+    await api.router.startup()
+    try:
+        engines = {engine, async_engine.sync_engine, async_write_engine.sync_engine, *shards.all_engines()}
+        samples, elapsed, background = await drive(api, data, load_spec, engines, issue_token)
+    finally:
+        await api.router.shutdown()
+
+    settings = {'profile': app.config.DATABASE_PROFILE, 'shards': app.config.ANSWER_SHARDS,
+                'write_behind': app.config.WRITE_BEHIND}
+    load = {'requests': load_spec.requests, 'warmup': load_spec.warmup, 'concurrency': load_spec.concurrency,
+            'mix': load_spec.mix, 'seed': load_spec.seed}
+    result = report.build(samples, elapsed, background, data.describe(), load, settings)
+    print(report.render(result))
+    if args.output:
+        report.save(result, args.output)
+
+
+def compare(args):
+    from testing.benchmark import report
+
+    baseline, current = report.load(args.baseline), report.load(args.current)
+    for name in ('settings', 'data', 'load'):
+        differing = [k for k in baseline[name].keys() | current[name].keys()
+                     if k != 'generated_in' and baseline[name].get(k) != current[name].get(k)]
+        if differing:
+            print(f'warning: the runs differ in {name}: {", ".join(sorted(differing))}', file=sys.stderr)
+    regressions = report.compare(baseline, current, args.tolerance)
+    for line in regressions:
+        print(f'regression: {line}')
+    if not regressions:
+        print(f'no regressions beyond {args.tolerance:g}%')
+    raise SystemExit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m testing.benchmark', description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='generate data, replay the load and report latencies')
+    run_parser.add_argument('--users', type=int, default=500)
+    run_parser.add_argument('--questions', type=int, default=100)
+    run_parser.add_argument('--assertions', type=int, default=5, help='assertions per question')
+    run_parser.add_argument('--answers', type=float, default=30, help='average stored attempts per user')
+    run_parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent of question popularity')
+    run_parser.add_argument('--retry', type=float, default=0.6, help='chance that a failed question is retried')
+    run_parser.add_argument('--requests', type=int, default=5000, help='measured requests')
+    run_parser.add_argument('--warmup', type=int, default=200, help='requests before measuring')
+    run_parser.add_argument('--concurrency', type=int, default=50, help='requests in flight')
+    run_parser.add_argument('--mix', type=_mix, default='list=20,detail=40,answer=30,recommendation=10',
+                            help='relative weights of the operations')
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--directory', help='where the sqlite databases go (default: a new temporary directory)')
+    run_parser.add_argument('--reset-database', action='store_true',
+                            help='allow replacing the configured mysql database')
+    run_parser.add_argument('--output', help='write the report as JSON')
+
+    compare_parser = commands.add_parser('compare', help='fail if a report regressed against a baseline')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--tolerance', type=float, default=10, help='allowed slowdown in percent')
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        compare(args)
+    else:
+        if args.output:
+            args.output = os.path.abspath(args.output)
+        directory = args.directory or tempfile.mkdtemp(prefix='benchmark-')
+        os.makedirs(directory, exist_ok=True)
+        sys.path.insert(0, os.getcwd())
+        os.chdir(directory)
+        try:
+            asyncio.run(run(args))
+        finally:
+            if not args.directory:
+                os.chdir(sys.path[0])
+                shutil.rmtree(directory)
@@ -0,0 +1,163 @@
+import datetime
+import itertools
+import random
+import time
+import uuid
+from dataclasses import dataclass, asdict
+from typing import Dict, List
+
+from sqlalchemy import insert
+
+from app.maintenance import backfill_progress, check_tag_stats
+from app.models import (Base, User, Answer, Question, TestCase, Assertion, Tag, CatalogVersion, question_tag_relation,
+                        assertion_tag_relation, answer_assertion_relation, SessionLocal, clear_database,
+                        create_database)
+from app.shards import SHARDED_TABLES, shards
+
+
+@dataclass
+class DataSpec:
+    users: int = 500
+    questions: int = 100
+    assertions: int = 5
+    tags: int = 12
+    answers: float = 30  # attempts per user on average; activity is exponentially distributed over users
+    skew: float = 1.1  # Zipf exponent of question popularity, 0 for uniform
+    retry: float = 0.6  # chance that a failed question is attempted again
+    days: int = 30  # answers are spread over this many days before now
+    seed: int = 0
+
+
+@dataclass
+class Dataset:
+    spec: DataSpec
+    user_ids: List[uuid.UUID]
+    # most popular first, with the matching cumulative weights for random.choices
+    question_ids: List[uuid.UUID]
+    popularity: List[float]
+    assertion_ids: Dict[uuid.UUID, List[uuid.UUID]]
+    levels: Dict[uuid.UUID, int]
+    answers: int = 0
+    seconds: float = 0
+
+    def describe(self) -> dict:
+        return {**asdict(self.spec), 'stored_answers': self.answers, 'generated_in': round(self.seconds, 3)}
+
+
+def failure_rate(level: int) -> float:
+    return min(0.2 + 0.12 * level, 0.9)
+
+
+def _uuid(rng: random.Random) -> uuid.UUID:
+    return uuid.UUID(int=rng.getrandbits(128), version=4)
+
+
+def _catalog(spec: DataSpec, rng: random.Random, session) -> Dataset:
+    tags = [{'id': _uuid(rng), 'name': f'タグ{i}', 'tutorial_link': f'https://example.com/tutorial/{i}'}
+            for i in range(spec.tags)]
+    questions, test_cases, assertions, question_tags, assertion_tags = [], [], [], [], []
+    assertion_ids, levels = {}, {}
+    for i in range(spec.questions):
+        question_id = _uuid(rng)
+        level = 1 + i * 5 // max(spec.questions, 1)
+        levels[question_id] = level
+        questions.append({'id': question_id, 'title': f'問題 {i}', 'level': level,
+                          'description': f'{i}番目の問題です。2つの値を足し合わせた数字を返す関数を定義してください。',
+                          'default_code': 'function add(first, second) {\n    // your code here\n\n}'})
+        test_cases.extend({'id': _uuid(rng), 'question_id': question_id, 'input': f'({j}, {j})',
+                           'expected': str(2 * j)} for j in range(3))
+        question_tags.extend({'question_id': question_id, 'tag_id': t['id']} for t in rng.sample(tags, 2))
+        assertion_ids[question_id] = []
+        for j in range(spec.assertions):
+            assertion_id = _uuid(rng)
+            assertion_ids[question_id].append(assertion_id)
+            assertions.append({'id': assertion_id, 'question_id': question_id, 'assertion': f"'+' in code /* {j} */",
+                               'message': f'加算が行われていない可能性があります ({j})'})
+            assertion_tags.extend({'assertion_id': assertion_id, 'tag_id': t['id']}
+                                  for t in rng.sample(tags, 1 + (j % 2)))
+
+    for table, rows in ((Tag, tags), (Question, questions), (TestCase, test_cases), (Assertion, assertions),
+                        (question_tag_relation, question_tags), (assertion_tag_relation, assertion_tags)):
+        if rows:
+            session.execute(insert(table), rows)
+    session.add(CatalogVersion(id=1, version=1))
+    session.commit()
+
+    # popularity follows the rank in a shuffled order, so it does not line up with the level
+    ranked = [q['id'] for q in questions]
+    rng.shuffle(ranked)
+    weights = [1 / (rank + 1) ** spec.skew for rank in range(len(ranked))]
+    return Dataset(spec=spec, user_ids=[], question_ids=ranked, popularity=list(itertools.accumulate(weights)),
+                   assertion_ids=assertion_ids, levels=levels)
+
+
+def _answers(spec: DataSpec, data: Dataset, rng: random.Random, user_id: uuid.UUID, now: datetime.datetime):
+    """A user's attempts in time order: popular questions first, failures retried with probability ``retry``."""
+    budget = round(rng.expovariate(1 / spec.answers)) if spec.answers else 0
+    timestamp = now - datetime.timedelta(days=spec.days * rng.random())
+    solved, answers, relations = set(), [], []
+    while len(answers) < budget and len(solved) < len(data.question_ids):
+        question_id = rng.choices(data.question_ids, cum_weights=data.popularity)[0]
+        if question_id in solved:
+            continue
+        while len(answers) < budget:
+            timestamp += datetime.timedelta(seconds=rng.expovariate(1 / 90))
+            answer_id = _uuid(rng)
+            is_correct = rng.random() >= failure_rate(data.levels[question_id])
+            answers.append({'id': answer_id, 'user': user_id, 'question': question_id, 'is_correct': is_correct,
+                            'use_assertions': True, 'timestamp': min(timestamp, now)})
+            if is_correct:
+                solved.add(question_id)
+                break
+            failed = data.assertion_ids[question_id]
+            relations.extend({'answer_id': answer_id, 'assertion_id': a}
+                             for a in rng.sample(failed, min(len(failed), 1 + rng.randrange(2))))
+            if rng.random() >= spec.retry:
+                break
+    return answers, relations
+
+
+def generate(spec: DataSpec, batch_size: int = 10000) -> Dataset:
+    """Replace the configured database (and its shards) with a reproducible synthetic semester."""
+    start = time.perf_counter()
+    rng = random.Random(spec.seed)
+    if shards:
+        for bind in shards.engines():
+            Base.metadata.drop_all(bind, tables=SHARDED_TABLES)
+    clear_database()
+    create_database()
+
+    session = SessionLocal()
+    try:
+        data = _catalog(spec, rng, session)
+    finally:
+        session.close()
+
+    now = datetime.datetime.now()
+    data.user_ids = [_uuid(rng) for _ in range(spec.users)]
+    by_shard = {}
+    for user_id in data.user_ids:
+        by_shard.setdefault(shards.index(user_id), []).append(user_id)
+    for index, session in enumerate(shards.sync_sessions()):
+        try:
+            users = by_shard.get(index, [])
+            answers, relations = [], []
+            for user_id in users:
+                # seeded per user, so the data does not depend on how users are spread over shards
+                a, r = _answers(spec, data, random.Random(f'{spec.seed}-{user_id}'), user_id, now)
+                answers.extend(a)
+                relations.extend(r)
+            if users:
+                session.execute(insert(User), [{'id': user_id, 'progress_version': 1} for user_id in users])
+            for table, rows in ((Answer, answers), (answer_assertion_relation, relations)):
+                for i in range(0, len(rows), batch_size):
+                    session.execute(insert(table), rows[i:i + batch_size])
+            session.commit()
+            # the per-user tables come from the same code that repairs them in production
+            backfill_progress(session)
+            check_tag_stats(session, fix=True)
+            data.answers += len(answers)
+        finally:
+            session.close()
+    data.seconds = time.perf_counter() - start
+    return data
@@ -0,0 +1,160 @@
+import asyncio
+import contextvars
+import json
+import random
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlencode
+
+from sqlalchemy import event
+
+from testing.benchmark.data import Dataset, failure_rate
+
+OPERATIONS = ('list', 'detail', 'answer', 'recommendation')
+
+# statements of the request running in the current task; anything else (write-behind flushes) is background work
+_statements = contextvars.ContextVar('statements', default=None)
+
+
+@dataclass
+class LoadSpec:
+    requests: int = 5000
+    warmup: int = 200
+    concurrency: int = 50
+    mix: Dict[str, float] = field(default_factory=lambda: {'list': 20, 'detail': 40, 'answer': 30,
+                                                           'recommendation': 10})
+    seed: int = 0
+
+
+@dataclass
+class Sample:
+    operation: str
+    status: int
+    seconds: float
+    statements: int
+
+
+class ASGIClient:
+    """Calls an ASGI application in process, without sockets or an HTTP client library."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def request(self, method: str, path: str, params: Optional[dict] = None,
+                      body: Optional[object] = None) -> Tuple[int, bytes]:
+        payload = b'' if body is None else json.dumps(body, default=str).encode('utf-8')
+        scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method,
+                 'scheme': 'http', 'path': path, 'raw_path': path.encode('ascii'), 'root_path': '',
+                 'query_string': urlencode(params or {}, doseq=True).encode('ascii'),
+                 'headers': [(b'host', b'benchmark'), (b'content-type', b'application/json'),
+                             (b'content-length', str(len(payload)).encode('ascii'))],
+                 'client': ('127.0.0.1', 0), 'server': ('benchmark', 80)}
+        responded = asyncio.Event()
+        received = False
+        status, chunks = 0, []
+
+        async def receive():
+            nonlocal received
+            if not received:
+                received = True
+                return {'type': 'http.request', 'body': payload, 'more_body': False}
+            await responded.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif message['type'] == 'http.response.body':
+                chunks.append(message.get('body', b''))
+                if not message.get('more_body'):
+                    responded.set()
+
+        await self.app(scope, receive, send)
+        responded.set()
+        return status, b''.join(chunks)
+
+
+def count_statements(engines) -> List[int]:
+    """Attribute every statement of ``engines`` to the request being served; returns the background counter."""
+    background = [0]
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        (_statements.get() or background)[0] += 1
+
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', record)
+    return background
+
+
+class VirtualUser:
+    """One learner: browses the list, opens questions, answers them and asks for recommendations."""
+
+    def __init__(self, client: ASGIClient, data: Dataset, user_id: uuid.UUID, token: str, rng: random.Random):
+        self.client, self.data, self.user_id, self.token, self.rng = client, data, user_id, token, rng
+
+    def _question(self) -> uuid.UUID:
+        return self.rng.choices(self.data.question_ids, cum_weights=self.data.popularity)[0]
+
+    async def run(self, operation: str) -> int:
+        if operation == 'list':
+            status, _ = await self.client.request('GET', '/question', {'token': self.token})
+        elif operation == 'detail':
+            status, _ = await self.client.request('GET', f'/question/{self._question()}', {'token': self.token})
+        elif operation == 'answer':
+            question_id = self._question()
+            is_correct = self.rng.random() >= failure_rate(self.data.levels[question_id])
+            failed = [] if is_correct else self.rng.sample(self.data.assertion_ids[question_id],
+                                                           min(1, len(self.data.assertion_ids[question_id])))
+            status, _ = await self.client.request('POST', '/answer', {'token': self.token}, {
+                'questionID': str(question_id), 'isCorrect': is_correct, 'failedAssertions': [str(a) for a in failed]})
+        elif operation == 'recommendation':
+            status, _ = await self.client.request('GET', '/recommendation', {'token': self.token})
+        else:
+            raise ValueError(f'unknown operation {operation!r}')
+        return status
+
+
+def plan(data: Dataset, spec: LoadSpec) -> List[Tuple[str, uuid.UUID, int]]:
+    """The (operation, user, seed) of every request, drawn up front so that scheduling does not change the load."""
+    rng = random.Random(spec.seed)
+    operations = [op for op in OPERATIONS if spec.mix.get(op)]
+    weights = [spec.mix[op] for op in operations]
+    return [(rng.choices(operations, weights)[0], rng.choice(data.user_ids), rng.getrandbits(64))
+            for _ in range(spec.warmup + spec.requests)]
+
+
+async def drive(app, data: Dataset, spec: LoadSpec, engines, issue_token) -> Tuple[List[Sample], float, int]:
+    """Run ``spec.warmup`` requests, then measure ``spec.requests`` more.
+
+    Returns the samples, the seconds the measured requests took and the statements run outside of any request.
+    """
+    client = ASGIClient(app)
+    requests = iter(enumerate(plan(data, spec)))
+    tokens = {}
+    background = count_statements(engines)
+    samples: List[Sample] = []
+    measured_from = None
+
+    async def worker():
+        nonlocal measured_from
+        for number, (operation, user_id, seed) in requests:
+            measured = number >= spec.warmup
+            if measured and measured_from is None:
+                measured_from = time.perf_counter()
+            token = tokens.get(user_id) or tokens.setdefault(user_id, issue_token(user_id))
+            user = VirtualUser(client, data, user_id, token, random.Random(seed))
+            counter = [0]
+            reset = _statements.set(counter)
+            start = time.perf_counter()
+            try:
+                status = await user.run(operation)
+            finally:
+                _statements.reset(reset)
+            if measured:
+                samples.append(Sample(operation, status, time.perf_counter() - start, counter[0]))
+
+    await asyncio.gather(*[worker() for _ in range(spec.concurrency)])
+    return samples, time.perf_counter() - measured_from, background[0]
@@ -0,0 +1,105 @@
+import datetime
+import json
+import math
+import platform
+import subprocess
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from testing.benchmark.driver import Sample
+
+# a run regresses when one of these grows (or, for throughput, shrinks) by more than the tolerance
+LATENCY_KEYS = ('p50', 'p95', 'p99')
+# concurrent requests of one user may see each other's writes in either order, which moves the mean a little
+STATEMENT_SLACK = 1.02
+
+
+def percentile(ordered: List[float], p: float) -> float:
+    """Nearest-rank percentile of an ascending list."""
+    if not ordered:
+        return 0.0
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def summarize(samples: List[Sample], elapsed: float) -> dict:
+    stats = {}
+    groups = defaultdict(list)
+    for sample in samples:
+        groups[sample.operation].append(sample)
+    for name, group in (('all', samples), *sorted(groups.items())):
+        latencies = sorted(s.seconds * 1000 for s in group)
+        statements = [s.statements for s in group]
+        stats[name] = {
+            'requests': len(group),
+            'errors': sum(s.status >= 400 for s in group),
+            'throughput': round(len(group) / elapsed, 1) if elapsed else 0.0,
+            'mean': round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+            **{key: round(percentile(latencies, float(key[1:])), 3) for key in LATENCY_KEYS},
+            'statements': round(sum(statements) / len(statements), 2) if statements else 0.0,
+            'max_statements': max(statements, default=0),
+        }
+    return stats
+
+
+def _revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build(samples: List[Sample], elapsed: float, background: int, data: dict, load: dict, settings: dict) -> dict:
+    return {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'revision': _revision(),
+        'python': platform.python_version(),
+        'settings': settings,
+        'data': data,
+        'load': load,
+        'elapsed': round(elapsed, 3),
+        'background_statements': background,
+        'operations': summarize(samples, elapsed),
+    }
+
+
+def save(report: dict, path: str):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+def load(path: str) -> dict:
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def render(report: dict) -> str:
+    lines = [f'{"operation":<16}{"requests":>9}{"errors":>7}{"req/s":>9}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}'
+             f'{"stmts":>7}']
+    for name, s in report['operations'].items():
+        lines.append(f'{name:<16}{s["requests"]:>9}{s["errors"]:>7}{s["throughput"]:>9.1f}{s["p50"]:>9.2f}'
+                     f'{s["p95"]:>9.2f}{s["p99"]:>9.2f}{s["statements"]:>7.2f}')
+    lines.append(f'{report["background_statements"]} statements outside of requests, '
+                 f'{report["elapsed"]:.1f}s measured')
+    return '\n'.join(lines)
+
+
+def compare(baseline: dict, current: dict, tolerance: float) -> List[str]:
+    """Regressions of ``current`` against ``baseline``: latency or throughput beyond ``tolerance`` percent, and more
+    statements per request, which does not depend on the machine."""
+    regressions = []
+    for name, old in baseline['operations'].items():
+        new: Dict[str, float] = current['operations'].get(name)
+        if new is None:
+            continue
+        for key in LATENCY_KEYS:
+            if old[key] and new[key] > old[key] * (1 + tolerance / 100):
+                regressions.append(f'{name} {key} {old[key]:.2f} -> {new[key]:.2f} ms')
+        if old['throughput'] and new['throughput'] < old['throughput'] * (1 - tolerance / 100):
+            regressions.append(f'{name} throughput {old["throughput"]:.1f} -> {new["throughput"]:.1f} req/s')
+        if new['statements'] > old['statements'] * STATEMENT_SLACK or new['max_statements'] > old['max_statements']:
+            regressions.append(f'{name} statements {old["statements"]:.2f} (max {old["max_statements"]}) -> '
+                               f'{new["statements"]:.2f} (max {new["max_statements"]})')
+        if new['errors'] > old['errors']:
+            regressions.append(f'{name} errors {old["errors"]} -> {new["errors"]}')
+    return regressions
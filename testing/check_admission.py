@@ -0,0 +1,84 @@
+import argparse
+import asyncio
+import time
+from collections import Counter
+
+from app.admission import Admission, AdmissionMiddleware, Gate, RateLimits
+from testing.benchmark.driver import ASGIClient
+
+
+def endpoint(seconds: float):
+    """Stands in for the application: holds its slot for ``seconds`` and answers 200."""
+
+    async def app(scope, receive, send):
+        await asyncio.sleep(seconds)
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b'{}'})
+
+    return app
+
+
+async def burst(args):
+    limits = RateLimits({('POST', '/answer'): (args.rate, args.burst)}, 1000)
+    client = ASGIClient(AdmissionMiddleware(endpoint(0), Admission(limits, Gate(0, 0, 0))))
+    statuses = Counter()
+    start = time.monotonic()
+    while time.monotonic() - start < args.seconds:
+        status, _ = await client.request('POST', '/answer', {'token': 'a'})
+        statuses[status] += 1
+        await asyncio.sleep(0.001)
+    expected = args.burst + args.rate * args.seconds
+    print(f'one token for {args.seconds}s: {statuses[200]} admitted (expected about {expected:.0f}), '
+          f'{statuses[429]} rate limited')
+    assert abs(statuses[200] - expected) <= 2, statuses
+    status, _ = await client.request('POST', '/answer', {'token': 'b'})
+    assert status == 200, 'a second token has its own bucket'
+    status, _ = await client.request('GET', '/recommendation', {'token': 'a'})
+    assert status == 200, 'only the configured routes are limited'
+
+
+async def flood(args):
+    gate = Gate(args.limit, args.queue, args.timeout)
+    admission = Admission(RateLimits({}, 0), gate)
+    client = ASGIClient(AdmissionMiddleware(endpoint(args.hold), admission))
+    peak = 0
+
+    async def one() -> int:
+        nonlocal peak
+        status, _ = await client.request('GET', '/question')
+        peak = max(peak, gate.active)
+        return status
+
+    statuses = Counter(await asyncio.gather(*[one() for _ in range(args.requests)]))
+    print(f'{args.requests} requests at once, {args.limit} slots, queue of {args.queue}: {dict(statuses)}, '
+          f'shed {dict(admission.shed)}')
+    assert peak <= args.limit and gate.active == 0 and gate.waiting == 0, (peak, gate.active, gate.waiting)
+    # requests queue in rounds of --limit, each taking --hold; whoever is still queued after --timeout is shed
+    queued = min(args.requests, args.limit + args.queue)
+    served = min(queued, args.limit * (1 + int(args.timeout / args.hold)))
+    assert statuses == {200: served, 503: args.requests - served}, statuses
+    assert admission.shed == {k: v for k, v in {('queue_full', ''): args.requests - queued,
+                                                ('wait_timeout', ''): queued - served}.items() if v}, admission.shed
+
+    # a waiter cancelled by a client disconnect must not take a slot with it
+    tasks = [asyncio.ensure_future(one()) for _ in range(args.limit + 2)]
+    await asyncio.sleep(0)
+    tasks[-1].cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    assert gate.active == 0 and gate.waiting == 0, (gate.active, gate.waiting)
+    assert 'dinagon_admission_shed_total{reason="queue_full",route=""}' in admission.render()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='check the rate limits and the database gate of app/admission.py')
+    parser.add_argument('--seconds', type=float, default=2)
+    parser.add_argument('--rate', type=float, default=5)
+    parser.add_argument('--burst', type=float, default=10)
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--queue', type=int, default=100)
+    parser.add_argument('--timeout', type=float, default=0.35, help='seconds a request may queue')
+    parser.add_argument('--hold', type=float, default=0.1, help='seconds each admitted request takes')
+    args = parser.parse_args()
+    asyncio.run(burst(args))
+    asyncio.run(flood(args))
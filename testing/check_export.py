@@ -0,0 +1,84 @@
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import uuid
+
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from app import controller
+from app.export import _backup
+from app.models import Base
+from app.profiles import SQLITE, async_engine_options, apply_sqlite_pragmas, sqlite_pragmas
+from testing.bench_async import populate
+
+# every answer commit adds one answer and one attempt, so a torn copy shows up as a mismatch
+INVARIANT = 'SELECT (SELECT COUNT(*) FROM answers), (SELECT COALESCE(SUM(attempts), 0) FROM user_question_progress)'
+
+
+async def write(session_factory, user_ids, question_ids, until: float) -> int:
+    written = 0
+    while time.monotonic() < until:
+        async with session_factory() as session:
+            await controller.create_answer(random.choice(user_ids), random.choice(question_ids),
+                                           random.random() < 0.3, [], True, session)
+        written += 1
+    return written
+
+
+async def backup_repeatedly(path: str, directory: str, until: float) -> list:
+    loop = asyncio.get_event_loop()
+    results = []
+    while time.monotonic() < until:
+        copy = os.path.join(directory, f'copy{len(results)}.db')
+        start = time.perf_counter()
+        await loop.run_in_executor(None, _backup, path, copy)
+        elapsed = time.perf_counter() - start
+        connection = sqlite3.connect(copy)
+        integrity, = connection.execute('PRAGMA integrity_check').fetchone()
+        answers, attempts = connection.execute(INVARIANT).fetchone()
+        connection.close()
+        os.remove(copy)
+        results.append((elapsed, integrity == 'ok' and answers == attempts, answers))
+    return results
+
+
+async def check(args):
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'check.db')
+    engine = create_engine(f'sqlite:///{path}')
+    apply_sqlite_pragmas(engine, sqlite_pragmas())
+    Base.metadata.create_all(engine)
+    question_ids = populate(sessionmaker(bind=engine)(), args.questions, 5)
+    engine.dispose()
+
+    writer = create_async_engine(f'sqlite+aiosqlite:///{path}', **async_engine_options(SQLITE, writer=True))
+    apply_sqlite_pragmas(writer.sync_engine, sqlite_pragmas())
+    session_factory = sessionmaker(bind=writer, class_=AsyncSession, expire_on_commit=False)
+    user_ids = [uuid.uuid4() for _ in range(args.users)]
+    until = time.monotonic() + args.seconds
+    try:
+        written, copies = await asyncio.gather(write(session_factory, user_ids, question_ids, until),
+                                               backup_repeatedly(path, directory, until))
+    finally:
+        await writer.dispose()
+
+    consistent = sum(ok for _, ok, _ in copies)
+    print(f'{written} answers written while taking {len(copies)} copies, '
+          f'{sum(e for e, _, _ in copies) / max(len(copies), 1) * 1000:.1f} ms each')
+    print(f'{consistent} of {len(copies)} copies consistent, last one with {copies[-1][2] if copies else 0} answers')
+    raise SystemExit(0 if consistent == len(copies) else 1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='take online backups while answers are being written and check that '
+                                                 'every copy is consistent')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--questions', type=int, default=50)
+    asyncio.run(check(parser.parse_args()))
@@ -0,0 +1,154 @@
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import uuid
+from contextlib import contextmanager
+from typing import Iterator, List
+
+from fastapi import HTTPException
+from sqlalchemy import create_engine, event, insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from app import routes
+from app.auth import decode_token, token_cache
+from app.catalog import catalog_cache
+from app.models import Base, LegacyUser
+from app.scheme import UserAnswerRequest
+from testing.bench_async import populate
+
+# statements per call once the catalog is cached; the cold catalog load is counted separately
+BUDGETS = {
+    'catalog load': 7,
+    'GET /question (new user)': 0,
+    'GET /question': 2,
+    'GET /question/{questionID}': 2,
+    'GET /question (304)': 1,
+    'GET /question (filtered page)': 2,
+    'GET /question/search': 1,
+    'GET /question/{questionID} (304)': 1,
+    'POST /answer': 8,
+    'POST /answers/batch': 11,
+    'GET /recommendation': 1,
+    'GET /dashboard/questions': 2,
+    'GET /dashboard/assertions': 3,
+    'GET /dashboard/tags': 2,
+}
+
+
+@contextmanager
+def count_statements(engine: Engine) -> Iterator[List[str]]:
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
+
+async def measure(questions: int, assertions: int):
+    path = os.path.join(tempfile.mkdtemp(), 'queries.db')
+    engine = create_engine(f'sqlite:///{path}')
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    question_ids = populate(session, questions, assertions)
+    session.close()
+    engine.dispose()
+
+    async_engine = create_async_engine(f'sqlite+aiosqlite:///{path}')
+    async_session = sessionmaker(bind=async_engine, class_=AsyncSession, expire_on_commit=False)
+    catalog_cache.invalidate()
+    counts = {}
+
+    async def call(name, handler, *args, **kwargs):
+        async with async_session() as session:
+            with count_statements(async_engine.sync_engine) as statements:
+                result = await handler(*args, session=session, **kwargs)
+        counts[name] = len(statements)
+        return result
+
+    catalog = await call('catalog load', catalog_cache.get)
+    # called directly, the route does not resolve its Query() defaults
+    unfiltered = dict(min_level=None, max_level=None, tag=None, match='any', solved=None, cursor=None, limit=None)
+    token = json.loads((await call('GET /question (new user)', routes.questions, '', None, **unfiltered)).body)['token']
+    for name, handler, args, kwargs in (('GET /question', routes.questions, (), unfiltered),
+                                        ('GET /question/{questionID}', routes.certain_question, (question_ids[0],),
+                                         {})):
+        response = await call(name, handler, *args, token=token, if_none_match=None, **kwargs)
+        not_modified = await call(f'{name} (304)', handler, *args, token=token,
+                                  if_none_match=response.headers['ETag'], **kwargs)
+        assert not_modified.status_code == 304
+    for is_correct in (False, False, True):
+        failed = [] if is_correct else [a.id for a in catalog.questions[question_ids[0]].assertions[:2]]
+        request = UserAnswerRequest(questionID=question_ids[0], isCorrect=is_correct, failedAssertions=failed)
+        async with async_session() as session:
+            with count_statements(async_engine.sync_engine) as statements:
+                await routes.answer(request, token, session, True)
+        counts['POST /answer'] = max(counts.get('POST /answer', 0), len(statements))
+    await call('GET /recommendation', routes.recommendation, token=token)
+    await check_legacy_tokens(async_session, decode_token(token))
+    page = json.loads((await call('GET /question (filtered page)', routes.questions, token, None, **{
+        **unfiltered, 'min_level': 1, 'tag': list(catalog.tags), 'solved': False, 'limit': 3})).body)
+    assert len(page['questions']) == 3 and page['nextCursor']
+    found = json.loads((await call('GET /question/search', routes.search_questions, 'question 1', token=token,
+                                   offset=0, limit=20)).body)
+    assert found['total'] and found['questions']
+    batch = [UserAnswerRequest(questionID=question_id, isCorrect=i % 3 == 0,
+                               failedAssertions=[] if i % 3 == 0 else [catalog.questions[question_id].assertions[0].id])
+             for i, question_id in enumerate(question_ids * 2)]
+    await call('POST /answers/batch', routes.answers_batch, batch, token=token)
+    for name, handler in (('GET /dashboard/questions', routes.dashboard_questions),
+                          ('GET /dashboard/assertions', routes.dashboard_assertions),
+                          ('GET /dashboard/tags', routes.dashboard_tags)):
+        await call(name, handler, bucket='day', since=None, until=None)
+
+    await async_engine.dispose()
+    return counts
+
+
+async def check_legacy_tokens(async_session, user_id: uuid.UUID):
+    """A user's id is not a credential: only users marked in legacy_users may use it as a token."""
+    for bare in (user_id.hex, str(user_id)):
+        async with async_session() as session:
+            try:
+                await routes.recommendation(token=bare, session=session)
+            except HTTPException as e:
+                assert e.status_code == 401, e.status_code
+            else:
+                raise AssertionError(f'the bare id {bare} of a user with a signed token was accepted')
+    async with async_session() as session:
+        await session.execute(insert(LegacyUser), [{'id': user_id}])
+        await session.commit()
+    token_cache.clear()
+    async with async_session() as session:
+        await routes.recommendation(token=user_id.hex, session=session)
+        await session.execute(LegacyUser.__table__.delete())
+        await session.commit()
+    token_cache.clear()
+
+
+async def check(sizes, assertions: int) -> bool:
+    results = [await measure(size, assertions) for size in sizes]
+    ok = True
+    print(f'{"endpoint":<34}' + ''.join(f'{f"{size} questions":>16}' for size in sizes) + f'{"budget":>8}')
+    for name, budget in BUDGETS.items():
+        counts = [r[name] for r in results]
+        flag = '' if len(set(counts)) == 1 and counts[0] <= budget else '  <-- FAIL'
+        ok = ok and not flag
+        print(f'{name:<34}' + ''.join(f'{c:>16}' for c in counts) + f'{budget:>8}{flag}')
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='check that every endpoint issues a fixed number of statements')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5, 200])
+    parser.add_argument('--assertions', type=int, default=5)
+    args = parser.parse_args()
+    raise SystemExit(0 if asyncio.run(check(args.sizes, args.assertions)) else 1)
@@ -0,0 +1,119 @@
+import argparse
+import datetime
+import os
+import random
+import tempfile
+import threading
+import uuid
+from collections import Counter, defaultdict
+
+from sqlalchemy import create_engine, insert, select
+
+from app import rollups
+from app.models import Base, SessionLocal, User, Answer, Assertion, answer_assertion_relation
+from app.profiles import SQLITE, apply_sqlite_pragmas, sqlite_pragmas
+from app.shards import shards
+from testing.bench_async import populate
+
+
+def write_answers(users, failures, count: int, around: datetime.datetime):
+    answers, failed = defaultdict(list), defaultdict(list)
+    for _ in range(count):
+        user, question_id, answer_id = random.choice(users), random.choice(list(failures)), uuid.uuid4()
+        assertion_ids = [] if random.random() < 0.3 else random.sample(failures[question_id], 1)
+        index = shards.index(user)
+        answers[index].append({'id': answer_id, 'user': user, 'question': question_id,
+                               'is_correct': not assertion_ids, 'use_assertions': True,
+                               'timestamp': around - datetime.timedelta(milliseconds=random.randrange(500))})
+        failed[index].extend({'answer_id': answer_id, 'assertion_id': a} for a in assertion_ids)
+    for index, session in enumerate(shards.sync_sessions()):
+        try:
+            if answers[index]:
+                session.execute(insert(Answer), answers[index])
+            if failed[index]:
+                session.execute(insert(answer_assertion_relation), failed[index])
+            session.commit()
+        finally:
+            session.close()
+
+
+def refresh_together(upper: datetime.datetime, refreshes: int) -> Counter:
+    """Start ``refreshes`` refreshes over the same answers at once and count how each ended.
+
+    One of them should fold the answers in; the others find the marks moved, before they start or when they write.
+    """
+    barrier = threading.Barrier(refreshes)
+    outcomes = Counter()
+
+    def run():
+        barrier.wait()
+        try:
+            buckets, _ = rollups.refresh(0, now=upper)
+            outcomes['committed' if buckets else 'skipped'] += 1
+        except rollups.RefreshConflict:
+            outcomes['conflict'] += 1
+
+    threads = [threading.Thread(target=run) for _ in range(refreshes)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return outcomes
+
+
+def check(args):
+    path = os.path.join(tempfile.mkdtemp(), 'rollups.db')
+    engine = create_engine(f'sqlite:///{path}', connect_args={'check_same_thread': False})
+    apply_sqlite_pragmas(engine, sqlite_pragmas())
+    Base.metadata.create_all(engine)
+    # the refreshes run on the shared session factory and shards, pointed at the temporary databases
+    SessionLocal.configure(bind=engine)
+    shards.configure(args.shards, f'sqlite:///{path}', f'sqlite+aiosqlite:///{path}', SQLITE)
+    shards.create_all()
+
+    session = SessionLocal()
+    populate(session, args.questions, 3)
+    failures = defaultdict(list)
+    for assertion_id, question_id in session.execute(select(Assertion.id, Assertion.question_id)):
+        failures[question_id].append(assertion_id)
+    session.close()
+    users = [uuid.uuid4() for _ in range(args.users)]
+    for index, session in enumerate(shards.sync_sessions()):
+        session.execute(insert(User), [{'id': u} for u in users if shards.index(u) == index])
+        session.commit()
+        session.close()
+
+    start = datetime.datetime.now().replace(microsecond=0)
+    totals, failed_rounds = Counter(), 0
+    for i in range(args.rounds):
+        around = start + datetime.timedelta(seconds=10 * i)
+        write_answers(users, failures, args.answers, around)
+        if i:
+            # the first round races to create the marks, the others to move existing ones
+            rollups.refresh(0, now=around - datetime.timedelta(seconds=1))
+        outcomes = refresh_together(around + datetime.timedelta(seconds=1), args.refreshes)
+        totals += outcomes
+        # a second refresh that commits may double the counts or overwrite them with its own, equal ones
+        differing = rollups.check()
+        if differing or outcomes['committed'] != 1:
+            failed_rounds += 1
+            print(f'round {i}: {outcomes["committed"]} refreshes committed the answers, rollups differing from '
+                  f'them: {", ".join(differing) or "none"}')
+
+    print(f'{args.rounds} rounds of {args.refreshes} concurrent refreshes over {args.shards} shard(s): '
+          f'{totals["committed"]} committed, {totals["skipped"]} found nothing left, {totals["conflict"]} turned away, '
+          f'{failed_rounds} rounds failed')
+    raise SystemExit(1 if failed_rounds else 0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='run refreshes of the dashboard rollups over the same answers at '
+                                                 'the same time and check that every answer is counted once')
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--refreshes', type=int, default=2)
+    # with a single shard the answers would be read through app.models.engine, which cannot be pointed elsewhere
+    parser.add_argument('--shards', type=int, default=2, choices=range(2, 17), metavar='2..16')
+    parser.add_argument('--answers', type=int, default=200)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--questions', type=int, default=10)
+    check(parser.parse_args())
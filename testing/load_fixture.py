@@ -1,51 +1,286 @@
 from app.models import *
+from app.shards import shards
+import argparse
 import glob
+import hashlib
 import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List, Tuple
 
+from sqlalchemy import bindparam, delete, func, insert, select, update
+
+FIXTURE_DIRECTORY = './shonagon/assertions'
+# ids are derived from file names and positions, so reloading a file keeps the ids answers already refer to
+NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, 'https://github.com/nagataaaas/shonagon')
+
+TAGS = {
+    '変数': 'https://developer.mozilla.org/ja/docs/Learn/JavaScript/First_steps/Variables',
+    'if文': 'https://developer.mozilla.org/ja/docs/Web/JavaScript/Guide/Control_flow_and_error_handling#conditional_statements',
+    '算術理解': 'https://developer.mozilla.org/ja/docs/Learn/JavaScript/First_steps/Math',
+    '関数定義': 'https://developer.mozilla.org/ja/docs/Web/JavaScript/Guide/Functions',
+    '関数呼び出し': 'https://developer.mozilla.org/ja/docs/Web/JavaScript/Guide/Functions#calling_functions',
+    '定数': 'https://developer.mozilla.org/ja/docs/Web/JavaScript/Reference/Statements/const',
+    '関数からの値の返却': 'https://developer.mozilla.org/ja/docs/Web/JavaScript/Reference/Statements/return',
+    'for文': 'https://developer.mozilla.org/ja/docs/Web/JavaScript/Guide/Loops_and_iteration#for_statement',
+    '型理解': 'https://developer.mozilla.org/ja/docs/Web/JavaScript/Guide/Grammar_and_Types#data_structures_and_types',
+}
+
+
+class LegacyCatalogError(Exception):
+    pass
+
+
+def tag_id(name: str) -> uuid.UUID:
+    return uuid.uuid5(NAMESPACE, f'tag:{name}')
+
+
+def question_id(path: str) -> uuid.UUID:
+    return uuid.uuid5(NAMESPACE, f'question:{path}')
+
+
+def known_tag_id(name: str) -> uuid.UUID:
+    if name not in TAGS:
+        raise KeyError(f'unknown tag {name!r}')
+    return tag_id(name)
+
+
+def read(file: str) -> Tuple[str, bytes, str]:
+    with open(file, 'rb') as f:
+        data = f.read()
+    return os.path.basename(file), data, hashlib.sha256(data).hexdigest()
+
+
+def parse(path: str, data: bytes) -> dict:
+    """Turn one question file into the rows to write; runs in worker processes."""
+    try:
+        source = json.loads(data.decode('utf-8'))
+        id_ = question_id(path)
+        assertions = [{'id': uuid.uuid5(id_, f'assertion:{i}'), 'question_id': id_,
+                       'assertion': json.dumps(a['assertion']), 'message': a['message']}
+                      for i, a in enumerate(source['assertions'])]
+        return {
+            'question': {'id': id_, 'title': source['title'], 'description': source['description'],
+                         'default_code': source['defaultCode'], 'level': source['level'], 'listed': True},
+            'tags': [{'question_id': id_, 'tag_id': known_tag_id(name)} for name in source['tags']],
+            'test_cases': [{'id': uuid.uuid5(id_, f'test_case:{i}'), 'question_id': id_, **case}
+                           for i, case in enumerate(source['testCase'])],
+            'assertions': assertions,
+            'assertion_tags': [{'assertion_id': row['id'], 'tag_id': known_tag_id(name)}
+                               for row, a in zip(assertions, source['assertions']) for name in a['tags']],
+        }
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f'{path}: {e!r}') from e
+
+
+def _replace_legacy_catalog(session: Session, prune: bool, dry_run: bool = False) -> bool:
+    """Catalogs written before fixture_files existed have random ids; they are dropped and loaded again.
+
+    Answers, progress, tag statistics and rollups refer to those ids and cannot be carried over, so they are deleted
+    too, which only happens with ``prune``. The shards commit their deletes first: should the load fail after that,
+    running it again finds the catalog still unhashed and finishes the replacement. With ``dry_run`` nothing is
+    deleted, but the return value and the error are the same.
+    """
+    if session.execute(select(func.count()).select_from(FixtureFile)).scalar() or \
+            not session.execute(select(func.count()).select_from(Question)).scalar():
+        return False
+    shard_sessions = shards.sync_sessions()
+    try:
+        answers = sum(s.execute(select(func.count()).select_from(Answer)).scalar() for s in shard_sessions)
+        if answers and not prune:
+            raise LegacyCatalogError(f'the stored catalog has random ids and {answers} answers refer to them; '
+                                     'pass --prune to delete the answers and everything derived from them')
+        if dry_run:
+            return True
+        for shard_session in shard_sessions:
+            for table in (answer_assertion_relation, UserQuestionProgress.__table__, UserTagStat.__table__,
+                          TagRecommendation.__table__, Answer.__table__):
+                shard_session.execute(delete(table))
+            shard_session.commit()
+    finally:
+        for shard_session in shard_sessions:
+            shard_session.close()
+    for table in (QuestionRollup.__table__, AssertionRollup.__table__, TagRollup.__table__, RollupMark.__table__,
+                  assertion_tag_relation, question_tag_relation, TestCase.__table__, Assertion.__table__,
+                  Question.__table__, Tag.__table__):
+        session.execute(delete(table))
+    return True
+
+
+def _write_tags(session: Session):
+    existing = {row.id: row.tutorial_link for row in session.execute(select(Tag.id, Tag.tutorial_link))}
+    new = [{'id': tag_id(name), 'name': name, 'tutorial_link': link}
+           for name, link in TAGS.items() if tag_id(name) not in existing]
+    changed = [{'b_id': tag_id(name), 'tutorial_link': link}
+               for name, link in TAGS.items() if existing.get(tag_id(name), link) != link]
+    if new:
+        session.execute(insert(Tag), new)
+    if changed:
+        session.execute(update(Tag).where(Tag.id == bindparam('b_id')).values(tutorial_link=bindparam('tutorial_link')),
+                        changed)
+
+
+def _write_questions(session: Session, parsed: List[dict], existing: set):
+    ids = [p['question']['id'] for p in parsed]
+    new = [p['question'] for p in parsed if p['question']['id'] not in existing]
+    changed = [{f'b_{k}' if k == 'id' else k: v for k, v in p['question'].items()}
+               for p in parsed if p['question']['id'] in existing]
+    if new:
+        session.execute(insert(Question), new)
+    if changed:
+        session.execute(update(Question).where(Question.id == bindparam('b_id')).values(
+            {c: bindparam(c) for c in ('title', 'description', 'default_code', 'level', 'listed')}), changed)
+
+    # children without references from answers are simply rewritten
+    old_assertions = set(session.execute(select(Assertion.id).filter(Assertion.question_id.in_(ids))).scalars())
+    session.execute(delete(assertion_tag_relation).where(assertion_tag_relation.c.assertion_id.in_(old_assertions)))
+    session.execute(delete(question_tag_relation).where(question_tag_relation.c.question_id.in_(ids)))
+    session.execute(delete(TestCase.__table__).where(TestCase.question_id.in_(ids)))
+
+    # assertions are kept by id, so answers that failed them still point at a row; dropped ones are detached
+    assertions = [row for p in parsed for row in p['assertions']]
+    kept = {row['id'] for row in assertions}
+    if old_assertions - kept:
+        session.execute(update(Assertion).where(Assertion.id.in_(old_assertions - kept)).values(question_id=None))
+    updated = [{'b_id': row['id'], 'question_id': row['question_id'], 'assertion': row['assertion'],
+                'message': row['message']} for row in assertions if row['id'] in old_assertions]
+    if updated:
+        session.execute(update(Assertion).where(Assertion.id == bindparam('b_id')).values(
+            {c: bindparam(c) for c in ('question_id', 'assertion', 'message')}), updated)
+    reattached = set(session.execute(select(Assertion.id).filter(Assertion.id.in_(kept - old_assertions))).scalars())
+    if reattached:
+        session.execute(update(Assertion).where(Assertion.id == bindparam('b_id')).values(
+            {c: bindparam(c) for c in ('question_id', 'assertion', 'message')}),
+            [{'b_id': row['id'], 'question_id': row['question_id'], 'assertion': row['assertion'],
+              'message': row['message']} for row in assertions if row['id'] in reattached])
+    inserted = [row for row in assertions if row['id'] not in old_assertions and row['id'] not in reattached]
+    if inserted:
+        session.execute(insert(Assertion), inserted)
+
+    for table, key in ((TestCase.__table__, 'test_cases'), (question_tag_relation, 'tags'),
+                       (assertion_tag_relation, 'assertion_tags')):
+        rows = [row for p in parsed for row in p[key]]
+        if rows:
+            session.execute(insert(table), rows)
+
+
+def _prune(session: Session, removed: Dict[str, uuid.UUID]) -> List[str]:
+    """Delete questions whose files are gone, unless answers still refer to them."""
+    answered = set()
+    for shard_session in shards.sync_sessions():
+        try:
+            answered.update(shard_session.execute(select(Answer.question).filter(
+                Answer.question.in_(removed.values())).distinct()).scalars())
+        finally:
+            shard_session.close()
+    pruned = {path: id_ for path, id_ in removed.items() if id_ not in answered}
+    ids = list(pruned.values())
+    if ids:
+        assertions = select(Assertion.id).filter(Assertion.question_id.in_(ids))
+        session.execute(delete(assertion_tag_relation).where(assertion_tag_relation.c.assertion_id.in_(assertions)))
+        session.execute(delete(question_tag_relation).where(question_tag_relation.c.question_id.in_(ids)))
+        session.execute(delete(TestCase.__table__).where(TestCase.question_id.in_(ids)))
+        session.execute(delete(Assertion.__table__).where(Assertion.question_id.in_(ids)))
+        session.execute(delete(Question.__table__).where(Question.id.in_(ids)))
+        session.execute(delete(FixtureFile.__table__).where(FixtureFile.path.in_(list(pruned))))
+    return sorted(pruned)
+
+
+def load(directory: str = FIXTURE_DIRECTORY, dry_run: bool = False, prune: bool = False,
+         workers: int = None) -> dict:
+    timings = {}
+    start = time.perf_counter()
+    with ThreadPoolExecutor() as executor:
+        files = list(executor.map(read, sorted(glob.glob(os.path.join(directory, '*')))))
+    timings['read'] = time.perf_counter() - start
 
-def load():
     session = SessionLocal()
+    try:
+        legacy = _replace_legacy_catalog(session, prune, dry_run)
+        stored = {f.path: f for f in session.execute(select(FixtureFile)).scalars()}
+        # questions whose file was deleted are unlisted rather than deleted, as answers may refer to them
+        listed = {path: listed for path, listed in session.execute(
+            select(FixtureFile.path, Question.listed).join(Question, Question.id == FixtureFile.question_id))}
+        current = {path for path, _, _ in files}
+        # a file put back unchanged is written again to list its question
+        changed = [(path, data, digest) for path, data, digest in files
+                   if path not in stored or stored[path].digest != digest or not listed.get(path, True)]
+        removed = {path: f.question_id for path, f in stored.items() if path not in current}
+        unlisting = {path: id_ for path, id_ in removed.items() if listed.get(path)}
+        summary = {'added': sorted(p for p, _, _ in changed if p not in stored),
+                   'changed': sorted(p for p, _, _ in changed if p in stored),
+                   'unchanged': len(files) - len(changed), 'removed': sorted(removed), 'pruned': [],
+                   'unlisted': sorted(unlisting), 'legacy_replaced': legacy}
+        if dry_run or not (changed or unlisting or (prune and removed)):
+            session.rollback()
+            summary['timings'] = timings
+            return summary
+
+        start = time.perf_counter()
+        # process start-up costs more than parsing a few hundred small files, so workers are opt-in
+        if not workers or workers == 1 or len(changed) < 32:
+            parsed = [parse(path, data) for path, data, _ in changed]
+        else:
+            with ProcessPoolExecutor(workers) as executor:
+                parsed = list(executor.map(parse, [p for p, _, _ in changed], [d for _, d, _ in changed],
+                                           chunksize=16))
+        timings['parse'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        _write_tags(session)
+        if parsed:
+            existing = set(session.execute(select(Question.id).filter(
+                Question.id.in_([p['question']['id'] for p in parsed]))).scalars())
+            _write_questions(session, parsed, existing)
+        if changed:
+            session.execute(delete(FixtureFile.__table__).where(FixtureFile.path.in_([p for p, _, _ in changed])))
+            session.execute(insert(FixtureFile), [{'path': path, 'digest': digest, 'question_id': question_id(path)}
+                                                  for path, _, digest in changed])
+        if prune and removed:
+            summary['pruned'] = _prune(session, removed)
+        unlisting = {path: id_ for path, id_ in unlisting.items() if path not in summary['pruned']}
+        if unlisting:
+            session.execute(update(Question).where(Question.id.in_(unlisting.values())).values(listed=False))
+        summary['unlisted'] = sorted(unlisting)
+
+        version = session.get(CatalogVersion, 1) or CatalogVersion(id=1, version=0)
+        version.version += 1
+        session.add(version)
+        session.commit()
+        timings['write'] = time.perf_counter() - start
+    finally:
+        session.close()
+
+    summary['timings'] = timings
+    return summary
+
 
-    tags = [
-        Tag(name='変数', tutorial_link='https://developer.mozilla.org/ja/docs/Learn/JavaScript/First_steps/Variables'),
-        Tag(name='if文',
-            tutorial_link='https://developer.mozilla.org/ja/docs/Web/JavaScript/Guide/Control_flow_and_error_handling#conditional_statements'),
-        Tag(name='算術理解', tutorial_link='https://developer.mozilla.org/ja/docs/Learn/JavaScript/First_steps/Math'),
-        Tag(name='関数定義', tutorial_link='https://developer.mozilla.org/ja/docs/Web/JavaScript/Guide/Functions'),
-        Tag(name='関数呼び出し',
-            tutorial_link='https://developer.mozilla.org/ja/docs/Web/JavaScript/Guide/Functions#calling_functions'),
-        Tag(name='定数', tutorial_link='https://developer.mozilla.org/ja/docs/Web/JavaScript/Reference/Statements/const'),
-        Tag(name='関数からの値の返却',
-            tutorial_link='https://developer.mozilla.org/ja/docs/Web/JavaScript/Reference/Statements/return'),
-        Tag(name='for文',
-            tutorial_link='https://developer.mozilla.org/ja/docs/Web/JavaScript/Guide/Loops_and_iteration#for_statement'),
-        Tag(name='型理解',
-            tutorial_link='https://developer.mozilla.org/ja/docs/Web/JavaScript/Guide/Grammar_and_Types#data_structures_and_types')]
-
-    session.add_all(tags)
-    session.commit()
-    tag_dict = {tag.name: tag for tag in tags}
-
-    for file in glob.glob('./shonagon/assertions/*'):
-        with open(file, 'r', encoding='utf-8') as f:
-            data = json.loads(f.read())
-
-        testcases = [TestCase(**case) for case in data['testCase']]
-        assertions = [Assertion(assertion=json.dumps(assertion['assertion']),
-                                message=assertion['message'],
-                                tags=[tag_dict[tag] for tag in assertion['tags']])
-                      for assertion in data['assertions']]
-
-        question = Question(title=data['title'], description=data['description'],
-                            test_cases=testcases, assertions=assertions, tags=[tag_dict[tag] for tag in data['tags']],
-                            default_code=data['defaultCode'], level=data['level'])
-
-        session.add_all([*testcases, *assertions, question])
-
-    session.commit()
-    session.close()
+def report(summary: dict, dry_run: bool):
+    if summary['legacy_replaced']:
+        print(f'{"would replace" if dry_run else "replaced"} a catalog loaded without fixture hashes')
+    for key in ('added', 'changed', 'removed', 'pruned', 'unlisted'):
+        if summary[key]:
+            print(f'{key}: {", ".join(summary[key])}')
+    print(f'{len(summary["added"])} added, {len(summary["changed"])} changed, {summary["unchanged"]} unchanged, '
+          f'{len(summary["removed"])} removed ({len(summary["pruned"])} pruned, {len(summary["unlisted"])} unlisted)'
+          + (' [dry run]' if dry_run else ''))
+    print('  '.join(f'{phase} {seconds * 1000:.1f}ms' for phase, seconds in summary['timings'].items()))
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='load the shonagon question bank, writing only files that changed')
+    parser.add_argument('--path', default=FIXTURE_DIRECTORY)
+    parser.add_argument('--dry-run', action='store_true', help='print what would change without writing')
+    parser.add_argument('--prune', action='store_true',
+                        help='delete unanswered questions whose file is gone, and the answers to a catalog loaded '
+                             'without fixture hashes')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='parser processes for large banks (default: parse in-process)')
+    args = parser.parse_args()
     create_database()
-    load()
+    try:
+        summary = load(args.path, args.dry_run, args.prune, args.workers)
+    except LegacyCatalogError as e:
+        raise SystemExit(str(e))
+    report(summary, args.dry_run)